@@ -0,0 +1,339 @@
+import argparse
+import base64
+import importlib.util
+import json
+import logging
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+"""
+Benchmarks the cold and warm start latency of the pull request Lambda
+function (lambda_function/lambda_function.py).
+
+Against a deployed function, every cold start is forced by changing its
+configuration, and the Init Duration and Duration of the REPORT log line of
+every invocation are recorded. Locally, every cold start is a fresh Python
+process that imports the handler module and invokes it.
+
+Locally, the default event is a push to a pull request, so the whole handler
+runs: the boto3 import, the CodeBuild client and the build store are created
+on the first invocation, as in Lambda. The CodeBuild calls are answered by a
+stub (on a real boto3 client, if boto3 is installed) and the in-memory build
+store is used, so nothing is started. Every invocation pushes a new commit.
+A deployed function is invoked with an event it ignores unless --event is
+given, since a pull request event would start real builds.
+"""
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda_function")
+
+PULL_REQUEST_EVENT = {
+    "detail-type": "CodeCommit Pull Request State Change",
+    "source": "aws.codecommit",
+    "detail": {
+        "event": "pullRequestSourceBranchUpdated",
+        "repositoryNames": ["SCP-management-pipeline"],
+        "pullRequestId": "1",
+        "sourceReference": "refs/heads/feature",
+        "destinationReference": "refs/heads/main",
+        "sourceCommit": "0123456789abcdef0123456789abcdef01234567",
+        "destinationCommit": "89abcdef0123456789abcdef0123456789abcdef",
+    },
+}
+
+IGNORED_EVENT = {"detail": {"event": "benchmark"}}
+
+# The environment of the function, for local runs
+LOCAL_ENVIRONMENT = {
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "TERRAFORMPLAN_PROJECT_NAME": "SCP-Plan-Validate",
+    "ACCESSANALYZERCHECKS_PROJECT_NAME": "IAM-Access-analyzer-checks",
+}
+
+REPORT_FIELDS = {
+    "duration_ms": r"\tDuration: ([0-9.]+) ms",
+    "init_ms": r"Init Duration: ([0-9.]+) ms",
+    "max_memory_mb": r"Max Memory Used: ([0-9]+) MB",
+}
+
+# Runs in a fresh interpreter, so the import is a cold start
+LOCAL_RUNNER = """
+import itertools, json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import lambda_function
+init_ms = (time.perf_counter() - started) * 1000
+# The handler prints its EMF timing records, only the results go to stdout
+results_output, sys.stdout = sys.stdout, sys.stderr
+
+class StubCodeBuild:
+    # Answers like CodeBuild, every build is still running
+    class exceptions:
+        InvalidInputException = type("InvalidInputException", (Exception,), {})
+
+    def __init__(self):
+        self.build_numbers = itertools.count(1)
+
+    def start_build(self, projectName, **kwargs):
+        return {"build": {"id": f"{projectName}:{next(self.build_numbers)}"}}
+
+    def batch_get_builds(self, ids):
+        return {"builds": [{"id": id, "buildStatus": "IN_PROGRESS"} for id in ids]}
+
+    def stop_build(self, id):
+        return {"build": {"id": id, "buildStatus": "STOPPED"}}
+
+create_client = lambda_function.codebuild_client
+
+def codebuild_client():
+    # The real client is created (and boto3 imported) on first use, as in
+    # Lambda, but its calls are answered by the stub instead of AWS
+    if "codebuild" not in lambda_function._clients:
+        stub = StubCodeBuild()
+        try:
+            client = create_client()
+        except ImportError:
+            lambda_function._clients["codebuild"] = stub
+            return stub
+        from botocore import xform_name
+        from botocore.awsrequest import AWSResponse
+
+        def answer(model, params, **kwargs):
+            request = json.loads(params["body"] or b"{}")
+            response = getattr(stub, xform_name(model.name))(**request)
+            return AWSResponse(params["url"], 200, {}, None), response
+
+        client.meta.events.register("before-call.codebuild.*", answer)
+    return lambda_function._clients["codebuild"]
+
+lambda_function.codebuild_client = codebuild_client
+event = json.loads(sys.argv[2])
+commit = event.get("detail", {}).get("sourceCommit")
+results = []
+for number in range(int(sys.argv[3])):
+    if commit:
+        # A new commit every time, so that it isn't skipped as already validated
+        event["detail"]["sourceCommit"] = f"{commit}-{number}"
+    started = time.perf_counter()
+    lambda_function.lambda_handler(event, None)
+    results.append({
+        "init_ms": init_ms if number == 0 else None,
+        "duration_ms": (time.perf_counter() - started) * 1000,
+    })
+results_output.write(json.dumps(results))
+"""
+
+
+def _parse_report(log):
+    report = {}
+    for field, pattern in REPORT_FIELDS.items():
+        match = re.search(pattern, log)
+        report[field] = float(match.group(1)) if match else None
+    return report
+
+
+def _invoke(lambda_client, function_name, event):
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        Payload=json.dumps(event).encode(),
+        LogType="Tail",
+    )
+    if "FunctionError" in response:
+        raise RuntimeError(
+            f"{function_name} failed: {response['Payload'].read().decode()}"
+        )
+    return _parse_report(base64.b64decode(response["LogResult"]).decode())
+
+
+def benchmark_deployed(function_name, cold_starts, invocations, event):
+    """
+    Returns one result per invocation of a deployed function; the first
+    invocation after every configuration change is a cold start.
+    """
+    import boto3
+
+    lambda_client = boto3.client("lambda")
+    waiter = lambda_client.get_waiter("function_updated")
+    environment = lambda_client.get_function_configuration(
+        FunctionName=function_name
+    ).get("Environment", {"Variables": {}})
+    results = []
+    try:
+        for cold_start in range(cold_starts):
+            # A new configuration makes Lambda start new execution environments
+            lambda_client.update_function_configuration(
+                FunctionName=function_name,
+                Environment={
+                    "Variables": {
+                        **environment["Variables"],
+                        "BENCHMARK_COLD_START": f"{time.time()}-{cold_start}",
+                    }
+                },
+            )
+            waiter.wait(FunctionName=function_name)
+            for _ in range(invocations):
+                results.append(_invoke(lambda_client, function_name, event))
+    finally:
+        lambda_client.update_function_configuration(
+            FunctionName=function_name,
+            Environment={"Variables": environment["Variables"]},
+        )
+    return results
+
+
+def benchmark_local(cold_starts, invocations, event):
+    """
+    Returns one result per invocation of the handler in local processes; the
+    first invocation in every process is a cold start.
+    """
+    if importlib.util.find_spec("boto3") is None:
+        logging.warning(
+            "boto3 is not installed, the CodeBuild client is a stub and its "
+            "import and creation are not measured."
+        )
+    # The in-memory build store, DynamoDB is never called
+    environment = {
+        **LOCAL_ENVIRONMENT,
+        **{k: v for k, v in os.environ.items() if k != "BUILD_STATE_TABLE"},
+    }
+    results = []
+    for _ in range(cold_starts):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                LOCAL_RUNNER,
+                LAMBDA_DIR,
+                json.dumps(event),
+                str(invocations),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+            env=environment,
+        ).stdout
+        process_ms = (time.perf_counter() - started) * 1000
+        for result in json.loads(output):
+            if result["init_ms"] is not None:
+                # Includes the start of the interpreter, like the Lambda runtime does
+                result["process_ms"] = process_ms
+            results.append(result)
+    return results
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    if len(values) == 1:
+        return {"p50": values[0], "p90": values[0], "max": values[0]}
+    deciles = statistics.quantiles(values, n=10, method="inclusive")
+    return {"p50": deciles[4], "p90": deciles[8], "max": max(values)}
+
+
+def summarize(results):
+    cold = [result for result in results if result["init_ms"] is not None]
+    warm = [result for result in results if result["init_ms"] is None]
+    return {
+        "cold_starts": len(cold),
+        "warm_invocations": len(warm),
+        "cold_init_ms": _percentiles([result["init_ms"] for result in cold]),
+        "cold_duration_ms": _percentiles([result["duration_ms"] for result in cold]),
+        "warm_duration_ms": _percentiles([result["duration_ms"] for result in warm]),
+    }
+
+
+def benchmark_lambda(
+    # [Optional] The name of the deployed function (Defaults to running the handler locally)
+    function_name=None,
+    # [Optional] How many cold starts to measure
+    cold_starts=5,
+    # [Optional] How many invocations per cold start, the first one is cold
+    invocations=10,
+    # [Optional] A JSON file with the event to invoke the function with
+    event=None,
+    # [Optional] Write the results as JSON to this file
+    output=None,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    benchmark_lambda(function_name="SCPManagementPipeline-PipelineTargetForPullRequest-xxxxxxxxxxx")
+    benchmark_lambda(cold_starts=20, output="lambda_benchmark.json")
+    """
+    if event:
+        with open(event) as event_file:
+            event = json.load(event_file)
+    elif function_name:
+        event = IGNORED_EVENT
+        logging.warning(
+            "Invoking the function with an event it ignores, pass --event with a "
+            "pull request event to measure the whole handler (it starts builds)."
+        )
+    else:
+        event = PULL_REQUEST_EVENT
+    if function_name:
+        results = benchmark_deployed(function_name, cold_starts, invocations, event)
+    else:
+        results = benchmark_local(cold_starts, invocations, event)
+    summary = summarize(results)
+    for name, value in summary.items():
+        if isinstance(value, dict):
+            value = ", ".join(f"{key} {number:.2f}" for key, number in value.items())
+        logging.warning(f"{name}: {value}")
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(
+                {
+                    "function_name": function_name,
+                    "summary": summary,
+                    "invocations": results,
+                },
+                output_file,
+                indent=2,
+            )
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Cold and warm start benchmark of the pull request Lambda function"
+    )
+    parser.set_defaults(method=benchmark_lambda)
+    parser.add_argument(
+        "--function_name",
+        type=str,
+        required=False,
+        help="The name of the deployed function. Defaults to running the handler locally.",
+    )
+    parser.add_argument(
+        "--cold_starts",
+        type=int,
+        default=5,
+        help="How many cold starts to measure (default 5).",
+    )
+    parser.add_argument(
+        "--invocations",
+        type=int,
+        default=10,
+        help="How many invocations per cold start, the first one is cold (default 10).",
+    )
+    parser.add_argument(
+        "--event",
+        type=str,
+        required=False,
+        help="A JSON file with the event to invoke the function with. Defaults to a pull request event locally, and to an event the handler ignores for a deployed function.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Write the results as JSON to this file.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
@@ -0,0 +1,108 @@
+import logging
+import os
+import time
+
+"""
+Idempotency store of the pull request builds: which source commits were
+already validated, and which builds were started last for each pull request.
+
+DynamoDB is used when BUILD_STATE_TABLE is set, an in-memory stand-in
+otherwise (e.g. for local tests of the handler).
+"""
+
+# How long a validated commit and the builds of a pull request are remembered
+TTL_SECONDS = 14 * 24 * 3600
+
+
+def _commit_key(repository, commit):
+    return f"commit#{repository}#{commit}"
+
+
+def _pull_request_key(repository, pull_request_id):
+    return f"pr#{repository}#{pull_request_id}"
+
+
+class DynamoDBBuildStore:
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        if client is None:
+            # Imported on first use, it is most of the cold start
+            import boto3
+
+            client = boto3.client("dynamodb")
+        self.client = client
+
+    def claim_commit(self, repository, commit):
+        """
+        Records the commit as validated. Returns False if it already was.
+        """
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "pk": {"S": _commit_key(repository, commit)},
+                    "expires_at": {"N": str(int(time.time()) + TTL_SECONDS)},
+                },
+                ConditionExpression="attribute_not_exists(pk)",
+            )
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def release_commit(self, repository, commit):
+        # The builds of the commit could not be started, so it can be retried
+        self.client.delete_item(
+            TableName=self.table_name,
+            Key={"pk": {"S": _commit_key(repository, commit)}},
+        )
+
+    def get_builds(self, repository, pull_request_id):
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={"pk": {"S": _pull_request_key(repository, pull_request_id)}},
+            ConsistentRead=True,
+        ).get("Item", {})
+        return item.get("build_ids", {}).get("SS", [])
+
+    def put_builds(self, repository, pull_request_id, source_commit, build_ids):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={
+                "pk": {"S": _pull_request_key(repository, pull_request_id)},
+                "source_commit": {"S": source_commit},
+                "build_ids": {"SS": build_ids},
+                "expires_at": {"N": str(int(time.time()) + TTL_SECONDS)},
+            },
+        )
+
+
+class MemoryBuildStore:
+
+    def __init__(self):
+        self.commits = set()
+        self.builds = {}
+
+    def claim_commit(self, repository, commit):
+        key = _commit_key(repository, commit)
+        if key in self.commits:
+            return False
+        self.commits.add(key)
+        return True
+
+    def release_commit(self, repository, commit):
+        self.commits.discard(_commit_key(repository, commit))
+
+    def get_builds(self, repository, pull_request_id):
+        return self.builds.get(_pull_request_key(repository, pull_request_id), [])
+
+    def put_builds(self, repository, pull_request_id, source_commit, build_ids):
+        self.builds[_pull_request_key(repository, pull_request_id)] = list(build_ids)
+
+
+def build_store():
+    table_name = os.environ.get("BUILD_STATE_TABLE")
+    if table_name:
+        return DynamoDBBuildStore(table_name)
+    logging.warning("BUILD_STATE_TABLE is not set, keeping the build state in memory")
+    return MemoryBuildStore()
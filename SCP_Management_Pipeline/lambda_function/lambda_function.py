@@ -1,68 +1,157 @@
-import boto3
-import os 
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-build = boto3.client('codebuild')
-commit = boto3.client('codecommit')
+from build_store import build_store
+
+# The function logs in JSON (see pipeline.py), so the extra fields of a record become searchable fields
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+PULL_REQUEST_EVENTS = ("pullRequestCreated", "pullRequestSourceBranchUpdated")
+
+# The pull request details passed to both builds, as (environment variable, event detail field)
+BUILD_VARIABLES = (
+    ("pullRequestId", "pullRequestId"),
+    ("destinationCommit", "destinationCommit"),
+    ("sourceCommit", "sourceCommit"),
+)
+
+# Timing records in CloudWatch embedded metric format, like those of scp_analysis/stage_timing.py in the builds
+METRICS_NAMESPACE = "SCPManagementPipeline"
+TIMING_STAGE = "PullRequestLambda"
+
+# Both are created on first use, and reused by warm invocations
+_clients = {}
+
+def codebuild_client():
+    if "codebuild" not in _clients:
+        import boto3
+        _clients["codebuild"] = boto3.client("codebuild")
+    return _clients["codebuild"]
+
+def store():
+    if "store" not in _clients:
+        _clients["store"] = build_store()
+    return _clients["store"]
+
+@lru_cache(maxsize=None)
+def source_location(repositoryName):
+    return f"https://git-codecommit.{os.environ['AWS_REGION']}.amazonaws.com/v1/repos/{repositoryName}"
+
+@lru_cache(maxsize=None)
+def build_projects():
+    return (os.environ['TERRAFORMPLAN_PROJECT_NAME'], os.environ['ACCESSANALYZERCHECKS_PROJECT_NAME'])
+
+def build_variables(detail, repositoryName):
+    variables = {name: detail[field] for name, field in BUILD_VARIABLES}
+    variables["targetBranch"] = detail["destinationReference"].split('/')[2]
+    variables["sourceBranch"] = detail["sourceReference"].split('/')[2]
+    variables["repositoryName"] = repositoryName
+    return [{'name': name, 'value': value, 'type': 'PLAINTEXT'} for name, value in variables.items()]
+
+def start_build(projectName, repositoryName, sourceVersion, build_Var):
+    return codebuild_client().start_build(
+                projectName=projectName,
+                sourceLocationOverride=source_location(repositoryName),
+                artifactsOverride={'type': 'NO_ARTIFACTS'},
+                sourceVersion=sourceVersion,
+                sourceTypeOverride='CODECOMMIT',
+                environmentVariablesOverride=build_Var
+                )["build"]["id"]
+
+def stop_superseded_builds(build_ids):
+    # Stop the builds of earlier pushes to the pull request that are still running
+    if not build_ids:
+        return []
+    build = codebuild_client()
+    stopped = []
+    for previousBuild in build.batch_get_builds(ids=build_ids)["builds"]:
+        if previousBuild["buildStatus"] == "IN_PROGRESS":
+            try:
+                build.stop_build(id=previousBuild["id"])
+                stopped.append(previousBuild["id"])
+            except build.exceptions.InvalidInputException:
+                # The build finished in the meantime
+                pass
+    return stopped
+
+def emit_timings(timings, failed, fields):
+    for phase, duration_ms in timings.items():
+        sys.stdout.write(json.dumps({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Stage", "Phase"]],
+                    "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"}, {"Name": "Failed", "Unit": "Count"}]
+                }]
+            },
+            "Stage": TIMING_STAGE,
+            "Phase": phase,
+            "Duration": round(duration_ms, 1),
+            "Failed": int(failed),
+            **fields
+        }) + "\n")
+    sys.stdout.flush()
 
 def lambda_handler(event, context):
-    
-    #get details of code build result
-    if event["detail"]["event"] == "pullRequestCreated" or event["detail"]["event"] == "pullRequestSourceBranchUpdated":
-        
-        targetBranch = event["detail"]["destinationReference"].split('/')[2]
-        sourceBranch = event["detail"]["sourceReference"].split('/')[2]
-
-        build_Var = [
-                        {
-                              'name': 'pullRequestId',
-                              'value': event["detail"]["pullRequestId"],
-                              'type': 'PLAINTEXT'
-                        },
-                        {
-                              'name': 'targetBranch',
-                              'value': targetBranch,
-                              'type': 'PLAINTEXT'
-                        },
-                        {
-                              'name': 'sourceBranch',
-                              'value': sourceBranch,
-                              'type': 'PLAINTEXT'
-                        },
-                        {
-                              'name': 'destinationCommit',
-                              'value': event["detail"]["destinationCommit"],
-                              'type': 'PLAINTEXT'
-                        },
-                        {
-                              'name': 'sourceCommit',
-                              'value': event["detail"]["sourceCommit"],
-                              'type': 'PLAINTEXT'
-                        },
-                        {
-                              'name': 'repositoryName',
-                              'value': event["detail"]["repositoryNames"][0],
-                              'type': 'PLAINTEXT'
-                        }]
-
-    #start code build with updated parameters from the pull request event
-        startBuild_1 = build.start_build(
-                    projectName=os.environ['TERRAFORMBUILD_PROJECT_NAME'],
-                    sourceLocationOverride="https://git-codecommit." + os.environ['AWS_REGION'] + ".amazonaws.com/v1/repos/" + event["detail"]["repositoryNames"][0],
-                    artifactsOverride={'type': 'NO_ARTIFACTS'},
-                    sourceVersion=sourceBranch,
-                    sourceTypeOverride='CODECOMMIT',
-                    environmentVariablesOverride=build_Var
-                    )
-        
-        print(startBuild_1)
-
-        startBuild_2 = build.start_build(
-                    projectName=os.environ['ACCESSANALYZERCHECKS_PROJECT_NAME'],
-                    sourceLocationOverride="https://git-codecommit." + os.environ['AWS_REGION'] + ".amazonaws.com/v1/repos/" + event["detail"]["repositoryNames"][0],
-                    artifactsOverride={'type': 'NO_ARTIFACTS'},
-                    sourceVersion=sourceBranch,
-                    sourceTypeOverride='CODECOMMIT',
-                    environmentVariablesOverride=build_Var
-                    )
-                    
-        print(startBuild_2)
\ No newline at end of file
+
+    detail = event["detail"]
+    if detail["event"] not in PULL_REQUEST_EVENTS:
+        return {"status": "ignored"}
+
+    repositoryName = detail["repositoryNames"][0]
+    pullRequestId = detail["pullRequestId"]
+    sourceCommit = detail["sourceCommit"]
+    fields = {"repositoryName": repositoryName, "pullRequestId": pullRequestId, "sourceCommit": sourceCommit}
+
+    timings = {}
+    started = checkpoint = time.perf_counter()
+
+    def record(phase):
+        nonlocal checkpoint
+        now = time.perf_counter()
+        timings[phase] = (now - checkpoint) * 1000
+        checkpoint = now
+
+    # EventBridge can deliver an event more than once, and a commit can be pushed to several pull requests
+    claimed = store().claim_commit(repositoryName, sourceCommit)
+    record("claim")
+    if not claimed:
+        logger.info("Commit already validated, skipping the builds", extra={**fields, "status": "skipped"})
+        emit_timings(timings, False, fields)
+        return {"status": "skipped", "sourceCommit": sourceCommit}
+
+    build_Var = build_variables(detail, repositoryName)
+    try:
+        stopped = stop_superseded_builds(store().get_builds(repositoryName, pullRequestId))
+        record("stop_superseded")
+
+        #start both code builds at once, with updated parameters from the pull request event
+        projects = build_projects()
+        # Created before the threads, creating boto3 clients is not thread safe
+        codebuild_client()
+        with ThreadPoolExecutor(max_workers=len(projects)) as executor:
+            buildIds = list(executor.map(
+                lambda projectName: start_build(projectName, repositoryName, sourceCommit, build_Var),
+                projects
+            ))
+        record("start_builds")
+    except Exception:
+        # Let a retry of the event start the builds
+        store().release_commit(repositoryName, sourceCommit)
+        timings["total"] = (time.perf_counter() - started) * 1000
+        emit_timings(timings, True, fields)
+        raise
+
+    store().put_builds(repositoryName, pullRequestId, sourceCommit, buildIds)
+    record("record_builds")
+    timings["total"] = (time.perf_counter() - started) * 1000
+    emit_timings(timings, False, fields)
+    logger.info("Started the pull request builds", extra={**fields, "status": "started", "buildIds": buildIds, "stoppedBuildIds": stopped})
+    return {"status": "started", "sourceCommit": sourceCommit, "buildIds": buildIds}
@@ -44,6 +44,8 @@ class Pipeline(Construct):
                     branch="main",
                     repository=devtools.code_repo,
                     output=source_output,
+                    # A full clone, so the plan stage can diff the SCPs against the previous commit
+                    code_build_clone_output=True,
                     run_order=1
                 )
             ]
@@ -86,7 +88,8 @@ def lambda_handler(event, context):
         }
             """),
             handler="index.lambda_handler",
-            runtime=awslambda.Runtime.PYTHON_3_8,
+            runtime=awslambda.Runtime.PYTHON_3_12,
+            architecture=awslambda.Architecture.ARM_64,
             environment={
                 "BUCKET_NAME": tfstate_bucket.bucket_name
             }
@@ -145,6 +148,12 @@ def lambda_handler(event, context):
                 privileged=False,
                 build_image=codebuild.LinuxBuildImage.AMAZON_LINUX_2_3
             ),
+            # The deployment manifest next to the Terraform state (see scp_analysis/scp_changes.py)
+            environment_variables={
+                "TFSTATE_BUCKET": codebuild.BuildEnvironmentVariable(value=tfstate_bucket.bucket_name),
+                # Set to "true" to plan and apply every SCP instead of only the changed ones, which also reverts SCPs changed outside Terraform
+                "FULL_RUN": codebuild.BuildEnvironmentVariable(value="false")
+            },
             description="Build",
             timeout=cdk.Duration.minutes(60)
         )
@@ -209,6 +218,7 @@ def lambda_handler(event, context):
                 action_name="Terraform-plan-validate",
                 input=source_output,
                 project=Terraformplan,
+                variables_namespace="SCPPlan",
                 run_order=1
             )
         )
@@ -224,10 +234,16 @@ def lambda_handler(event, context):
             self, "IAMACCESSANALYZERCHECKS",
             project_name="IAM-Access-analyzer-checks",
             build_spec=codebuild.BuildSpec.from_asset("./SCP_Management_Pipeline/access_analyzer_checks_buildspec.yaml"),
+            # Keeps the pip cache of the buildspec between builds
+            cache=codebuild.Cache.bucket(tfstate_bucket, prefix="codebuild-cache/access-analyzer"),
             environment=codebuild.BuildEnvironment(
                 privileged=False,
                 build_image=codebuild.LinuxBuildImage.AMAZON_LINUX_2_3
             ),
+            # The deployment manifest next to the Terraform state (see scp_analysis/scp_changes.py)
+            environment_variables={
+                "TFSTATE_BUCKET": codebuild.BuildEnvironmentVariable(value=tfstate_bucket.bucket_name)
+            },
             description="Policy grammar and syntax checks",
             timeout=cdk.Duration.minutes(60)
         )
@@ -338,7 +354,9 @@ def lambda_handler(event, context):
         human_approval_action = codepipeline_actions.ManualApprovalAction(
             action_name="ReviewerApprovalAction",
             notification_topic=sns_topic,
-            additional_information=review_url
+            external_entity_link=review_url,
+            # The effective permission changes computed in the plan stage (see scp_analysis/scp_diff.py)
+            additional_information="SCP changes: #{SCPPlan.SCP_DIFF_SUMMARY} (see the SCP-Plan-Validate build log for the full diff)"
         )
         human_approval_stage.add_action(human_approval_action)
 
@@ -356,6 +374,12 @@ def lambda_handler(event, context):
                 privileged=False,
                 build_image=codebuild.LinuxBuildImage.AMAZON_LINUX_2_3
             ),
+            # The deployment manifest next to the Terraform state (see scp_analysis/scp_changes.py)
+            environment_variables={
+                "TFSTATE_BUCKET": codebuild.BuildEnvironmentVariable(value=tfstate_bucket.bucket_name),
+                # Set to "true" to plan and apply every SCP instead of only the changed ones, which also reverts SCPs changed outside Terraform
+                "FULL_RUN": codebuild.BuildEnvironmentVariable(value="false")
+            },
             description="Deploy",
             timeout=cdk.Duration.minutes(60)
         )
@@ -441,29 +465,45 @@ def lambda_handler(event, context):
                 resources=[devtools.code_repo.repository_arn],
                 detail={ 
                     "destinationReference": ["refs/heads/main"],
-                    "event": ["pullRequestCreated"]
+                    "event": ["pullRequestCreated", "pullRequestSourceBranchUpdated"]
                     }
                 )
         )
 
+        ### Commits already validated and the latest builds of every pull request, so the lambda function
+        ### skips duplicate events and stops the builds of superseded pushes
+        build_state_table = dynamodb.Table(
+            self, "pull-request-build-state",
+            partition_key=dynamodb.Attribute(name="pk", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            encryption=dynamodb.TableEncryption.AWS_MANAGED,
+            time_to_live_attribute="expires_at",
+            removal_policy=cdk.RemovalPolicy.DESTROY
+        )
+
         ### Define lambda function to trigger pipeline based on event bridge rule
         lambda_function = awslambda.Function(
             self, "TargetForPullRequests",
             code=awslambda.Code.from_asset("./SCP_Management_Pipeline/lambda_function"),
             handler="lambda_function.lambda_handler",
-            runtime=awslambda.Runtime.PYTHON_3_11,
+            runtime=awslambda.Runtime.PYTHON_3_12,
+            architecture=awslambda.Architecture.ARM_64,
+            # One JSON line per invocation, with the pull request and build IDs as fields
+            logging_format=awslambda.LoggingFormat.JSON,
             environment={
-                "Terraformplan_PROJECT_NAME": Terraformplan.project_name,
+                "TERRAFORMPLAN_PROJECT_NAME": Terraformplan.project_name,
                 "ACCESSANALYZERCHECKS_PROJECT_NAME": accessanalyzerchecks.project_name,
                 "TERRAFORMDEPLOY_PROJECT_NAME": Terraformdeploy.project_name,
+                "BUILD_STATE_TABLE": build_state_table.table_name,
             }
         )
 
         ### Define role permissions for Lambda function
         lambda_function.add_to_role_policy(iam.PolicyStatement(
-            actions=["codebuild:StartBuild"],
+            actions=["codebuild:StartBuild", "codebuild:StopBuild", "codebuild:BatchGetBuilds"],
             resources=[Terraformplan.project_arn, accessanalyzerchecks.project_arn, Terraformdeploy.project_arn]
         ))
+        build_state_table.grant_read_write_data(lambda_function)
 
         NagSuppressions.add_resource_suppressions(lambda_function,[{
             'id': 'AwsSolutions-IAM4', 'reason': 'supressing since it only allows your lambda permissions to write logs'
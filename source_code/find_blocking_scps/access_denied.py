@@ -0,0 +1,482 @@
+import argparse
+import codecs
+import gzip
+import json
+import logging
+import os
+import re
+from collections import Counter, OrderedDict
+
+import boto3
+
+from scp_block_finder import (
+    ImplicitDeny,
+    Organization,
+    build_request_context,
+    evaluate_index,
+    load_snapshot,
+)
+
+"""
+Attributes the AccessDenied errors in CloudTrail logs that an SCP caused to
+the SCP statements responsible, and counts them per statement.
+
+The logs are streamed: files one after the other, and every file event by
+event, so memory stays bounded however large the log set is. Verdicts are
+cached by account, action, the resource patterns of the SCPs that the
+resource matches, region and principal.
+"""
+
+# Bytes of a log file decoded at a time
+CHUNK_SIZE = 1 << 20
+
+DEFAULT_MAX_CACHE_ENTRIES = 100000
+
+# How many actions and accounts are listed per statement
+TOP_COUNT = 10
+
+LOG_FILE_SUFFIXES = (".json", ".json.gz", ".jsonl", ".jsonl.gz")
+
+ACCESS_DENIED_CODES = (
+    "AccessDenied",
+    "AccessDeniedException",
+    "Client.UnauthorizedOperation",
+    "UnauthorizedOperation",
+)
+
+SCP_MESSAGE_PATTERN = re.compile(r"service control polic(y|ies)", re.I)
+EXPLICIT_DENY_PATTERN = re.compile(r"explicit deny in a service control policy", re.I)
+IMPLICIT_DENY_PATTERN = re.compile(r"no service control policy allows", re.I)
+POLICY_ARN_PATTERN = re.compile(
+    r"arn:aws[\w-]*:organizations::\d+:policy/o-\w+/service_control_policy/p-\w+"
+)
+
+RECORDS_START_PATTERN = re.compile(r'\s*\{\s*"Records"\s*:\s*\[')
+
+# Event sources whose IAM action prefix is not the first label of the source
+ACTION_PREFIXES = {
+    "monitoring": "cloudwatch",
+    "email": "ses",
+    "tagging": "tag",
+    "runtime.lex": "lex",
+    "runtime.sagemaker": "sagemaker",
+}
+
+
+def _iter_records_array(stream, buffer, position):
+    # The events of {"Records": [...]}, decoded one at a time
+    decoder = json.JSONDecoder()
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position == len(buffer):
+            buffer, position = stream.read(CHUNK_SIZE), 0
+            if not buffer:
+                return
+            continue
+        if buffer[position] == "]":
+            return
+        try:
+            event, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The event continues in the next chunk
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                raise
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield event
+
+
+def _iter_lines(stream, buffer):
+    while True:
+        *lines, buffer = buffer.split("\n")
+        yield from lines
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+    if buffer:
+        yield buffer
+
+
+def iter_events(stream):
+    """
+    Yields the CloudTrail events of a text stream, either a CloudTrail log file
+    ({"Records": [...]}) or one event per line (as CloudTrail events or as the
+    output of lookup-events, with the event in "CloudTrailEvent").
+    """
+    buffer = stream.read(CHUNK_SIZE)
+    start = RECORDS_START_PATTERN.match(buffer)
+    if start:
+        yield from _iter_records_array(stream, buffer, start.end())
+        return
+    for line in _iter_lines(stream, buffer):
+        if not line.strip():
+            continue
+        event = json.loads(line)
+        yield (
+            json.loads(event["CloudTrailEvent"])
+            if "CloudTrailEvent" in event
+            else event
+        )
+
+
+def iter_log_files(source, endpoint_url=None):
+    """
+    Yields (name, binary stream) for every log file of a local file, a local
+    directory (recursively, in name order) or an s3://bucket/prefix URL.
+    """
+    if source.startswith("s3://"):
+        s3 = boto3.client("s3", endpoint_url=endpoint_url)
+        bucket, _, prefix = source[len("s3://") :].partition("/")
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                if item["Key"].endswith(LOG_FILE_SUFFIXES):
+                    body = s3.get_object(Bucket=bucket, Key=item["Key"])["Body"]
+                    yield f"s3://{bucket}/{item['Key']}", body
+        return
+    if os.path.isfile(source):
+        paths = [source]
+    else:
+        paths = sorted(
+            os.path.join(directory, name)
+            for directory, _, names in os.walk(source)
+            for name in names
+            if name.endswith(LOG_FILE_SUFFIXES)
+        )
+    for path in paths:
+        with open(path, "rb") as log_file:
+            yield path, log_file
+
+
+def read_log_events(source, endpoint_url=None):
+    """
+    Yields the CloudTrail events of every log file of a source (see
+    iter_log_files), gzipped or not.
+    """
+    for name, body in iter_log_files(source, endpoint_url):
+        if name.endswith(".gz"):
+            stream = gzip.open(body, "rt", encoding="utf-8")
+        else:
+            stream = codecs.getreader("utf-8")(body)
+        try:
+            yield from iter_events(stream)
+        finally:
+            stream.close()
+
+
+def is_scp_denial(event):
+    """
+    Returns whether an event is an access denied error that an SCP caused.
+    """
+    return event.get("errorCode") in ACCESS_DENIED_CODES and bool(
+        SCP_MESSAGE_PATTERN.search(event.get("errorMessage") or "")
+    )
+
+
+def _principal_arn(identity):
+    # aws:PrincipalArn is the role ARN for assumed roles
+    issuer = (identity.get("sessionContext") or {}).get("sessionIssuer") or {}
+    if identity.get("type") == "AssumedRole" and issuer.get("arn"):
+        return issuer["arn"]
+    if identity.get("type") in ("IAMUser", "Root"):
+        return identity.get("arn", "")
+    return ""
+
+
+def _resource(event):
+    for resource in event.get("resources") or []:
+        if resource.get("ARN"):
+            return resource["ARN"]
+    parameters = event.get("requestParameters") or {}
+    if event.get("eventSource") == "s3.amazonaws.com" and parameters.get("bucketName"):
+        key = parameters.get("key")
+        return f"arn:aws:s3:::{parameters['bucketName']}" + (f"/{key}" if key else "")
+    return "*"
+
+
+def event_query(event):
+    """
+    Returns the block finder query of a CloudTrail event: its account, action,
+    resource, region and principal.
+    """
+    identity = event.get("userIdentity") or {}
+    source = event.get("eventSource", "").replace(".amazonaws.com", "")
+    prefix = ACTION_PREFIXES.get(source, source.split(".")[0])
+    query = {
+        "target": identity.get("accountId") or event.get("recipientAccountId", ""),
+        "action": f"{prefix}:{event.get('eventName', '')}",
+        "resource": _resource(event),
+        "region": event.get("awsRegion", ""),
+        "principal_arn": _principal_arn(identity),
+        "account": identity.get("accountId", ""),
+        "denial": denial_kind(event.get("errorMessage") or ""),
+    }
+    return query
+
+
+def denial_kind(message):
+    """
+    Returns what the error message says blocked the request: "explicit" or
+    "implicit" (or "" if it doesn't say), and the SCP ARNs it names.
+    """
+    if EXPLICIT_DENY_PATTERN.search(message):
+        kind = "explicit"
+    elif IMPLICIT_DENY_PATTERN.search(message):
+        kind = "implicit"
+    else:
+        kind = ""
+    return kind, tuple(sorted(set(POLICY_ARN_PATTERN.findall(message))))
+
+
+def _restrict(findings, denial):
+    # Keep the findings that match what the error message says blocked the request
+    kind, policy_arns = denial
+    if kind == "explicit":
+        explicit = [f for f in findings if not isinstance(f, ImplicitDeny)]
+        named = [f for f in explicit if f.policy_arn in policy_arns]
+        return named or explicit or findings
+    if kind == "implicit":
+        return [f for f in findings if isinstance(f, ImplicitDeny)] or findings
+    return findings
+
+
+class VerdictCache:
+    """
+    Attributions by (account, action, resource patterns, region, principal),
+    least recently used first out once max_entries is reached.
+
+    Two resources get the same verdict if they match the same resource
+    patterns of the statements that can apply to the action, so the patterns
+    they match are cached instead of the resources themselves.
+    """
+
+    def __init__(
+        self,
+        organization,
+        complete_context=False,
+        max_entries=DEFAULT_MAX_CACHE_ENTRIES,
+    ):
+        self.organization = organization
+        self.complete_context = complete_context
+        self.max_entries = max_entries
+        self._verdicts = OrderedDict()
+        self._statements = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _resource_statements(self, target, action):
+        # The statements that can apply to the action and don't match every resource
+        key = (target, action.lower())
+        statements = self._statements.get(key)
+        if statements is None:
+            index = self.organization.get_policy_index(target)
+            candidates = list(index.candidates(action))
+            for allow_level in index.levels.values():
+                candidates.extend(allow_level.statements)
+            statements = [
+                statement
+                for statement in candidates
+                if statement.matches_action(action)
+                and not (
+                    not statement.resource_negated
+                    and "*" in statement.resource_patterns
+                )
+            ]
+            self._statements[key] = statements
+        return statements
+
+    def attribute(self, query):
+        """
+        Returns the findings (see evaluate_index) that explain the denial.
+        """
+        resource_patterns = tuple(
+            statement.matches_resource(query["resource"])
+            for statement in self._resource_statements(query["target"], query["action"])
+        )
+        key = (
+            query["target"],
+            query["action"].lower(),
+            resource_patterns,
+            query["region"],
+            query["principal_arn"],
+            json.dumps(query.get("context"), sort_keys=True),
+            query["denial"],
+        )
+        findings = self._verdicts.get(key)
+        if findings is not None:
+            self.hits += 1
+            self._verdicts.move_to_end(key)
+            return findings
+        self.misses += 1
+        findings = _restrict(
+            evaluate_index(
+                self.organization.get_policy_index(query["target"]),
+                query["action"],
+                query["resource"],
+                build_request_context(
+                    query["region"],
+                    query["principal_arn"],
+                    query["account"],
+                    self.organization.org_id,
+                    context=query.get("context"),
+                    complete=self.complete_context,
+                ),
+            ),
+            query["denial"],
+        )
+        self._verdicts[key] = findings
+        if len(self._verdicts) > self.max_entries:
+            self._verdicts.popitem(last=False)
+        return findings
+
+
+def attribute_events(events, cache):
+    """
+    Yields (query, findings or None, error or None) for every SCP denial
+    among the events.
+    """
+    for event in events:
+        if not is_scp_denial(event):
+            continue
+        query = event_query(event)
+        try:
+            yield query, cache.attribute(query), None
+        except Exception as error:
+            # E.g. an account that left the organization after the event
+            yield query, None, f"{type(error).__name__}: {error}"
+
+
+def aggregate(attributions):
+    """
+    Returns the number of denials per blocking statement, with the actions
+    and accounts that hit it most, and the denials nothing explained.
+    """
+    statements = {}
+    unattributed = Counter()
+    errors = Counter()
+    denials = 0
+    for query, findings, error in attributions:
+        denials += 1
+        if error:
+            errors[error] += 1
+            continue
+        if not findings:
+            unattributed[(query["target"], query["action"])] += 1
+            continue
+        for finding in findings:
+            name = finding.describe()
+            entry = statements.get(name)
+            if entry is None:
+                entry = statements[name] = {
+                    "statement": name,
+                    **finding.to_dict(),
+                    "count": 0,
+                    "actions": Counter(),
+                    "accounts": Counter(),
+                }
+            entry["count"] += 1
+            entry["actions"][query["action"]] += 1
+            entry["accounts"][query["target"]] += 1
+    return {
+        "denials": denials,
+        "statements": [
+            {
+                **entry,
+                "actions": dict(entry["actions"].most_common(TOP_COUNT)),
+                "accounts": dict(entry["accounts"].most_common(TOP_COUNT)),
+            }
+            for entry in sorted(statements.values(), key=lambda entry: -entry["count"])
+        ],
+        "unattributed": [
+            {"account": account, "action": action, "count": count}
+            for (account, action), count in unattributed.most_common()
+        ],
+        "errors": dict(errors.most_common()),
+    }
+
+
+def attribute_access_denied(
+    # A CloudTrail log file, a directory of them or an s3://bucket/prefix URL
+    source,
+    # [Optional] An organization snapshot (see org_snapshot.py)
+    # (Defaults to the Organizations API)
+    snapshot=None,
+    # [Optional] The endpoint of an S3-compatible store for s3:// sources
+    endpoint_url=None,
+    # [Optional] Whether the events have no condition keys other than the ones read
+    # (Conditions on unknown keys are otherwise assumed to possibly apply)
+    complete_context=False,
+    # [Optional] How many verdicts are cached
+    max_cache_entries=DEFAULT_MAX_CACHE_ENTRIES,
+    # [Optional] Write the counts as JSON to this file
+    output=None,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    attribute_access_denied(source="s3://my-cloudtrail-bucket/AWSLogs/o-abc123/", snapshot="org.snapshot.json.gz")
+    """
+    organization = load_snapshot(snapshot) if snapshot else Organization()
+    cache = VerdictCache(organization, complete_context, max_cache_entries)
+    counts = aggregate(attribute_events(read_log_events(source, endpoint_url), cache))
+    for entry in counts["statements"]:
+        logging.warning(
+            f"{entry['count']:>8}  {entry['statement']}: {', '.join(entry['actions'])}"
+        )
+    unattributed = sum(entry["count"] for entry in counts["unattributed"])
+    logging.warning(
+        f"{counts['denials']} SCP denials, {unattributed} not explained by the current SCPs, "
+        f"{sum(counts['errors'].values())} errors. Verdict cache: {cache.hits} hits, {cache.misses} misses."
+    )
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(counts, output_file, indent=2)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="SCP attribution of CloudTrail AccessDenied errors"
+    )
+    parser.set_defaults(method=attribute_access_denied)
+    parser.add_argument(
+        "--source",
+        type=str,
+        required=True,
+        help="A CloudTrail log file, a directory of them or an s3://bucket/prefix URL.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        required=False,
+        help="An organization snapshot (see org_snapshot.py). Defaults to the Organizations API.",
+    )
+    parser.add_argument(
+        "--endpoint_url",
+        type=str,
+        required=False,
+        help="The endpoint of an S3-compatible store for s3:// sources.",
+    )
+    parser.add_argument(
+        "--complete_context",
+        action="store_true",
+        help="The events have no condition keys other than the ones read from them.",
+    )
+    parser.add_argument(
+        "--max_cache_entries",
+        type=int,
+        default=DEFAULT_MAX_CACHE_ENTRIES,
+        help=f"How many verdicts are cached (default {DEFAULT_MAX_CACHE_ENTRIES}).",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Write the counts as JSON to this file.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
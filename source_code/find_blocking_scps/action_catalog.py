@@ -0,0 +1,337 @@
+import argparse
+import bisect
+import datetime
+import functools
+import gzip
+import json
+import logging
+import os
+import re
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from patterns import compile_pattern
+
+"""
+A versioned catalog of the IAM actions of every AWS service, so that action
+patterns like "ec2:*Vpc*" can be expanded into the concrete actions they
+cover, offline.
+
+The catalog is a gzipped JSON document next to this file:
+{
+    "format_version": 1,
+    "version": "<date it was built>",
+    "source": "<where the actions came from>",
+    "services": {"<service prefix>": ["<ActionName>", ...], ...}
+}
+
+It is built from the AWS Service Authorization Reference (or the policy
+generator's policies.js, or policy_sentry's iam-definition.json) with --build,
+and committed, so that lookups never need network access. In memory, the actions are one sorted array of
+lowercase "service:action" names: a pattern is only matched against the range
+of the array that starts with its literal prefix, found by binary search.
+"""
+
+CATALOG_FORMAT_VERSION = 1
+
+DEFAULT_CATALOG = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "action_catalog.json.gz"
+)
+
+# The machine-readable Service Authorization Reference
+SERVICE_REFERENCE_URL = "https://servicereference.us-east-1.amazonaws.com/"
+
+# Concurrent downloads of service reference documents
+DEFAULT_MAX_WORKERS = 8
+
+# Sorts after every character of an action name
+_PREFIX_END = "\uffff"
+
+
+def is_action_pattern(action):
+    return "*" in action or "?" in action
+
+
+class ActionCatalog:
+    """
+    The actions of a catalog document, in a sorted array with prefix and
+    IAM wildcard lookups. Lookups are case-insensitive and return the
+    actions as the catalog spells them.
+    """
+
+    def __init__(self, services, version="", source=""):
+        self.version = version
+        self.source = source
+        self._names = {}
+        for service, actions in services.items():
+            for action in actions:
+                name = f"{service}:{action}"
+                self._names[name.lower()] = name
+        self._sorted = sorted(self._names)
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def __contains__(self, action):
+        return action.lower() in self._names
+
+    def services(self):
+        return sorted({name.partition(":")[0] for name in self._sorted})
+
+    def with_prefix(self, prefix):
+        """
+        Returns every action that starts with prefix, in lexical order.
+        """
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self._sorted, prefix)
+        end = bisect.bisect_left(self._sorted, prefix + _PREFIX_END, start)
+        return [self._names[name] for name in self._sorted[start:end]]
+
+    def expand(self, pattern):
+        """
+        Returns every action that an IAM action pattern (with * and ?) covers,
+        in lexical order. A name without wildcards is returned as the catalog
+        spells it, if the catalog has it.
+        """
+        prefix = re.split(r"[*?]", pattern, maxsplit=1)[0]
+        if prefix == pattern:
+            name = self._names.get(pattern.lower())
+            return [name] if name else []
+        matcher = compile_pattern(pattern, ignore_case=True)
+        return [action for action in self.with_prefix(prefix) if matcher.match(action)]
+
+    def expand_all(self, patterns, negated=False):
+        """
+        Returns the set of actions that a list of Action patterns covers, or
+        that a list of NotAction patterns doesn't.
+        """
+        covered = set()
+        for pattern in patterns:
+            covered.update(self.expand(pattern))
+        if negated:
+            return set(self._names.values()) - covered
+        return covered
+
+
+def read_catalog(path=DEFAULT_CATALOG):
+    """
+    Returns the ActionCatalog of a catalog file.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"No action catalog at {path}, build one with action_catalog.py --build"
+        )
+    with gzip.open(path, "rt", encoding="utf-8") as catalog_file:
+        catalog = json.load(catalog_file)
+    if catalog.get("format_version") != CATALOG_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported action catalog format version {catalog.get('format_version')}"
+        )
+    return ActionCatalog(catalog["services"], catalog["version"], catalog["source"])
+
+
+@functools.lru_cache(maxsize=None)
+def load_catalog(path=DEFAULT_CATALOG):
+    """
+    Returns the ActionCatalog of a catalog file, read once per process.
+    """
+    return read_catalog(path)
+
+
+def _read(source):
+    if re.match(r"https?://", source):
+        with urllib.request.urlopen(source, timeout=60) as response:
+            return response.read().decode("utf-8")
+    with open(source, encoding="utf-8") as source_file:
+        return source_file.read()
+
+
+def parse_policy_generator(text):
+    """
+    Returns the actions by service prefix of the policy generator's
+    policies.js (app.PolicyEditorConfig = {...}).
+    """
+    config = json.loads(text[text.index("{") :])
+    services = {}
+    for service in config["serviceMap"].values():
+        services.setdefault(service["StringPrefix"], set()).update(service["Actions"])
+    return services
+
+
+def parse_iam_definition(text):
+    """
+    Returns the actions by service prefix of an iam-definition.json of
+    policy_sentry, which is scraped from the Service Authorization Reference.
+    """
+    services = {}
+    for service in json.loads(text).values():
+        if isinstance(service, dict) and "privileges" in service:
+            services.setdefault(service["prefix"], set()).update(service["privileges"])
+    return services
+
+
+def fetch_service_reference(
+    base_url=SERVICE_REFERENCE_URL, max_workers=DEFAULT_MAX_WORKERS
+):
+    """
+    Returns the actions by service prefix of the Service Authorization
+    Reference, one document per service.
+    """
+    service_list = json.loads(_read(base_url.rstrip("/") + "/v1/service-list.json"))
+
+    def fetch(entry):
+        document = json.loads(_read(entry["url"]))
+        return entry["service"], [action["Name"] for action in document["Actions"]]
+
+    services = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for service, actions in executor.map(fetch, service_list):
+            services.setdefault(service, set()).update(actions)
+    return services
+
+
+def build_catalog(source=SERVICE_REFERENCE_URL, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Returns a catalog document from the Service Authorization Reference (a
+    base URL), or from a policies.js or iam-definition.json file or URL.
+    """
+    if source.endswith(".js"):
+        services = parse_policy_generator(_read(source))
+    elif source.endswith(".json"):
+        services = parse_iam_definition(_read(source))
+    else:
+        services = fetch_service_reference(source, max_workers)
+    return {
+        "format_version": CATALOG_FORMAT_VERSION,
+        "version": datetime.date.today().isoformat(),
+        "source": source,
+        "services": {
+            service: sorted(actions) for service, actions in sorted(services.items())
+        },
+    }
+
+
+def write_catalog(catalog, path=DEFAULT_CATALOG):
+    with gzip.open(path, "wt", encoding="utf-8") as catalog_file:
+        json.dump(catalog, catalog_file, separators=(",", ":"), sort_keys=True)
+
+
+def statement_actions(statement, catalog):
+    """
+    Returns the concrete actions a CompiledStatement of the block finder
+    applies to.
+    """
+    return catalog.expand_all(statement.action_patterns, statement.action_negated)
+
+
+def expand_actions(
+    # [Optional] Action patterns to expand, e.g. ec2:*Vpc*
+    patterns=None,
+    # [Optional] A policy file to list the denied actions of, statement by statement
+    policy=None,
+    # [Optional] The catalog file (Defaults to action_catalog.json.gz next to this script)
+    catalog=DEFAULT_CATALOG,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    expand_actions(patterns=["ec2:*Vpc*", "s3:Get*Policy"])
+    expand_actions(policy="Security_Baseline_Root.json")
+    """
+    action_catalog = load_catalog(catalog)
+    expanded = {}
+    for pattern in patterns or []:
+        expanded[pattern] = action_catalog.expand(pattern)
+        logging.warning(f"{pattern}: {len(expanded[pattern])} actions")
+        for action in expanded[pattern]:
+            print(action)
+    if policy:
+        # The statement compiler of the block finder, which needs boto3
+        from scp_block_finder import CompiledStatement, _as_list_of_statements
+
+        with open(policy) as policy_file:
+            document = json.load(policy_file)
+        for number, statement in enumerate(
+            _as_list_of_statements(document["Statement"])
+        ):
+            if statement.get("Effect") != "Deny":
+                continue
+            compiled = CompiledStatement(os.path.basename(policy), "", statement)
+            actions = sorted(statement_actions(compiled, action_catalog))
+            name = compiled.sid or f"statement {number}"
+            expanded[name] = actions
+            condition = " (conditional)" if compiled.condition else ""
+            logging.warning(f"{name} denies {len(actions)} actions{condition}")
+            for action in actions:
+                print(f"{name}\t{action}")
+    logging.warning(
+        f"Action catalog {action_catalog.version}: {len(action_catalog)} actions "
+        f"of {len(action_catalog.services())} services."
+    )
+    return expanded
+
+
+def update_catalog(
+    # [Optional] The Service Authorization Reference base URL, or a policies.js or iam-definition.json file or URL
+    build=SERVICE_REFERENCE_URL,
+    # [Optional] The catalog file to write (Defaults to action_catalog.json.gz next to this script)
+    catalog=DEFAULT_CATALOG,
+    # [Optional] How many service documents are downloaded concurrently
+    max_workers=DEFAULT_MAX_WORKERS,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    update_catalog()
+    update_catalog(build="policies.js")
+    """
+    document = build_catalog(build, max_workers)
+    write_catalog(document, catalog)
+    action_catalog = read_catalog(catalog)
+    logging.warning(
+        f"Wrote {len(action_catalog)} actions of {len(action_catalog.services())} "
+        f"services to {catalog}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IAM action catalog")
+    parser.set_defaults(method=expand_actions)
+    parser.add_argument(
+        "patterns",
+        type=str,
+        nargs="*",
+        help="Action patterns to expand, e.g. ec2:*Vpc*.",
+    )
+    parser.add_argument(
+        "--policy",
+        type=str,
+        required=False,
+        help="A policy file to list the denied actions of, statement by statement.",
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        default=DEFAULT_CATALOG,
+        help="The catalog file. Defaults to action_catalog.json.gz next to this script.",
+    )
+    parser.add_argument(
+        "--build",
+        type=str,
+        nargs="?",
+        const=SERVICE_REFERENCE_URL,
+        required=False,
+        help=f"Build the catalog from the Service Authorization Reference (default {SERVICE_REFERENCE_URL}), or from a policies.js or iam-definition.json file or URL.",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help=f"How many service documents are downloaded concurrently (default {DEFAULT_MAX_WORKERS}).",
+    )
+    args = parser.parse_args()
+    if args.build:
+        args.method = update_catalog
+    args.method(**vars(args))
@@ -0,0 +1,129 @@
+import json
+import sqlite3
+import threading
+import time
+
+"""
+On-disk cache for Organizations API responses, shared between runs of
+scp_block_finder.py.
+
+A cached response is served until it is older than its time to live, so a
+change in the organization shows up at most one TTL later. SCP contents change
+more often than the OU tree and decide the answer, so describe_policy
+responses have their own, shorter TTL.
+"""
+
+# Default time to live of a cached response, in seconds
+DEFAULT_TTL = 3600
+# Default time to live of a cached policy (describe_policy), in seconds
+DEFAULT_POLICY_TTL = 60
+POLICY_OPERATION = "describe_policy"
+# Default maximum number of cached responses, the least recently used are evicted
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class ApiCache:
+    """
+    SQLite-backed cache of API responses, keyed by operation and parameters.
+
+    Entries expire after ttl seconds (policy_ttl seconds for describe_policy),
+    and the least recently used entries are evicted once there are more than
+    max_entries. A policy whose content changed is served from the cache until
+    its entry expires.
+    """
+
+    def __init__(
+        self,
+        path,
+        ttl=DEFAULT_TTL,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        policy_ttl=DEFAULT_POLICY_TTL,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.policy_ttl = policy_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY,"
+                " operation TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)"
+            )
+
+    @staticmethod
+    def make_key(operation, params):
+        return json.dumps([operation, params], sort_keys=True, separators=(",", ":"))
+
+    def ttl_of(self, operation):
+        return self.policy_ttl if operation == POLICY_OPERATION else self.ttl
+
+    def get_or_fetch(self, operation, params, fetch):
+        """
+        Returns the cached value of operation(params) if it is younger than the
+        operation's TTL, or calls fetch() and caches its (JSON-serializable)
+        result.
+        """
+        key = self.make_key(operation, params)
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, created FROM entries WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is not None and now - row[1] < self.ttl_of(operation):
+                self.hits += 1
+                with self._connection:
+                    self._connection.execute(
+                        "UPDATE entries SET last_used = ? WHERE key = ?", (now, key)
+                    )
+                return json.loads(row[0])
+            self.misses += 1
+
+        value = fetch()
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries"
+                " (key, operation, value, created, last_used)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, operation, json.dumps(value), now, now),
+            )
+            self._evict()
+        return value
+
+    def _evict(self):
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM entries WHERE key IN"
+                " (SELECT key FROM entries ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM entries")
+
+    def stats(self):
+        with self._lock:
+            (entries,) = self._connection.execute(
+                "SELECT COUNT(*) FROM entries"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+        }
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,467 @@
+import argparse
+import datetime
+import inspect
+import itertools
+import json
+import logging
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+from org_snapshot import take_snapshot
+from permission_matrix import compute_matrix
+from scp_block_finder import (
+    Organization,
+    OrganizationSnapshot,
+    check_conditions,
+    evaluate_batch,
+    find_blocking_scp,
+)
+
+"""
+Benchmarks the SCP evaluation against synthetic organizations, served by a
+local stub instead of the Organizations API.
+
+Measures queries per second, latency percentiles and peak (Python) memory for
+single queries, batches and the whole-organization matrix, and saves the
+results so that they can be compared between versions.
+"""
+
+SERVICES = ["ec2", "s3", "iam", "kms", "lambda", "logs", "rds", "sns", "sqs", "sts"]
+VERBS = ["Create", "Delete", "Describe", "Get", "List", "Put", "Update", "Modify"]
+NOUNS = ["Bucket", "Function", "Instance", "Key", "Policy", "Role", "Topic", "Vpc"]
+
+FULL_AWS_ACCESS = {
+    "Version": "2012-10-17",
+    "Statement": [{"Effect": "Allow", "Action": "*", "Resource": "*"}],
+}
+
+
+def _random_action(rng):
+    return f"{rng.choice(SERVICES)}:{rng.choice(VERBS)}{rng.choice(NOUNS)}"
+
+
+def _random_statement(rng, number):
+    statement = {
+        "Sid": f"Statement{number}",
+        "Effect": "Deny",
+        "Action": sorted({_random_action(rng) for _ in range(rng.randint(1, 20))}),
+        "Resource": "*",
+    }
+    if rng.random() < 0.2:
+        statement["Action"].append(f"{rng.choice(SERVICES)}:{rng.choice(VERBS)}*")
+    if rng.random() < 0.7:
+        statement["Condition"] = {
+            "ArnNotLike": {
+                "aws:PrincipalARN": [
+                    "arn:aws:iam::*:role/AWSControlTowerExecution",
+                    f"arn:aws:iam::*:role/Admin{rng.randint(0, 9)}*",
+                ]
+            }
+        }
+    return statement
+
+
+def build_synthetic_organization(
+    depth=3, width=3, accounts_per_ou=5, policies_per_level=4, statements=10, seed=0
+):
+    """
+    Returns the data of a synthetic organization: a root with `depth` levels of
+    `width` child OUs per OU, `accounts_per_ou` accounts in every OU, and
+    `policies_per_level` SCPs of `statements` Deny statements each attached to
+    the root and to every OU, next to FullAWSAccess.
+    """
+    rng = random.Random(seed)
+    parents = {}
+    attachments = {}
+    policies = {"p-FullAWSAccess": FULL_AWS_ACCESS}
+
+    def attach_policies(target_id):
+        attachments[target_id] = ["p-FullAWSAccess"]
+        for _ in range(policies_per_level):
+            policy_id = f"p-{len(policies):08d}"
+            policies[policy_id] = {
+                "Version": "2012-10-17",
+                "Statement": [
+                    _random_statement(rng, number) for number in range(statements)
+                ],
+            }
+            attachments[target_id].append(policy_id)
+
+    attach_policies("r-0000")
+    level = ["r-0000"]
+    for _ in range(depth):
+        next_level = []
+        for parent_id in level:
+            for _ in range(width):
+                ou_id = f"ou-0000-{len(parents):08d}"
+                parents[ou_id] = parent_id
+                attach_policies(ou_id)
+                for _ in range(accounts_per_ou):
+                    account_id = f"{len(parents):012d}"
+                    parents[account_id] = ou_id
+                    attachments[account_id] = ["p-FullAWSAccess"]
+                next_level.append(ou_id)
+        level = next_level
+    return {
+        "org_id": "o-benchmark",
+        "parents": parents,
+        "attachments": attachments,
+        "policies": policies,
+    }
+
+
+class StubOrganizationsClient:
+    """
+    Serves a synthetic organization through the subset of the boto3
+    Organizations client that the SCP tools use, with an optional simulated
+    round-trip latency per call.
+    """
+
+    def __init__(self, organization, latency=0.0):
+        self.organization = organization
+        self.latency = latency
+        self.calls = 0
+
+    def _call(self, result):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return result
+
+    def describe_organization(self):
+        return self._call({"Organization": {"Id": self.organization["org_id"]}})
+
+    def list_parents(self, ChildId):
+        return self._call({"Parents": [{"Id": self.organization["parents"][ChildId]}]})
+
+    def list_policies_for_target(self, TargetId, Filter):
+        policy_ids = self.organization["attachments"].get(TargetId, [])
+        return self._call({"Policies": [{"Id": policy_id} for policy_id in policy_ids]})
+
+    def describe_policy(self, PolicyId):
+        return self._call(
+            {
+                "Policy": {
+                    "PolicySummary": {
+                        "Id": PolicyId,
+                        "Name": PolicyId,
+                        "Arn": f"arn:aws:organizations::000000000000:policy/{PolicyId}",
+                    },
+                    "Content": json.dumps(self.organization["policies"][PolicyId]),
+                }
+            }
+        )
+
+    def list_roots(self):
+        return self._call({"Roots": [{"Id": "r-0000"}]})
+
+    def list_organizational_units_for_parent(self, ParentId):
+        children = self._children(ParentId)
+        return self._call(
+            {
+                "OrganizationalUnits": [
+                    {"Id": c} for c in children if c.startswith("ou-")
+                ]
+            }
+        )
+
+    def list_accounts_for_parent(self, ParentId):
+        children = self._children(ParentId)
+        return self._call(
+            {"Accounts": [{"Id": c} for c in children if not c.startswith("ou-")]}
+        )
+
+    def list_policies(self, Filter):
+        return self._call(
+            {"Policies": [{"Id": p} for p in self.organization["policies"]]}
+        )
+
+    def list_targets_for_policy(self, PolicyId):
+        targets = [
+            target_id
+            for target_id, policy_ids in self.organization["attachments"].items()
+            if PolicyId in policy_ids
+        ]
+        return self._call({"Targets": [{"TargetId": t} for t in targets]})
+
+    def _children(self, parent_id):
+        return [c for c, p in self.organization["parents"].items() if p == parent_id]
+
+    def get_paginator(self, operation):
+        # Every stub response fits on a single page
+        method = getattr(self, operation)
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                yield method(**kwargs)
+
+        return Paginator()
+
+
+def _percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, round(percent / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _measure(run, repetitions):
+    """
+    Calls run() `repetitions` times and returns the throughput, the latency
+    percentiles in milliseconds and the peak traced memory in bytes.
+    """
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repetitions):
+        call_started = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    # Memory is traced in a separate call, since tracing slows everything down
+    tracemalloc.start()
+    run()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "calls": repetitions,
+        "calls_per_second": repetitions / elapsed,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p90_ms": _percentile(latencies, 90) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def _random_queries(organization, count, rng):
+    account_ids = [c for c in organization["parents"] if not c.startswith("ou-")]
+    return [
+        {
+            "target": rng.choice(account_ids),
+            "action": _random_action(rng),
+            "resource": "*",
+            "region": "us-east-1",
+            "principal_arn": f"arn:aws:iam::000000000000:role/Role{rng.randint(0, 20)}",
+            "account": "",
+        }
+        for _ in range(count)
+    ]
+
+
+def run_benchmarks(
+    # Shape of the synthetic organization (see build_synthetic_organization)
+    depth=3,
+    width=3,
+    accounts_per_ou=5,
+    policies_per_level=4,
+    statements=10,
+    # Number of random queries per batch
+    queries=1000,
+    # Simulated round-trip latency of each Organizations API call, in seconds
+    latency=0.0,
+    # Worker processes of the whole-organization matrix
+    processes=None,
+    seed=0,
+):
+    """
+    Returns the measurements of every benchmark, by name.
+    """
+    rng = random.Random(seed)
+    organization = build_synthetic_organization(
+        depth, width, accounts_per_ou, policies_per_level, statements, seed
+    )
+    sample = _random_queries(organization, queries, rng)
+    results = {}
+
+    # One query against a fresh Organization, as one run of scp_block_finder.py
+    # makes it (compiled policies are still reused within this process)
+    single_queries = itertools.cycle(sample)
+
+    def single():
+        client = StubOrganizationsClient(organization, latency)
+        find_blocking_scp(
+            organization=Organization(org_client=client), **next(single_queries)
+        )
+
+    results["single"] = _measure(single, min(queries, 200))
+
+    # Every query against one Organization, as --batch evaluates them
+    def batch():
+        client = StubOrganizationsClient(organization, latency)
+        for _ in evaluate_batch(sample, Organization(org_client=client)):
+            pass
+
+    results["batch"] = _measure(batch, 3)
+    results["batch"]["queries_per_second"] = (
+        results["batch"]["calls_per_second"] * queries
+    )
+
+    # The condition evaluator on its own
+    condition = {
+        "ArnNotLike": {
+            "aws:PrincipalARN": [
+                "arn:aws:iam::*:role/AWSControlTowerExecution",
+                "arn:aws:iam::*:role/Admin*",
+            ]
+        },
+        "StringNotEquals": {"aws:RequestedRegion": ["us-east-1", "eu-west-1"]},
+    }
+    results["check_conditions"] = _measure(
+        lambda: check_conditions(
+            condition,
+            "us-west-2",
+            "arn:aws:iam::000000000000:role/Role1",
+            "",
+            "o-benchmark",
+        ),
+        10000,
+    )
+
+    # Every account and every action of the sample, as permission_matrix.py
+    snapshot = take_snapshot(StubOrganizationsClient(organization))
+    actions = sorted({query["action"] for query in sample})
+    results["whole_org"] = _measure(
+        lambda: compute_matrix(
+            OrganizationSnapshot(snapshot), actions, processes=processes
+        ),
+        1,
+    )
+    accounts = sum(1 for c in organization["parents"] if not c.startswith("ou-"))
+    results["whole_org"]["cells_per_second"] = (
+        results["whole_org"]["calls_per_second"] * accounts * len(actions)
+    )
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+# Metrics compared against a baseline, and whether higher values are better
+COMPARED_METRICS = {
+    "calls_per_second": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "peak_memory_bytes": False,
+}
+
+
+def find_regressions(baseline, current, max_regression):
+    """
+    Returns a description of every metric of current that is more than
+    max_regression (e.g. 0.2 for 20%) worse than in baseline.
+    """
+    regressions = []
+    for name, measurements in current["results"].items():
+        baseline_measurements = baseline["results"].get(name, {})
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before = baseline_measurements.get(metric)
+            after = measurements.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (-change if higher_is_better else change) > max_regression:
+                regressions.append(
+                    f"{name} {metric}: {before:.6g} -> {after:.6g} ({change:+.0%})"
+                )
+    return regressions
+
+
+def benchmark(
+    # [Optional] The JSON file to save the results to
+    output=None,
+    # [Optional] A JSON file of earlier results to compare with
+    baseline=None,
+    # [Optional] How much worse (0.2 = 20%) a metric may get before it is a regression
+    max_regression=0.2,
+    # keyworded variable length of arguments, passed to run_benchmarks
+    **kwargs,
+):
+    """
+    Example Usage:
+    benchmark(output="benchmark.json", baseline="benchmark-main.json")
+    """
+    parameters = {
+        name: kwargs[name]
+        for name in inspect.signature(run_benchmarks).parameters
+        if kwargs.get(name) is not None
+    }
+    # The evaluation logs every policy and finding, which would dominate
+    logging.disable(logging.WARNING)
+    try:
+        results = run_benchmarks(**parameters)
+    finally:
+        logging.disable(logging.NOTSET)
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "parameters": parameters,
+        "results": results,
+    }
+    print(json.dumps(report, indent=4))
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=4)
+    if baseline:
+        with open(baseline) as baseline_file:
+            regressions = find_regressions(
+                json.load(baseline_file), report, max_regression
+            )
+        for regression in regressions:
+            logging.error(f"Performance regression: {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP evaluation benchmark")
+    parser.set_defaults(method=benchmark)
+    for name, help_text in [
+        ("depth", "Levels of OUs below the root (default 3)."),
+        ("width", "Child OUs of every OU (default 3)."),
+        ("accounts_per_ou", "Accounts in every OU (default 5)."),
+        ("policies_per_level", "SCPs attached to the root and every OU (default 4)."),
+        ("statements", "Deny statements in every SCP (default 10)."),
+        ("queries", "Random queries per batch (default 1000)."),
+        ("processes", "Worker processes of the whole-organization matrix."),
+        ("seed", "Seed of the synthetic organization and queries (default 0)."),
+    ]:
+        parser.add_argument(f"--{name}", type=int, required=False, help=help_text)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        required=False,
+        help="Simulated latency of each Organizations API call, in seconds (default 0).",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="The JSON file to save the results to.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        required=False,
+        help="A JSON file of earlier results. Exits with an error if a metric got worse by more than --max_regression.",
+    )
+    parser.add_argument(
+        "--max_regression",
+        type=float,
+        default=0.2,
+        help="How much worse a metric may get before it is a regression (default 0.2, i.e. 20%%).",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
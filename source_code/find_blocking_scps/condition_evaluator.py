@@ -0,0 +1,283 @@
+import datetime
+import ipaddress
+import json
+from operator import eq, ge, gt, le, lt
+
+from patterns import compile_pattern
+
+"""
+Evaluates IAM policy Condition blocks against a request context.
+
+A Condition block is compiled once into a tree of predicates (one per
+operator and condition key), so that evaluating it for a request is a plain
+function call instead of a walk over the policy JSON.
+"""
+
+
+class RequestContext(dict):
+    """
+    The condition keys of a request, with lowercase key names mapped to a list
+    of string values.
+
+    If the context is not complete, keys that are missing from it are unknown
+    and every condition on them is assumed to possibly apply. If it is complete,
+    missing keys are treated the way IAM treats keys that are absent from a
+    request.
+    """
+
+    def __init__(self, values=None, complete=False):
+        super().__init__()
+        self.complete = complete
+        for key, value in (values or {}).items():
+            self.set(key, value)
+
+    def set(self, key, value):
+        if value is None or value == "":
+            return
+        self[key.lower()] = [_to_string(v) for v in _as_list(value)]
+
+
+def _as_list(value):
+    # Standardize into a list if there's only one value
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+def _to_string(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def _parse_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _parse_date(value):
+    # Dates are either ISO 8601 or seconds since the epoch
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return _parse_number(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def _parse_network(value):
+    try:
+        return ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        return None
+
+
+def _arn_matcher(pattern):
+    # ARNs are compared segment by segment, so "*" never spans the
+    # partition, service, region or account segments
+    segments = pattern.split(":", 5)
+    if len(segments) != 6:
+        matcher = compile_pattern(pattern)
+        return lambda value: matcher.match(value) is not None
+    matchers = [compile_pattern(segment) for segment in segments]
+
+    def match(value):
+        value_segments = value.split(":", 5)
+        return len(value_segments) == 6 and all(
+            m.match(v) for m, v in zip(matchers, value_segments)
+        )
+
+    return match
+
+
+def _string_equals(expected):
+    expected = set(expected)
+    return lambda value: value in expected
+
+
+def _string_equals_ignore_case(expected):
+    expected = {e.lower() for e in expected}
+    return lambda value: value.lower() in expected
+
+
+def _string_like(expected):
+    matchers = [compile_pattern(e) for e in expected]
+    return lambda value: any(m.match(value) for m in matchers)
+
+
+def _arn_like(expected):
+    matchers = [_arn_matcher(e) for e in expected]
+    return lambda value: any(m(value) for m in matchers)
+
+
+def _comparison(parse, compare):
+    def build(expected):
+        parsed = [p for p in (parse(e) for e in expected) if p is not None]
+
+        def match(value):
+            parsed_value = parse(value)
+            return parsed_value is not None and any(
+                compare(parsed_value, p) for p in parsed
+            )
+
+        return match
+
+    return build
+
+
+def _bool(expected):
+    expected = {e.lower() for e in expected}
+    return lambda value: value.lower() in expected
+
+
+def _ip_address(expected):
+    networks = [n for n in (_parse_network(e) for e in expected) if n is not None]
+
+    def match(value):
+        try:
+            address = ipaddress.ip_address(value.split("/")[0])
+        except ValueError:
+            return False
+        return any(address in network for network in networks)
+
+    return match
+
+
+# Condition operators (without IfExists and set qualifiers), mapped to the
+# builder of their per-value matcher and whether the operator is negated
+OPERATORS = {
+    "StringEquals": (_string_equals, False),
+    "StringNotEquals": (_string_equals, True),
+    "StringEqualsIgnoreCase": (_string_equals_ignore_case, False),
+    "StringNotEqualsIgnoreCase": (_string_equals_ignore_case, True),
+    "StringLike": (_string_like, False),
+    "StringNotLike": (_string_like, True),
+    "ArnEquals": (_arn_like, False),
+    "ArnNotEquals": (_arn_like, True),
+    "ArnLike": (_arn_like, False),
+    "ArnNotLike": (_arn_like, True),
+    "NumericEquals": (_comparison(_parse_number, eq), False),
+    "NumericNotEquals": (_comparison(_parse_number, eq), True),
+    "NumericLessThan": (_comparison(_parse_number, lt), False),
+    "NumericLessThanEquals": (_comparison(_parse_number, le), False),
+    "NumericGreaterThan": (_comparison(_parse_number, gt), False),
+    "NumericGreaterThanEquals": (_comparison(_parse_number, ge), False),
+    "DateEquals": (_comparison(_parse_date, eq), False),
+    "DateNotEquals": (_comparison(_parse_date, eq), True),
+    "DateLessThan": (_comparison(_parse_date, lt), False),
+    "DateLessThanEquals": (_comparison(_parse_date, le), False),
+    "DateGreaterThan": (_comparison(_parse_date, gt), False),
+    "DateGreaterThanEquals": (_comparison(_parse_date, ge), False),
+    "Bool": (_bool, False),
+    "BinaryEquals": (_string_equals, False),
+    "IpAddress": (_ip_address, False),
+    "NotIpAddress": (_ip_address, True),
+}
+
+SET_QUALIFIERS = ("ForAnyValue:", "ForAllValues:")
+
+
+def parse_operator(operator):
+    """
+    Splits a condition operator into its set qualifier ("ForAnyValue",
+    "ForAllValues" or None), base operator and whether it ends in IfExists.
+    Raises ValueError for unknown operators.
+    """
+    qualifier = None
+    for prefix in SET_QUALIFIERS:
+        if operator.startswith(prefix):
+            qualifier = prefix[:-1]
+            operator = operator[len(prefix) :]
+    if_exists = operator.endswith("IfExists") and operator != "IfExists"
+    if if_exists:
+        operator = operator[: -len("IfExists")]
+    if operator not in OPERATORS and operator != "Null":
+        raise ValueError(f"Unknown condition operator {operator}")
+    return qualifier, operator, if_exists
+
+
+def _compile_null(key, expected):
+    # Null checks whether the key is absent ("true") or present ("false")
+    expect_absent = {e.lower() for e in expected}
+
+    def predicate(context):
+        if key not in context:
+            return "true" in expect_absent or not context.complete
+        return "false" in expect_absent
+
+    return predicate
+
+
+def _compile_leaf(operator, key, expected):
+    qualifier, base_operator, if_exists = parse_operator(operator)
+    key = key.lower()
+    expected = [_to_string(e) for e in _as_list(expected)]
+    if base_operator == "Null":
+        return _compile_null(key, expected)
+    build, negated = OPERATORS[base_operator]
+    matches = build(expected)
+
+    def value_passes(value):
+        return matches(value) != negated
+
+    # What the condition evaluates to when the key is absent from a complete context
+    if if_exists or qualifier == "ForAllValues":
+        when_missing = True
+    elif qualifier == "ForAnyValue":
+        when_missing = False
+    else:
+        when_missing = negated
+
+    def predicate(context):
+        values = context.get(key)
+        if values is None:
+            return when_missing or not context.complete
+        if qualifier == "ForAllValues":
+            return all(value_passes(value) for value in values)
+        if qualifier == "ForAnyValue" or not negated:
+            return any(value_passes(value) for value in values)
+        return all(value_passes(value) for value in values)
+
+    return predicate
+
+
+class CompiledCondition:
+    """
+    A Condition block compiled into one predicate per operator and key. The
+    block applies if all of its predicates do.
+    """
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.predicates = [
+            _compile_leaf(operator, key, expected)
+            for operator, keys in condition.items()
+            for key, expected in keys.items()
+        ]
+
+    def __call__(self, context):
+        for predicate in self.predicates:
+            if not predicate(context):
+                return False
+        return True
+
+
+# Compiled Condition blocks, keyed by their canonical JSON
+_compiled_conditions = {}
+
+
+def compile_condition(condition):
+    """
+    Returns the CompiledCondition for a Condition block. Identical blocks
+    (e.g. the same principal exception list in many statements) are only
+    compiled once.
+    """
+    key = json.dumps(condition, sort_keys=True)
+    compiled = _compiled_conditions.get(key)
+    if compiled is None:
+        compiled = CompiledCondition(condition)
+        _compiled_conditions[key] = compiled
+    return compiled
@@ -0,0 +1,290 @@
+import argparse
+import gzip
+import json
+import logging
+
+from org_snapshot import write_snapshot
+from scp_block_finder import OrganizationSnapshot, load_snapshot
+
+"""
+Keeps an organization snapshot current by replaying Organizations CloudTrail
+events (account moves, OU changes, SCP attachments and SCP updates) instead of
+walking the whole organization again.
+"""
+
+
+class OrganizationGraph(OrganizationSnapshot):
+    """
+    OrganizationSnapshot that also indexes the children of every root and OU,
+    and that can be updated in place with apply_event.
+
+    Parent lookups read the parent pointers directly, so finding the OU path
+    of an account takes one dict lookup per level. Applying an event only
+    drops the cached policy indexes of the subtree it affects.
+
+    Snapshots updated this way carry the position of the last replayed event:
+    "events": {"last_time": "<eventTime>", "last_ids": ["<eventID>", ...]}
+    """
+
+    def __init__(self, snapshot):
+        super().__init__(snapshot)
+        self.children = {}
+        for child_id, parent_id in snapshot["parents"].items():
+            self.children.setdefault(parent_id, set()).add(child_id)
+        self.snapshot.setdefault("events", {"last_time": "", "last_ids": []})
+        self._handlers = {
+            "MoveAccount": self._move_account,
+            "CreateAccountResult": self._create_account_result,
+            "RemoveAccountFromOrganization": self._remove_account,
+            "LeaveOrganization": self._leave_organization,
+            "CreateOrganizationalUnit": self._create_organizational_unit,
+            "DeleteOrganizationalUnit": self._delete_organizational_unit,
+            "AttachPolicy": self._attach_policy,
+            "DetachPolicy": self._detach_policy,
+            "CreatePolicy": self._create_policy,
+            "UpdatePolicy": self._update_policy,
+            "DeletePolicy": self._delete_policy,
+        }
+
+    def get_parent(self, child_id):
+        # Always current, so there is nothing to invalidate when it moves
+        return self._fetch_parent(child_id)
+
+    def get_policy_ids(self, target_id):
+        return self._fetch_policy_ids(target_id)
+
+    def get_children(self, parent_id):
+        return sorted(self.children.get(parent_id, ()))
+
+    def get_subtree(self, target_id):
+        """
+        Returns the target and all of its descendants.
+        """
+        subtree = []
+        pending = [target_id]
+        while pending:
+            current = pending.pop()
+            subtree.append(current)
+            pending.extend(self.children.get(current, ()))
+        return subtree
+
+    def _root_id(self):
+        for organizations_id in self.children:
+            if organizations_id.startswith("r-"):
+                return organizations_id
+        raise ValueError("The snapshot has no root")
+
+    def _invalidate(self, target_id):
+        for organizations_id in self.get_subtree(target_id):
+            self._indexes.pop(organizations_id, None)
+
+    def _set_parent(self, child_id, parent_id):
+        old_parent_id = self.snapshot["parents"].get(child_id)
+        if old_parent_id is not None:
+            self.children[old_parent_id].discard(child_id)
+        self.snapshot["parents"][child_id] = parent_id
+        self.children.setdefault(parent_id, set()).add(child_id)
+        self._invalidate(child_id)
+
+    def _remove(self, organizations_id):
+        self._invalidate(organizations_id)
+        parent_id = self.snapshot["parents"].pop(organizations_id, None)
+        if parent_id is not None:
+            self.children[parent_id].discard(organizations_id)
+        self.children.pop(organizations_id, None)
+        self.snapshot["attachments"].pop(organizations_id, None)
+
+    def _move_account(self, request, response, event):
+        self._set_parent(request["accountId"], request["destinationParentId"])
+
+    def _create_account_result(self, request, response, event):
+        status = event.get("serviceEventDetails", {}).get("createAccountStatus", {})
+        if status.get("state") == "SUCCEEDED":
+            # New accounts are created in the root
+            self._set_parent(status["accountId"], self._root_id())
+            self.snapshot["attachments"].setdefault(status["accountId"], [])
+
+    def _remove_account(self, request, response, event):
+        self._remove(request["accountId"])
+
+    def _leave_organization(self, request, response, event):
+        self._remove(event["recipientAccountId"])
+
+    def _create_organizational_unit(self, request, response, event):
+        self._set_parent(response["organizationalUnit"]["id"], request["parentId"])
+
+    def _delete_organizational_unit(self, request, response, event):
+        self._remove(request["organizationalUnitId"])
+
+    def _attach_policy(self, request, response, event):
+        # Only SCPs are part of the snapshot
+        if request["policyId"] in self.snapshot["policies"]:
+            policy_ids = self.snapshot["attachments"].setdefault(
+                request["targetId"], []
+            )
+            if request["policyId"] not in policy_ids:
+                policy_ids.append(request["policyId"])
+            self._invalidate(request["targetId"])
+
+    def _detach_policy(self, request, response, event):
+        policy_ids = self.snapshot["attachments"].get(request["targetId"], [])
+        if request["policyId"] in policy_ids:
+            policy_ids.remove(request["policyId"])
+            self._invalidate(request["targetId"])
+
+    def _policy_targets(self, policy_id):
+        return [
+            target_id
+            for target_id, policy_ids in self.snapshot["attachments"].items()
+            if policy_id in policy_ids
+        ]
+
+    def _create_policy(self, request, response, event):
+        if request.get("type") == "SERVICE_CONTROL_POLICY":
+            summary = response["policy"]["policySummary"]
+            self.snapshot["policies"][summary["id"]] = {
+                "name": summary["name"],
+                "arn": summary["arn"],
+                "content": response["policy"]["content"],
+            }
+
+    def _update_policy(self, request, response, event):
+        policy_id = request["policyId"]
+        if policy_id not in self.snapshot["policies"]:
+            return
+        policy = self.snapshot["policies"][policy_id]
+        updated = (response or {}).get("policy", {})
+        policy["name"] = updated.get("policySummary", {}).get(
+            "name", request.get("name", policy["name"])
+        )
+        policy["content"] = updated.get(
+            "content", request.get("content", policy["content"])
+        )
+        self._policies.pop(policy_id, None)
+        for target_id in self._policy_targets(policy_id):
+            self._invalidate(target_id)
+
+    def _delete_policy(self, request, response, event):
+        # A policy can only be deleted once it is detached everywhere
+        self.snapshot["policies"].pop(request["policyId"], None)
+        self._policies.pop(request["policyId"], None)
+
+    def apply_event(self, event):
+        """
+        Applies one Organizations CloudTrail event to the graph. Returns whether
+        it was applied.
+
+        Events that were already replayed, failed requests and unrelated events
+        are skipped.
+        """
+        handler = self._handlers.get(event.get("eventName"))
+        if (
+            handler is None
+            or event.get("eventSource") != "organizations.amazonaws.com"
+            or event.get("errorCode")
+        ):
+            return False
+        position = self.snapshot["events"]
+        event_time, event_id = event["eventTime"], event.get("eventID")
+        if event_time < position["last_time"] or (
+            event_time == position["last_time"] and event_id in position["last_ids"]
+        ):
+            return False
+        handler(
+            event.get("requestParameters") or {},
+            event.get("responseElements") or {},
+            event,
+        )
+        if event_time > position["last_time"]:
+            position["last_time"], position["last_ids"] = event_time, []
+        position["last_ids"].append(event_id)
+        return True
+
+
+def read_events(path):
+    """
+    Yields the CloudTrail events of a file, in the order they happened.
+
+    The file is either a CloudTrail log file ({"Records": [...]}, gzipped or
+    not) or has one event per line, as CloudTrail events or as the output of
+    lookup-events (with the event in "CloudTrailEvent").
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as events_file:
+        text = events_file.read()
+    try:
+        document = json.loads(text)
+    except json.JSONDecodeError:
+        events = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        if isinstance(document, dict) and "Records" in document:
+            events = document["Records"]
+        elif isinstance(document, dict) and "Events" in document:
+            events = document["Events"]
+        else:
+            events = document if isinstance(document, list) else [document]
+    events = [
+        json.loads(e["CloudTrailEvent"]) if "CloudTrailEvent" in e else e
+        for e in events
+    ]
+    return sorted(events, key=lambda event: event.get("eventTime", ""))
+
+
+def load_graph(path):
+    """
+    Returns an OrganizationGraph for the snapshot file at path.
+    """
+    return OrganizationGraph(load_snapshot(path).snapshot)
+
+
+def update_snapshot(
+    # The snapshot file written by org_snapshot.py, updated in place
+    snapshot,
+    # Files of Organizations CloudTrail events to replay
+    events,
+    # [Optional] Where to write the updated snapshot (Defaults to snapshot)
+    output=None,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    update_snapshot(snapshot="org.snapshot.json.gz", events=["organizations-events.json"])
+    """
+    graph = load_graph(snapshot)
+    applied = 0
+    for events_path in events:
+        for event in read_events(events_path):
+            applied += graph.apply_event(event)
+    write_snapshot(graph.snapshot, output or snapshot)
+    logging.warning(
+        f"Applied {applied} events, the snapshot is current as of "
+        f"{graph.snapshot['events']['last_time'] or graph.snapshot['created']}"
+    )
+    return graph
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP Block Finder snapshot updates")
+    parser.set_defaults(method=update_snapshot)
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        required=True,
+        help="The snapshot file written by org_snapshot.py, updated in place.",
+    )
+    parser.add_argument(
+        "--events",
+        type=str,
+        action="append",
+        required=True,
+        help="A file of Organizations CloudTrail events to replay. Can be repeated.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Where to write the updated snapshot. Defaults to --snapshot.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
@@ -0,0 +1,139 @@
+import argparse
+import boto3
+import datetime
+import gzip
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from scp_block_finder import (
+    DEFAULT_MAX_WORKERS,
+    ORGANIZATIONS_CLIENT_CONFIG,
+    SNAPSHOT_FORMAT_VERSION,
+    load_snapshot,
+)
+
+"""
+Writes an offline snapshot of the organization (OU tree, SCP attachments and
+SCP contents) that scp_block_finder.py can use with --snapshot.
+"""
+
+
+def _paginate(org_client, operation, result_key, **kwargs):
+    paginator = org_client.get_paginator(operation)
+    for page in paginator.paginate(**kwargs):
+        yield from page[result_key]
+
+
+def _describe_policy(org_client, policy_id):
+    policy_response = org_client.describe_policy(PolicyId=policy_id)
+    targets = [
+        target["TargetId"]
+        for target in _paginate(
+            org_client, "list_targets_for_policy", "Targets", PolicyId=policy_id
+        )
+    ]
+    return policy_response["Policy"], targets
+
+
+def take_snapshot(org_client=None, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Walks the whole organization and returns it as a snapshot document
+    (see scp_block_finder.OrganizationSnapshot for the format).
+    """
+    if org_client is None:
+        org_client = boto3.client("organizations", config=ORGANIZATIONS_CLIENT_CONFIG)
+    org_id = org_client.describe_organization()["Organization"]["Id"]
+
+    # Walk the OU tree from the root(s) down to the accounts
+    parents = {}
+    pending = [root["Id"] for root in _paginate(org_client, "list_roots", "Roots")]
+    while pending:
+        parent_id = pending.pop()
+        for ou in _paginate(
+            org_client,
+            "list_organizational_units_for_parent",
+            "OrganizationalUnits",
+            ParentId=parent_id,
+        ):
+            parents[ou["Id"]] = parent_id
+            pending.append(ou["Id"])
+        for account in _paginate(
+            org_client, "list_accounts_for_parent", "Accounts", ParentId=parent_id
+        ):
+            parents[account["Id"]] = parent_id
+    logging.info(f"Found {len(parents)} accounts and OUs.")
+
+    # Describe every SCP once and record where it is attached
+    policy_ids = [
+        policy["Id"]
+        for policy in _paginate(
+            org_client, "list_policies", "Policies", Filter="SERVICE_CONTROL_POLICY"
+        )
+    ]
+    attachments = {}
+    policies = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        described = executor.map(
+            lambda policy_id: _describe_policy(org_client, policy_id), policy_ids
+        )
+        for policy_id, (policy, targets) in zip(policy_ids, described):
+            policies[policy_id] = {
+                "name": policy["PolicySummary"]["Name"],
+                "arn": policy["PolicySummary"]["Arn"],
+                "content": policy["Content"],
+            }
+            for target_id in targets:
+                attachments.setdefault(target_id, []).append(policy_id)
+    logging.info(f"Found {len(policies)} SCPs.")
+
+    return {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "org_id": org_id,
+        "parents": parents,
+        "attachments": attachments,
+        "policies": policies,
+    }
+
+
+def write_snapshot(snapshot, path):
+    with gzip.open(path, "wt", encoding="utf-8") as snapshot_file:
+        json.dump(snapshot, snapshot_file, separators=(",", ":"), sort_keys=True)
+
+
+def create_snapshot(
+    # The path of the snapshot file to write, e.g. org.snapshot.json.gz
+    output,
+    # [Optional] How many Organizations API calls are made concurrently
+    max_workers=DEFAULT_MAX_WORKERS,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    create_snapshot(output="org.snapshot.json.gz")
+    """
+    write_snapshot(take_snapshot(max_workers=max_workers), output)
+    # Make sure that the written snapshot can be loaded again
+    load_snapshot(output)
+    logging.warning(f"Wrote organization snapshot to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP Block Finder snapshot")
+    parser.set_defaults(method=create_snapshot)
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="The path of the snapshot file to write, e.g. org.snapshot.json.gz.",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help=f"How many Organizations API calls are made concurrently (default {DEFAULT_MAX_WORKERS}).",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
@@ -0,0 +1,148 @@
+import functools
+import re
+
+"""
+IAM wildcard pattern matching shared by the SCP evaluation modules.
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def compile_pattern(pattern, ignore_case=False):
+    """
+    Compiles an IAM wildcard pattern into an anchored regular expression.
+
+    "*" matches any sequence of characters and "?" matches any single character.
+    Everything else is matched literally, so the pattern has to match the whole
+    value and not just a part of it. Compiled patterns are cached, so each
+    distinct pattern is only compiled once per process.
+    """
+    regex = "".join(
+        ".*" if char == "*" else "." if char == "?" else re.escape(char)
+        for char in pattern
+    )
+    flags = re.DOTALL | (re.IGNORECASE if ignore_case else 0)
+    return re.compile(rf"\A{regex}\Z", flags)
+
+
+# arn:partition:service:region:account:resource, where the resource may
+# contain colons itself
+ARN_SEGMENTS = 6
+
+
+def split_arn(value):
+    """
+    Returns the partition, service, region, account and resource segments of
+    an ARN (or ARN pattern), or None if the value isn't one.
+    """
+    segments = value.split(":", ARN_SEGMENTS - 1)
+    if len(segments) < ARN_SEGMENTS or segments[0] != "arn":
+        return None
+    return segments[1:]
+
+
+class _ArnNode:
+    # One segment of the trie: the children of literal segments by value, and
+    # those of wildcard segments by their literal prefix (the part before the
+    # first wildcard), so that only the wildcard segments whose prefix starts
+    # the looked up segment are matched
+    __slots__ = ("literal", "wildcard", "prefix_lengths", "values")
+
+    def __init__(self):
+        self.literal = {}
+        self.wildcard = {}
+        self.prefix_lengths = []
+        self.values = []
+
+    def child(self, segment):
+        prefix = re.split(r"[*?]", segment, maxsplit=1)[0]
+        if prefix == segment:
+            if segment not in self.literal:
+                self.literal[segment] = _ArnNode()
+            return self.literal[segment]
+        if prefix not in self.wildcard:
+            self.wildcard[prefix] = {}
+            self.prefix_lengths = sorted({*self.prefix_lengths, len(prefix)})
+        children = self.wildcard[prefix]
+        if segment not in children:
+            children[segment] = (compile_pattern(segment), _ArnNode())
+        return children[segment][1]
+
+    def children_matching(self, segment):
+        child = self.literal.get(segment)
+        if child is not None:
+            yield child
+        for length in self.prefix_lengths:
+            if length > len(segment):
+                break
+            for matcher, child in self.wildcard.get(segment[:length], {}).values():
+                if matcher.match(segment):
+                    yield child
+
+
+class ResourceTrie:
+    """
+    Resource patterns indexed segment by segment, the way IAM matches ARNs:
+    the partition, service, region, account and resource of a pattern are
+    each matched against the same segment of the ARN, so a wildcard never
+    spans two segments, and the pattern has to match the whole segment
+    ("arn:aws:s3:::bucket" doesn't match "arn:aws:s3:::bucket-other").
+
+    A lookup follows the literal segments with dict lookups and, at the nodes
+    it reaches, only tries the wildcard segments whose literal prefix starts
+    the segment, so it doesn't scan every pattern. "*" matches any resource;
+    patterns that aren't ARNs are matched as plain IAM wildcard patterns.
+    """
+
+    def __init__(self, patterns=()):
+        self._root = _ArnNode()
+        self._any = []
+        self._other = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern, value=None):
+        """
+        Adds a pattern, with the value that match() returns for it (defaults
+        to the pattern itself).
+        """
+        value = pattern if value is None else value
+        if pattern == "*":
+            self._any.append(value)
+            return
+        segments = split_arn(pattern)
+        if segments is None:
+            self._other.append((compile_pattern(pattern), value))
+            return
+        node = self._root
+        for segment in segments:
+            node = node.child(segment)
+        node.values.append(value)
+
+    def match(self, resource):
+        """
+        Returns the values of every pattern that matches the resource.
+        """
+        matched = list(self._any)
+        matched.extend(
+            value for matcher, value in self._other if matcher.match(resource)
+        )
+        segments = split_arn(resource)
+        if segments is not None:
+            nodes = [self._root]
+            for segment in segments:
+                nodes = [
+                    child for node in nodes for child in node.children_matching(segment)
+                ]
+                if not nodes:
+                    break
+            for node in nodes:
+                matched.extend(node.values)
+        return matched
+
+    def matches(self, resource):
+        """
+        Returns whether any pattern matches the resource.
+        """
+        if self._any:
+            return True
+        return bool(self.match(resource))
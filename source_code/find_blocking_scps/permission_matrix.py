@@ -0,0 +1,379 @@
+import argparse
+import csv
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from action_catalog import is_action_pattern, load_catalog
+from org_snapshot import take_snapshot
+from scp_block_finder import (
+    OrganizationSnapshot,
+    PolicyIndex,
+    build_request_context,
+    compile_policy,
+    evaluate_index,
+    load_snapshot,
+    parse_context,
+)
+
+"""
+Computes, for every account in the organization and a list of actions, whether
+the action is denied by an SCP and by which statement.
+
+Accounts whose OU paths carry the same SCPs share one evaluation, and the
+distinct OU paths are evaluated on a process pool.
+"""
+
+
+def read_actions(path):
+    """
+    Reads one action per line, ignoring blank lines and # comments.
+    """
+    with open(path) as actions_file:
+        lines = (line.split("#", 1)[0].strip() for line in actions_file)
+        return [line for line in lines if line]
+
+
+def actions_in_policies(organization, catalog=None):
+    """
+    Returns every action without wildcards that an SCP of the organization names
+    in an Action or NotAction element. With an ActionCatalog, the patterns of
+    the Action elements of Deny statements are expanded into the actions they
+    cover as well.
+    """
+    actions = set()
+    for policy_id in organization.snapshot["policies"]:
+        for statement in organization.get_policy(policy_id).statements:
+            actions.update(p for p in statement.action_patterns if "*" not in p)
+            if (
+                catalog is not None
+                and statement.effect == "Deny"
+                and not statement.action_negated
+            ):
+                actions.update(catalog.expand_all(statement.action_patterns))
+    return sorted(actions)
+
+
+def expand_action_list(actions, catalog):
+    """
+    Replaces the action patterns of a list with the actions they cover.
+    """
+    expanded = []
+    for action in actions:
+        expanded.extend(
+            catalog.expand(action) if is_action_pattern(action) else [action]
+        )
+    return list(dict.fromkeys(expanded))
+
+
+def _account_ids(organization):
+    return sorted(
+        child_id
+        for child_id in organization.snapshot["parents"]
+        if not child_id.startswith(("ou-", "r-"))
+    )
+
+
+def _uses_account_key(policies):
+    # Conditions on aws:PrincipalAccount have to be evaluated for each account
+    return any("aws:principalaccount" in content.lower() for *_, content in policies)
+
+
+# Marks a statement that only denies if condition keys that weren't given apply
+CONDITIONAL_PREFIX = "?"
+
+
+def evaluate_policy_set(
+    policies, actions, resource, request_context, complete_request_context=None
+):
+    """
+    Evaluates every action against one set of SCPs (the policies along one OU
+    path, as (level, id, name, ARN, content) tuples). Returns one list of
+    blocking "policy name/Sid" (or "implicit deny at <level>") strings per action.
+
+    With a complete_request_context (the same keys, with the missing ones
+    absent), a statement that only blocks because a missing key is assumed to
+    apply is marked with CONDITIONAL_PREFIX.
+
+    This runs in a worker process, so it only takes picklable arguments.
+    """
+    index = PolicyIndex()
+    for level, policy_id, policy_name, policy_arn, content in policies:
+        index.add_policy(
+            compile_policy(policy_id, policy_name, policy_arn, content), level
+        )
+    cells = []
+    for action in actions:
+        blocking = [
+            finding.describe()
+            for finding in evaluate_index(index, action, resource, request_context)
+        ]
+        if complete_request_context is not None:
+            certain = {
+                finding.describe()
+                for finding in evaluate_index(
+                    index, action, resource, complete_request_context
+                )
+            }
+            blocking = [
+                statement if statement in certain else CONDITIONAL_PREFIX + statement
+                for statement in blocking
+            ]
+        cells.append(blocking)
+    return cells
+
+
+def compute_matrix(
+    organization,
+    actions,
+    resource="*",
+    region="",
+    principal_arn="",
+    context=None,
+    complete_context=False,
+    processes=None,
+):
+    """
+    Returns {account ID: [blocking statements of each action]} for every
+    account of an OrganizationSnapshot. Unless complete_context is set,
+    statements that only block if condition keys that weren't given apply are
+    marked with CONDITIONAL_PREFIX.
+    """
+    # Group the accounts by their OU path and the SCPs along it. The account
+    # itself is the first level of the path, so accounts only share a group if
+    # they also have the same SCPs attached directly.
+    groups = {}
+    for account_id in _account_ids(organization):
+        ou_stack = organization.get_ou_stack(account_id)
+        signature = tuple(
+            tuple(organization.get_policy_ids(organizations_id))
+            for organizations_id in ou_stack
+        )
+        groups.setdefault((tuple(ou_stack[1:]), signature), []).append(account_id)
+    logging.warning(
+        f"Evaluating {len(actions)} actions for {sum(map(len, groups.values()))} "
+        f"accounts in {len(groups)} distinct OU paths..."
+    )
+
+    jobs = []
+    for (parent_stack, signature), account_ids in groups.items():
+        # The account level is labelled "account", since the group may
+        # stand for several accounts
+        levels = ("account",) + parent_stack
+        policies = []
+        for level, policy_ids in zip(levels, signature):
+            for policy_id in policy_ids:
+                policy = organization.snapshot["policies"][policy_id]
+                policies.append(
+                    (level, policy_id, policy["name"], policy["arn"], policy["content"])
+                )
+        if _uses_account_key(policies):
+            jobs.extend((policies, [account_id]) for account_id in account_ids)
+        else:
+            jobs.append((policies, account_ids))
+
+    def request_context_for(account_ids, complete):
+        account = account_ids[0] if len(account_ids) == 1 else ""
+        return build_request_context(
+            region,
+            principal_arn,
+            account,
+            organization.org_id,
+            context=context,
+            complete=complete,
+        )
+
+    def complete_request_context_for(account_ids):
+        # Tells the statements that only block if a missing key applies from
+        # those that block either way
+        if complete_context:
+            return None
+        return request_context_for(account_ids, True)
+
+    matrix = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            (
+                account_ids,
+                executor.submit(
+                    evaluate_policy_set,
+                    policies,
+                    actions,
+                    resource,
+                    request_context_for(account_ids, complete_context),
+                    complete_request_context_for(account_ids),
+                ),
+            )
+            for policies, account_ids in jobs
+        ]
+        for account_ids, future in futures:
+            row = future.result()
+            for account_id in account_ids:
+                matrix[account_id] = row
+    return dict(sorted(matrix.items()))
+
+
+def write_matrix(matrix, actions, output):
+    """
+    Writes the matrix as CSV, or as Parquet if output ends in .parquet (this
+    needs pyarrow). Each cell holds the blocking statements, separated by ";",
+    and is empty if the action is not denied. Statements prefixed with "?"
+    only block if condition keys that weren't given apply.
+    """
+    rows = [
+        [account_id] + [";".join(cell) for cell in row]
+        for account_id, row in matrix.items()
+    ]
+    if output.endswith(".parquet"):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Writing Parquet needs pyarrow: pip install pyarrow")
+        columns = ["account_id"] + actions
+        table = pyarrow.table(
+            {column: [row[i] for row in rows] for i, column in enumerate(columns)}
+        )
+        pyarrow.parquet.write_table(table, output)
+        return
+    with open(output, "w", newline="") as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(["account_id"] + actions)
+        writer.writerows(rows)
+
+
+def build_permission_matrix(
+    # The CSV or Parquet file to write
+    output,
+    # [Optional] A file with one action per line
+    # (Defaults to every action named in the organization's SCPs)
+    actions=None,
+    # [Optional] The resource to test access to
+    # (With "*", only Denies that apply to every resource are found)
+    resource="*",
+    # [Optional] The region the requests are occurring in
+    region="",
+    # [Optional] The ARN of the principal making the requests
+    principal_arn="",
+    # [Optional] Other condition keys of the requests
+    context=None,
+    # [Optional] Whether the requests have no condition keys other than the ones given
+    complete_context=False,
+    # [Optional] An organization snapshot written by org_snapshot.py
+    # (Defaults to taking one from the Organizations API)
+    snapshot=None,
+    # [Optional] How many worker processes to use (Defaults to the CPU count)
+    processes=None,
+    # [Optional] An action catalog (see action_catalog.py) to expand action
+    # patterns with, in the actions file and in the SCPs
+    catalog=None,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    build_permission_matrix(
+        output="matrix.csv",
+        actions="actions.txt",
+        snapshot="org.snapshot.json.gz",
+    )
+    """
+    if snapshot:
+        organization = load_snapshot(snapshot)
+    else:
+        organization = OrganizationSnapshot(take_snapshot())
+    action_catalog = load_catalog(catalog) if catalog else None
+    if actions:
+        action_list = read_actions(actions)
+        if action_catalog is not None:
+            action_list = expand_action_list(action_list, action_catalog)
+    else:
+        action_list = actions_in_policies(organization, action_catalog)
+    matrix = compute_matrix(
+        organization,
+        action_list,
+        resource=resource,
+        region=region or "",
+        principal_arn=principal_arn or "",
+        context=context,
+        complete_context=complete_context,
+        processes=processes,
+    )
+    write_matrix(matrix, action_list, output)
+    logging.warning(f"Wrote the permission matrix to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP permission matrix")
+    parser.set_defaults(method=build_permission_matrix)
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="The CSV file (or .parquet file, needs pyarrow) to write.",
+    )
+    parser.add_argument(
+        "--actions",
+        type=str,
+        required=False,
+        help="A file with one action per line. Defaults to every action named in the organization's SCPs.",
+    )
+    parser.add_argument(
+        "--resource",
+        type=str,
+        default="*",
+        help='The resource to test access to. With the default "*", only Denies that apply to every resource are found.',
+    )
+    parser.add_argument(
+        "--region",
+        type=str,
+        required=False,
+        help="The region the requests are occurring in.",
+    )
+    parser.add_argument(
+        "--principal_arn",
+        type=str,
+        required=False,
+        help="The ARN of the principal making the requests.",
+    )
+    parser.add_argument(
+        "--context",
+        type=str,
+        action="append",
+        metavar="KEY=VALUE",
+        help="Another condition key of the requests. Can be repeated.",
+    )
+    parser.add_argument(
+        "--complete_context",
+        action="store_true",
+        help="The requests have no condition keys other than the ones given.",
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        required=False,
+        help="An action catalog (see action_catalog.py) to expand action patterns with, in --actions and in the SCPs.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        required=False,
+        help="An organization snapshot written by org_snapshot.py. Defaults to taking one from the Organizations API.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="How many worker processes to use. Defaults to the CPU count.",
+    )
+    args = parser.parse_args()
+    try:
+        args.context = parse_context(args.context)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.catalog:
+        try:
+            load_catalog(args.catalog)
+        except (FileNotFoundError, ValueError) as error:
+            parser.error(str(error))
+    args.method(**vars(args))
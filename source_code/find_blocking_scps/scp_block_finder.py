@@ -1,78 +1,593 @@
 import argparse
 import boto3
+import csv
+import gzip
+import heapq
+import itertools
 import json
 import logging
 import re
+import sys
+import threading
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from action_catalog import DEFAULT_CATALOG, is_action_pattern, load_catalog
+from api_cache import DEFAULT_MAX_ENTRIES, DEFAULT_POLICY_TTL, DEFAULT_TTL, ApiCache
+from condition_evaluator import RequestContext, compile_condition
+from patterns import ResourceTrie, compile_pattern
 
 """
 Author: Benjamin Morris
 """
 
+# Default number of concurrent Organizations API calls
+DEFAULT_MAX_WORKERS = 8
+
+# Organizations throttles bursts of requests, so let botocore adapt the client's
+# request rate to the throttling errors it receives instead of retrying blindly
+ORGANIZATIONS_CLIENT_CONFIG = Config(retries={"mode": "adaptive", "max_attempts": 10})
+
+# Index bucket used for statements whose actions are not limited to one service
+# (for example "*", "*:Describe*" or any NotAction statement)
+ANY_SERVICE = "*"
+
+
+def action_service(action_pattern):
+    """
+    Returns the lowercase service prefix of an action (pattern), e.g. "s3" for
+    "s3:GetObject", or ANY_SERVICE if the pattern can match more than one service.
+    """
+    service, separator, _ = action_pattern.partition(":")
+    if not separator or "*" in service or "?" in service:
+        return ANY_SERVICE
+    return service.lower()
+
+
+def _as_list(value):
+    # Standardize into a list if there's only one value
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def _as_list_of_statements(statements):
+    # A policy may contain a single statement object instead of a list
+    if isinstance(statements, dict):
+        return [statements]
+    return statements
+
+
+def build_request_context(
+    region="", principal_arn="", account="", org_id="", context=None, complete=False
+):
+    """
+    Returns the RequestContext of a query: the region, principal and
+    organization keys that the finder's arguments stand for, plus any other
+    condition keys given in context.
+    """
+    request_context = RequestContext(context, complete=complete)
+    request_context.set("aws:RequestedRegion", region)
+    request_context.set("aws:PrincipalArn", principal_arn)
+    request_context.set("aws:PrincipalAccount", account)
+    request_context.set("aws:PrincipalOrgID", org_id)
+    return request_context
+
+
+def parse_context(key_values):
+    """
+    Turns a list of "KEY=VALUE" strings (e.g. from repeated --context arguments)
+    into a dict of condition keys and their values.
+    """
+    context = {}
+    for key_value in key_values or []:
+        key, separator, value = key_value.partition("=")
+        if not separator:
+            raise ValueError(f"--context {key_value} is not in the KEY=VALUE format")
+        context.setdefault(key, []).append(value)
+    return context
+
+
 def check_conditions(condition, region, principal_arn, account, org_id):
     """
     Helper function that returns whether a condition applies.
 
-    This helper function is EXTREMELY limited and only handles a handful of
-    specific operator and condition key combinations.
+    Condition keys that are not known from the user-provided input are assumed
+    to possibly apply (see condition_evaluator.RequestContext).
 
     Returns False if the SCP's Condition does not apply to the user-provided input
     Returns True if the SCP's Condition does apply to the user-provided input
     """
-    # Region allowlist
-    try:
-        allowed_regions = condition["StringNotEquals"]["aws:RequestedRegion"]
-        if region and region in allowed_regions:
-            return False
-    except KeyError:
-        logging.info("No region allowlist condition found.")
-    # Principal allowlist
-    try:
-        allowed_principals = condition["ArnNotLike"]["aws:PrincipalARN"]
-        if principal_arn:
-            # Operate under the assumption that the condition applies
-            # unless an exception is found
-            for excluded_principal in allowed_principals:
-                if re.search(excluded_principal.replace("*", ".*"), principal_arn):
-                    return False
-    except KeyError:
-        logging.info("No principal allowlist condition found.")
-    # Principal blocklist
-    try:
-        blocked_principals = condition["ArnLike"]["aws:PrincipalARN"]
-        if principal_arn:
-            # Operate under the assumption that the condition does NOT apply
-            # unless an exception is found
-            applies = False
-            for included_principal in blocked_principals:
-                if re.search(included_principal.replace("*", ".*"), principal_arn):
-                    applies = True
-            if applies is False:
-                return False
-    except KeyError:
-        logging.info("No principal blocklist condition found.")
-    # Account allowlist
-    try:
-        allowed_accounts = condition["StringNotEquals"]["aws:PrincipalAccount"]
-        if account and account in allowed_accounts:
-            return False
-    except KeyError:
-        logging.info("No account allowlist condition found.")
-    # Org Allowlist
-    try:
-        allowed_org_id = condition["StringNotEquals"]["aws:PrincipalOrgID"]
-        if org_id and org_id == allowed_org_id:
-            return False
-    except KeyError:
-        logging.info("No account allowlist condition found.")
-    # If all of the conditions apply, return True: the SCP does apply
-    return True
+    return compile_condition(condition)(
+        build_request_context(region, principal_arn, account, org_id)
+    )
+
+
+class CompiledStatement:
+    """
+    A single SCP statement with its Action/NotAction patterns compiled into
+    anchored matchers and its Resource/NotResource patterns into a
+    ResourceTrie, which matches ARNs segment by segment.
+
+    Actions are matched case-insensitively, resources case-sensitively,
+    as IAM does.
+    """
+
+    def __init__(self, policy_name, policy_arn, statement):
+        self.policy_name = policy_name
+        self.policy_arn = policy_arn
+        self.statement = statement
+        self.effect = statement.get("Effect")
+        self.condition = statement.get("Condition")
+        self.condition_matcher = (
+            compile_condition(self.condition) if self.condition else None
+        )
+
+        if "Action" in statement:
+            self.action_patterns = _as_list(statement["Action"])
+            self.action_negated = False
+        else:
+            self.action_patterns = _as_list(statement.get("NotAction", []))
+            self.action_negated = "NotAction" in statement
+        self.action_matchers = [
+            compile_pattern(pattern, ignore_case=True)
+            for pattern in self.action_patterns
+        ]
+
+        if "Resource" in statement:
+            self.resource_patterns = _as_list(statement["Resource"])
+            self.resource_negated = False
+        else:
+            self.resource_patterns = _as_list(statement.get("NotResource", []))
+            self.resource_negated = "NotResource" in statement
+        self.resource_trie = ResourceTrie(self.resource_patterns)
+
+        # A NotAction statement can match actions of any service. So can a
+        # statement with a pattern of any service, which is then only indexed
+        # under ANY_SERVICE, so that a query doesn't find it twice
+        if self.action_negated:
+            self.services = {ANY_SERVICE}
+        else:
+            self.services = {action_service(p) for p in self.action_patterns}
+            if ANY_SERVICE in self.services:
+                self.services = {ANY_SERVICE}
+
+    def matches_action(self, action):
+        matched = any(matcher.match(action) for matcher in self.action_matchers)
+        return matched != self.action_negated
+
+    def matches_resource(self, resource):
+        return self.resource_trie.matches(resource) != self.resource_negated
+
+    def matches_condition(self, request_context):
+        return self.condition_matcher is None or self.condition_matcher(request_context)
+
+    def matches(self, action, resource, request_context):
+        return (
+            self.matches_action(action)
+            and self.matches_resource(resource)
+            and self.matches_condition(request_context)
+        )
+
+    @property
+    def sid(self):
+        return self.statement.get("Sid", "")
+
+    def describe(self):
+        return f"{self.policy_name}/{self.sid}"
+
+    def to_dict(self):
+        return {
+            "policy_name": self.policy_name,
+            "policy_arn": self.policy_arn,
+            "sid": self.sid,
+        }
+
+
+class ImplicitDeny:
+    """
+    A level of the OU path (root, OU or account) at which none of the attached
+    SCPs allows the request, so that it is implicitly denied.
+    """
+
+    def __init__(self, target_id):
+        self.target_id = target_id
+
+    def describe(self):
+        return f"implicit deny at {self.target_id}"
+
+    def to_dict(self):
+        return {"implicit_deny_at": self.target_id}
+
+
+class CompiledPolicy:
+    """
+    An SCP parsed into CompiledStatements. Use compile_policy() to build one,
+    so that unchanged policies are reused instead of being compiled again.
+    """
+
+    def __init__(self, policy_id, policy_name, policy_arn, content):
+        self.policy_id = policy_id
+        self.policy_name = policy_name
+        self.policy_arn = policy_arn
+        self.content = content
+        self.statements = [
+            CompiledStatement(policy_name, policy_arn, statement)
+            for statement in _as_list_of_statements(json.loads(content)["Statement"])
+        ]
+
+
+# Compiled policies, keyed by policy ID and content, so that each SCP is only
+# parsed and compiled once per process (and again only if its content changes)
+_compiled_policies = {}
+
+
+def compile_policy(policy_id, policy_name, policy_arn, content):
+    key = (policy_id, content)
+    compiled = _compiled_policies.get(key)
+    if compiled is None:
+        compiled = CompiledPolicy(policy_id, policy_name, policy_arn, content)
+        _compiled_policies[key] = compiled
+    return compiled
+
+
+class AllowLevel:
+    """
+    The Allow statements of the SCPs attached to one level of an OU path.
+
+    Unconditional Allows on all resources are precomputed into sets (everything,
+    whole services and single actions), so that checking a level is usually a
+    set lookup. Only the remaining Allow statements are matched one by one.
+    """
+
+    def __init__(self, target_id):
+        self.target_id = target_id
+        self.allows_everything = False
+        self.allowed_services = set()
+        self.allowed_actions = set()
+        self.statements = []
+
+    def add_statement(self, statement):
+        if (
+            statement.condition is None
+            and not statement.action_negated
+            and not statement.resource_negated
+            and "*" in statement.resource_patterns
+            and all(_is_set_pattern(p) for p in statement.action_patterns)
+        ):
+            for pattern in statement.action_patterns:
+                if pattern == "*":
+                    self.allows_everything = True
+                elif pattern.endswith(":*"):
+                    self.allowed_services.add(action_service(pattern))
+                else:
+                    self.allowed_actions.add(pattern.lower())
+        else:
+            self.statements.append(statement)
+
+    def allows(self, action, resource, request_context):
+        if (
+            self.allows_everything
+            or action.lower() in self.allowed_actions
+            or action_service(action) in self.allowed_services
+        ):
+            return True
+        return any(
+            statement.matches(action, resource, request_context)
+            for statement in self.statements
+        )
+
+
+def _is_set_pattern(action_pattern):
+    # Whether an Allow pattern can be stored in the sets of an AllowLevel
+    if action_pattern == "*":
+        return True
+    if action_service(action_pattern) == ANY_SERVICE:
+        return False
+    name = action_pattern.partition(":")[2]
+    return name == "*" or not ("*" in name or "?" in name)
+
+
+class PolicyIndex:
+    """
+    The statements of a set of SCPs. Deny statements are grouped by the service
+    prefix of their actions, Allow statements by the level of the OU path whose
+    policies they belong to.
+
+    A query for "s3:GetObject" only looks at the "s3" bucket and at the
+    ANY_SERVICE bucket, instead of scanning every statement of every policy.
+    The Resource and NotResource patterns of the Deny statements are indexed
+    in one ResourceTrie each, so that a query for a resource only looks at
+    the statements whose resources can match it.
+    Statements are returned in the order the policies were added.
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+        self._by_service = defaultdict(list)
+        self._resources = ResourceTrie()
+        self._not_resources = ResourceTrie()
+        self.levels = {}
+
+    def add_policy(self, compiled_policy, level=None):
+        """
+        Adds a policy attached at level (a root, OU or account ID).
+        """
+        allow_level = self.levels.get(level)
+        if allow_level is None:
+            allow_level = self.levels[level] = AllowLevel(level)
+        for statement in compiled_policy.statements:
+            if statement.effect == "Allow":
+                allow_level.add_statement(statement)
+                continue
+            if statement.effect != "Deny":
+                continue
+            position = next(self._counter)
+            for service in statement.services:
+                self._by_service[service].append((position, statement))
+            resources = (
+                self._not_resources if statement.resource_negated else self._resources
+            )
+            for pattern in statement.resource_patterns:
+                resources.add(pattern, position)
+
+    def candidates(self, action, resource=None):
+        """
+        Yields the Deny statements that can match the action and, if given,
+        that match the resource.
+        """
+        service = action_service(action)
+        buckets = [self._by_service.get(ANY_SERVICE, [])]
+        if service != ANY_SERVICE:
+            buckets.append(self._by_service.get(service, []))
+        entries = heapq.merge(*buckets, key=lambda entry: entry[0])
+        if resource is None:
+            for _, statement in entries:
+                yield statement
+            return
+        matched = set(self._resources.match(resource))
+        not_matched = set(self._not_resources.match(resource))
+        for position, statement in entries:
+            if statement.resource_negated:
+                if position not in not_matched:
+                    yield statement
+            elif position in matched:
+                yield statement
+
+
+def evaluate_index(index, action, resource, request_context):
+    """
+    Returns what may block the given request: the matching Deny statements in
+    the index, followed by an ImplicitDeny for every level at which none of
+    the attached SCPs allows the request.
+    """
+    findings = [
+        statement
+        for statement in index.candidates(action, resource)
+        if statement.matches_action(action)
+        and statement.matches_condition(request_context)
+    ]
+    for allow_level in index.levels.values():
+        if not allow_level.allows(action, resource, request_context):
+            findings.append(ImplicitDeny(allow_level.target_id))
+    return findings
+
+
+class Organization:
+    """
+    Read-only view of the organization's hierarchy and SCPs, backed by the
+    Organizations API.
+
+    Every response is memoized, so evaluating many queries against the same
+    Organization only fetches each parent, attachment list and policy once.
+    With an ApiCache, responses are also reused between runs.
+    Attachment lists and policies are fetched on up to max_workers threads.
+    Subclasses provide other sources by overriding the _fetch_* methods.
+    """
+
+    def __init__(self, org_client=None, cache=None, max_workers=DEFAULT_MAX_WORKERS):
+        self._org_client = org_client
+        self._org_client_lock = threading.Lock()
+        self.cache = cache
+        self.max_workers = max_workers
+        self._org_id = None
+        self._parents = {}
+        self._policy_ids = {}
+        self._policies = {}
+        self._indexes = {}
+
+    @property
+    def org_client(self):
+        # Only created when something actually has to be fetched
+        with self._org_client_lock:
+            if self._org_client is None:
+                self._org_client = boto3.client(
+                    "organizations", config=ORGANIZATIONS_CLIENT_CONFIG
+                )
+        return self._org_client
+
+    def _fetch_org_id(self):
+        return self.org_client.describe_organization()["Organization"]["Id"]
+
+    def _fetch_parent(self, child_id):
+        parent_resp = self.org_client.list_parents(ChildId=child_id)
+        return parent_resp["Parents"][0]["Id"]
+
+    def _fetch_policy_ids(self, target_id):
+        paginator = self.org_client.get_paginator("list_policies_for_target")
+        return [
+            policy["Id"]
+            for page in paginator.paginate(
+                TargetId=target_id, Filter="SERVICE_CONTROL_POLICY"
+            )
+            for policy in page["Policies"]
+        ]
+
+    def _fetch_policy(self, policy_id):
+        """
+        Returns the name, ARN and content of a policy.
+        """
+        policy_response = self.org_client.describe_policy(PolicyId=policy_id)
+        policy_summary = policy_response["Policy"]["PolicySummary"]
+        return (
+            policy_summary["Name"],
+            policy_summary["Arn"],
+            policy_response["Policy"]["Content"],
+        )
+
+    def _cached(self, operation, params, fetch):
+        if self.cache is None:
+            return fetch()
+        return self.cache.get_or_fetch(operation, params, fetch)
+
+    @property
+    def org_id(self):
+        if self._org_id is None:
+            self._org_id = self._cached("describe_organization", {}, self._fetch_org_id)
+        return self._org_id
+
+    def get_parent(self, child_id):
+        if child_id not in self._parents:
+            self._parents[child_id] = self._cached(
+                "list_parents",
+                {"ChildId": child_id},
+                lambda: self._fetch_parent(child_id),
+            )
+        return self._parents[child_id]
+
+    def get_policy_ids(self, target_id):
+        if target_id not in self._policy_ids:
+            self._policy_ids[target_id] = self._cached(
+                "list_policies_for_target",
+                {"TargetId": target_id, "Filter": "SERVICE_CONTROL_POLICY"},
+                lambda: self._fetch_policy_ids(target_id),
+            )
+        return self._policy_ids[target_id]
+
+    def get_policy(self, policy_id):
+        if policy_id not in self._policies:
+            policy_name, policy_arn, policy_content = self._cached(
+                "describe_policy",
+                {"PolicyId": policy_id},
+                lambda: self._fetch_policy(policy_id),
+            )
+            logging.warning(f"Querying policy {policy_name} (ARN {policy_arn})...")
+            logging.debug(policy_content)
+            self._policies[policy_id] = compile_policy(
+                policy_id, policy_name, policy_arn, policy_content
+            )
+        return self._policies[policy_id]
+
+    def _walk_up(self, target):
+        # Yields the target followed by all of its ancestors, up to the root
+        current_target = target
+        yield current_target
+        while not re.match(r"r-", current_target):
+            current_target = self.get_parent(current_target)
+            yield current_target
+
+    def get_ou_stack(self, target):
+        """
+        Returns the target followed by all of its ancestors, up to the root.
+        """
+        return list(self._walk_up(target))
+
+    def get_policy_index(self, target):
+        """
+        Returns the PolicyIndex of every SCP attached to the target or to one
+        of its ancestors.
+
+        The attachments of each level are listed as soon as the level is known,
+        and each distinct policy (e.g. FullAWSAccess, which is usually attached
+        at every level) is described only once, all on a bounded thread pool.
+        """
+        if target not in self._indexes:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                ou_stack = []
+                level_futures = []
+                for organizations_id in self._walk_up(target):
+                    ou_stack.append(organizations_id)
+                    level_futures.append(
+                        executor.submit(self.get_policy_ids, organizations_id)
+                    )
+                logging.info(ou_stack)
+                policy_futures = {}
+                for level_future in level_futures:
+                    for policy_id in level_future.result():
+                        if policy_id not in policy_futures:
+                            policy_futures[policy_id] = executor.submit(
+                                self.get_policy, policy_id
+                            )
+                index = PolicyIndex()
+                for organizations_id, level_future in zip(ou_stack, level_futures):
+                    for policy_id in level_future.result():
+                        index.add_policy(
+                            policy_futures[policy_id].result(), organizations_id
+                        )
+            self._indexes[target] = index
+        return self._indexes[target]
+
+
+# Version of the snapshot format written by org_snapshot.py
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+class OrganizationSnapshot(Organization):
+    """
+    Organization backed by a snapshot written by org_snapshot.py instead of
+    the Organizations API, so that it can be queried offline.
+
+    A snapshot is a gzipped JSON document:
+    {
+        "format_version": 1,
+        "created": "<ISO 8601 timestamp>",
+        "org_id": "o-...",
+        "parents": {"<account or OU ID>": "<parent ID>", ...},
+        "attachments": {"<root, OU or account ID>": ["<policy ID>", ...], ...},
+        "policies": {"<policy ID>": {"name": ..., "arn": ..., "content": ...}, ...}
+    }
+    """
+
+    def __init__(self, snapshot):
+        if snapshot.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported snapshot format version {snapshot.get('format_version')}"
+            )
+        super().__init__()
+        self.snapshot = snapshot
+
+    def _fetch_org_id(self):
+        return self.snapshot["org_id"]
+
+    def _fetch_parent(self, child_id):
+        try:
+            return self.snapshot["parents"][child_id]
+        except KeyError:
+            raise ValueError(f"{child_id} is not part of the snapshot") from None
+
+    def _fetch_policy_ids(self, target_id):
+        return self.snapshot["attachments"].get(target_id, [])
+
+    def _fetch_policy(self, policy_id):
+        policy = self.snapshot["policies"][policy_id]
+        return policy["name"], policy["arn"], policy["content"]
+
+
+def load_snapshot(path):
+    """
+    Returns an OrganizationSnapshot for the snapshot file at path.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as snapshot_file:
+        return OrganizationSnapshot(json.load(snapshot_file))
 
 
 def find_blocking_scp(
     # The account, OU ID, or root ID that you want to query
     target,
-    # The action that you want to test for.
-    # It must be the full name of the action, no wildcards
+    # The action that you want to test for, e.g. ec2:DeleteVpc, or an action
+    # pattern (e.g. ec2:*Vpc*) that is expanded with the action catalog
     action,
     # The resource that you want to test access to
     # It must be the full ARN of the resource, no wildcards.
@@ -86,6 +601,18 @@ def find_blocking_scp(
     # [Optional] The ID of the account making this request
     # (Useful to filter out account-based Denies)
     account="",
+    # [Optional] Other condition keys of this request, e.g.
+    # {"aws:PrincipalTag/team": "network", "aws:SourceIp": "10.0.0.1"}
+    context=None,
+    # [Optional] Whether the request has no condition keys other than the ones given
+    # (Conditions on unknown keys are otherwise assumed to possibly apply)
+    complete_context=False,
+    # [Optional] An Organization to reuse between calls
+    # (Avoids fetching the same hierarchy and policies again)
+    organization=None,
+    # [Optional] The action catalog to expand an action pattern with
+    # (Defaults to action_catalog.json.gz, see action_catalog.py)
+    catalog=DEFAULT_CATALOG,
     # keyworded variable length of arguments
     **kwargs,
 ):
@@ -93,12 +620,17 @@ def find_blocking_scp(
     This is a script to help narrow down which SCP is blocking an action.
 
     Notes:
-        This assumes that the SCP is using a default-allow (FullAWSAccess).
-        This script will not be useful if you use a default-deny SCP model.
-        This script does not handle most conditions currently.
-        You will need to check conditions manually.
-        The script does a cursory check of common allowlist conditions...
-        ...specifically region, account, and principal.
+        This works with a default-allow (FullAWSAccess) and with an allow-list
+        SCP model: an action is also reported as blocked at every level of the
+        OU path where none of the attached SCPs allows it.
+        Conditions are evaluated against the region, principal, account and
+        any other condition keys you provide. Conditions on keys you don't
+        provide are assumed to apply, unless complete_context is set.
+
+    Returns the list of possibly-blocking statements (CompiledStatement),
+    followed by an ImplicitDeny for every level that doesn't allow the action.
+    For an action pattern, returns that list for every action it covers, by
+    action.
 
     Example Usage:
     find_blocking_scp(
@@ -107,87 +639,221 @@ def find_blocking_scp(
         resource="arn:aws:logs:us-west-1:999999999999:log-group::log-stream:",
     )
     """
-    org_client = boto3.client("organizations")
-    org_id = org_client.describe_organization()["Organization"]["Id"]
-    current_target = target
-    ou_stack = [current_target]
-    while not re.match(r"r-", current_target):
-        parent_resp = org_client.list_parents(ChildId=current_target)
-        parent_id = parent_resp["Parents"][0]["Id"]
-        ou_stack.append(parent_id)
-        current_target = parent_id
-    logging.info(ou_stack)
-    # Then for each layer, list the policies,
-    # then describe the policies so that we can check for the specified action
-    for organizations_id in ou_stack:
-        policies = org_client.list_policies_for_target(
-            TargetId=organizations_id, Filter="SERVICE_CONTROL_POLICY"
-        )["Policies"]
-        for policy in policies:
-            policy_id = policy["Id"]
-            policy_response = org_client.describe_policy(PolicyId=policy_id)
-            policy_content = policy_response["Policy"]["Content"]
-            policy_name = policy_response["Policy"]["PolicySummary"]["Name"]
-            policy_arn = policy_response["Policy"]["PolicySummary"]["Arn"]
-            logging.warning(f"Querying policy {policy_name} (ARN {policy_arn})...")
-            logging.debug(policy_content)
-            policy_json = json.loads(policy_content)["Statement"]
-            for statement in policy_json:
-                if statement["Effect"] == "Deny":
-
-                    # Check for Action value matches ###
-                    if statement.get("Action"):
-                        action_match = False
-                        all_actions = statement["Action"]
-                        # Standardize into a list if there's only one action
-                        if isinstance(all_actions, str):
-                            all_actions = [all_actions]
-                        for action_identifier in all_actions:
-                            action_identifier = action_identifier.replace("*", ".*")
-                            if re.search(action_identifier, action):
-                                action_match = True
-                                break
-                    elif statement.get("NotAction"):
-                        action_match = True
-                        all_notactions = statement["NotAction"]
-                        # Standardize into a list if there's only one action
-                        if isinstance(all_notactions, str):
-                            all_notactions = [all_notactions]
-                        for notaction_identifier in all_notactions:
-                            notaction_identifier = notaction_identifier.replace(
-                                "*", ".*"
-                            )
-                            if re.search(notaction_identifier, action):
-                                action_match = False
-                                break
-
-                    # Check for Resource value matches
-                    resource_match = False
-                    all_resources = statement["Resource"]
-                    # Standardize into a list if there's only one resource
-                    if isinstance(all_resources, str):
-                        all_resources = [all_resources]
-                    for resource_identifier in all_resources:
-                        resource_identifier = resource_identifier.replace("*", ".*")
-                        if re.search(resource_identifier, resource):
-                            resource_match = True
-                            break
-
-                    # Check for Conditions (LIMITED FUNCTIONALITY!!!)
-                    try:
-                        condition_json = statement["Condition"]
-                        condition_match = check_conditions(
-                            condition_json, region, principal_arn, account, org_id
-                        )
-                    except KeyError:
-                        logging.debug("No Conditions key in statement.")
-
-                    # Filter out non-matching SCP statements
-                    if resource_match and action_match and condition_match:
-                        pretty_statement = json.dumps(statement, indent=4)
-                        logging.warning(
-                            f"Found a possibly-blocking SCP in policy {policy_name}:\r\n{pretty_statement}"
-                        )
+    if organization is None:
+        organization = Organization()
+    # List, describe and compile the policies of each layer into an index,
+    # so that only the statements that can match the action are evaluated
+    index = organization.get_policy_index(target)
+    request_context = build_request_context(
+        region,
+        principal_arn,
+        account,
+        organization.org_id,
+        context=context,
+        complete=complete_context,
+    )
+    if is_action_pattern(action):
+        actions = load_catalog(catalog).expand(action)
+        if not actions:
+            raise ValueError(f"No action in the action catalog matches {action}")
+        findings_by_action = {}
+        for expanded in actions:
+            findings = evaluate_index(index, expanded, resource, request_context)
+            findings_by_action[expanded] = findings
+            if findings:
+                logging.warning(
+                    f"{expanded} is possibly blocked by "
+                    f"{', '.join(finding.describe() for finding in findings)}"
+                )
+        blocked = sum(bool(findings) for findings in findings_by_action.values())
+        logging.warning(
+            f"{blocked} of the {len(actions)} actions matching {action} are possibly blocked."
+        )
+        return findings_by_action
+    findings = evaluate_index(index, action, resource, request_context)
+    for finding in findings:
+        if isinstance(finding, ImplicitDeny):
+            logging.warning(
+                f"None of the SCPs attached to {finding.target_id} allows {action}, so it is implicitly denied."
+            )
+            continue
+        pretty_statement = json.dumps(finding.statement, indent=4)
+        logging.warning(
+            f"Found a possibly-blocking SCP in policy {finding.policy_name}:\r\n{pretty_statement}"
+        )
+    return findings
+
+
+# Columns (CSV) or keys (JSONL) of a batch query
+BATCH_QUERY_FIELDS = (
+    "target",
+    "action",
+    "resource",
+    "region",
+    "principal_arn",
+    "account",
+)
+
+
+def _csv_rows(stream):
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def _jsonl_rows(stream):
+    for line_number, line in enumerate(stream, 1):
+        if line.strip():
+            yield line_number, line
+
+
+def read_batch_queries(stream, file_format):
+    """
+    Yields one dict per query from a JSONL or CSV stream (with a header row).
+    A row that can't be parsed yields a query with only an "error" that names
+    its line, so that the other rows are still read.
+    """
+    if file_format == "csv":
+        rows = _csv_rows(stream)
+    else:
+        rows = _jsonl_rows(stream)
+    for line_number, row in rows:
+        try:
+            if file_format != "csv":
+                row = json.loads(row)
+            yield normalize_query(row)
+        except ValueError as error:
+            yield {"error": f"Line {line_number}: {error}"}
+
+
+def normalize_query(row):
+    """
+    Returns a query with all BATCH_QUERY_FIELDS (empty if missing) and, if the
+    row has any, the other condition keys under "context". Raises ValueError
+    if the row or its context isn't an object.
+    """
+    if not isinstance(row, dict):
+        raise ValueError(f"A query must be a JSON object, not {json.dumps(row)}")
+    query = {field: row.get(field) or "" for field in BATCH_QUERY_FIELDS}
+    # Other condition keys, as an object (or a JSON string in CSV files)
+    context = row.get("context")
+    if isinstance(context, str):
+        try:
+            context = json.loads(context) if context else None
+        except ValueError as error:
+            raise ValueError(f"The context is not valid JSON: {error}") from None
+    if context and not isinstance(context, dict):
+        raise ValueError("The context must be a JSON object of condition keys")
+    if context:
+        query["context"] = context
+    return query
+
+
+def evaluate_query(
+    query, organization, complete_context=False, catalog=DEFAULT_CATALOG
+):
+    """
+    Evaluates one query (see normalize_query) and returns its verdict: the
+    query, plus whether it is blocked and by which statements, or an error.
+    An action pattern (e.g. "ec2:*Vpc*") is expanded with the action catalog
+    (see action_catalog.py), and its verdict lists every action it covers.
+    """
+    verdict = dict(query)
+    # A row that couldn't be read (see read_batch_queries)
+    if "error" in query:
+        return verdict
+    missing = [f for f in ("target", "action", "resource") if not query[f]]
+    if missing:
+        verdict["error"] = f"Missing required field(s): {', '.join(missing)}"
+        return verdict
+    # A target that isn't part of the organization (or snapshot) fails only
+    # its own query, so that one bad row doesn't stop a batch
+    try:
+        index = organization.get_policy_index(query["target"])
+        request_context = build_request_context(
+            query["region"],
+            query["principal_arn"],
+            query["account"],
+            organization.org_id,
+            context=query.get("context"),
+            complete=complete_context,
+        )
+    except (ValueError, ClientError) as error:
+        verdict["error"] = str(error)
+        return verdict
+    if not is_action_pattern(query["action"]):
+        findings = evaluate_index(
+            index, query["action"], query["resource"], request_context
+        )
+        verdict["blocked"] = bool(findings)
+        verdict["statements"] = [finding.to_dict() for finding in findings]
+        return verdict
+    # An action pattern is evaluated for every action of the catalog it covers
+    try:
+        actions = load_catalog(catalog).expand(query["action"])
+    except FileNotFoundError as error:
+        verdict["error"] = str(error)
+        return verdict
+    verdict["actions"] = []
+    for action in actions:
+        findings = evaluate_index(index, action, query["resource"], request_context)
+        verdict["actions"].append(
+            {
+                "action": action,
+                "blocked": bool(findings),
+                "statements": [finding.to_dict() for finding in findings],
+            }
+        )
+    verdict["blocked"] = any(result["blocked"] for result in verdict["actions"])
+    return verdict
+
+
+def evaluate_batch(
+    queries, organization=None, complete_context=False, catalog=DEFAULT_CATALOG
+):
+    """
+    Evaluates many queries against one Organization and yields one verdict per
+    query, in order. The hierarchy and the policies are only fetched once.
+    """
+    if organization is None:
+        organization = Organization()
+    for query in queries:
+        yield evaluate_query(query, organization, complete_context, catalog)
+
+
+def find_blocking_scps_batch(
+    # Path of a JSONL or CSV file of queries, or "-" for stdin
+    batch,
+    # [Optional] "jsonl" or "csv" (Defaults to the file extension)
+    batch_format=None,
+    # [Optional] Whether the queries have no condition keys other than the ones given
+    complete_context=False,
+    # [Optional] An Organization to evaluate the queries against
+    # (Defaults to the live Organizations API)
+    organization=None,
+    # [Optional] The action catalog to expand action patterns with
+    catalog=DEFAULT_CATALOG,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Runs find_blocking_scp for every query of a JSONL or CSV file and prints
+    one JSON verdict line per query to stdout.
+
+    Each query has the fields target, action and resource, and optionally
+    region, principal_arn and account (see find_blocking_scp).
+
+    Example Usage:
+    scp_block_finder.py --batch access_denied.jsonl > verdicts.jsonl
+    """
+    if batch_format is None:
+        batch_format = "csv" if batch.lower().endswith(".csv") else "jsonl"
+    stream = sys.stdin if batch == "-" else open(batch, newline="")
+    with stream:
+        queries = read_batch_queries(stream, batch_format)
+        for verdict in evaluate_batch(queries, organization, complete_context, catalog):
+            print(json.dumps(verdict))
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":
@@ -196,19 +862,19 @@ if __name__ == "__main__":
     parser.add_argument(
         "--target",
         type=str,
-        required=True,
+        required=False,
         help="The account, OU ID, or root ID that you want to query.",
     )
     parser.add_argument(
         "--action",
         type=str,
-        required=True,
-        help="The action that you want to test access to. It must be the full name of the action (service:Action), no wildcards.",
+        required=False,
+        help="The action that you want to test access to (service:Action), or an action pattern like ec2:*Vpc* that is expanded with the action catalog.",
     )
     parser.add_argument(
         "--resource",
         type=str,
-        required=True,
+        required=False,
         help="The resource that you want to test access to. It must be the full ARN of the resource, no wildcards.",
     )
     parser.add_argument(
@@ -229,5 +895,98 @@ if __name__ == "__main__":
         required=False,
         help="The ID of the account making this request.",
     )
+    parser.add_argument(
+        "--context",
+        type=str,
+        action="append",
+        metavar="KEY=VALUE",
+        help="Another condition key of this request, e.g. aws:PrincipalTag/team=network. Can be repeated, also for multiple values of one key.",
+    )
+    parser.add_argument(
+        "--complete_context",
+        action="store_true",
+        help="The request has no condition keys other than the ones given. Conditions on missing keys are evaluated like IAM does instead of being assumed to apply.",
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        default=DEFAULT_CATALOG,
+        help="The action catalog that action patterns are expanded with. Defaults to action_catalog.json.gz next to this script.",
+    )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        required=False,
+        help="A JSONL or CSV file of queries (or - for stdin) to evaluate in one run. Prints one JSON verdict per line.",
+    )
+    parser.add_argument(
+        "--batch_format",
+        type=str,
+        required=False,
+        choices=["jsonl", "csv"],
+        help="The format of the --batch file. Defaults to its file extension.",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help=f"How many Organizations API calls are made concurrently (default {DEFAULT_MAX_WORKERS}).",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        required=False,
+        help="A SQLite file in which Organizations API responses are cached between runs.",
+    )
+    parser.add_argument(
+        "--cache_ttl",
+        type=int,
+        default=DEFAULT_TTL,
+        help=f"How long cached Organizations API responses are used, in seconds (default {DEFAULT_TTL}).",
+    )
+    parser.add_argument(
+        "--policy_cache_ttl",
+        type=int,
+        default=DEFAULT_POLICY_TTL,
+        help=f"How long cached SCP contents are used, in seconds (default {DEFAULT_POLICY_TTL}).",
+    )
+    parser.add_argument(
+        "--cache_max_entries",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help=f"How many Organizations API responses are cached at most (default {DEFAULT_MAX_ENTRIES}).",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        required=False,
+        help="Evaluate against an organization snapshot written by org_snapshot.py instead of the Organizations API.",
+    )
     args = parser.parse_args()
+    try:
+        args.context = parse_context(args.context)
+    except ValueError as error:
+        parser.error(str(error))
+    cache = None
+    if args.snapshot:
+        args.organization = load_snapshot(args.snapshot)
+    elif args.cache:
+        cache = ApiCache(
+            args.cache, args.cache_ttl, args.cache_max_entries, args.policy_cache_ttl
+        )
+        args.organization = Organization(cache=cache, max_workers=args.max_workers)
+    else:
+        args.organization = Organization(max_workers=args.max_workers)
+    if args.batch:
+        args.method = find_blocking_scps_batch
+    elif not (args.target and args.action and args.resource):
+        parser.error("--target, --action and --resource are required without --batch")
+    elif is_action_pattern(args.action):
+        try:
+            load_catalog(args.catalog)
+        except (FileNotFoundError, ValueError) as error:
+            parser.error(str(error))
     args.method(**vars(args))
+    if cache is not None:
+        logging.warning(f"Organizations API cache: {cache.stats()}")
+        cache.close()
@@ -0,0 +1,285 @@
+import argparse
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from org_snapshot import take_snapshot
+from scp_block_finder import (
+    OrganizationSnapshot,
+    evaluate_query,
+    load_snapshot,
+    normalize_query,
+)
+
+"""
+Long-running SCP evaluation service.
+
+Holds the organization and its compiled policies in memory, refreshes them in
+the background, and answers find_blocking_scp-style queries over HTTP:
+
+    GET  /query?target=...&action=...&resource=...[&region=&principal_arn=&account=]
+    POST /query     one query as a JSON object
+    POST /batch     JSONL queries, answered with JSONL verdicts
+    GET  /metrics   request latency and cache freshness, in Prometheus text format
+    GET  /healthz
+"""
+
+# Upper bounds of the request latency histogram, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+# Default seconds between two refreshes of the organization
+DEFAULT_REFRESH_INTERVAL = 300
+
+
+def warm_up(organization):
+    """
+    Builds the policy index of every root, OU and account of the snapshot, so
+    that no query has to wait for one.
+    """
+    targets = set(organization.snapshot["parents"])
+    targets.update(organization.snapshot["parents"].values())
+    for target in targets:
+        organization.get_policy_index(target)
+    return organization
+
+
+class OrganizationHolder:
+    """
+    Holds the current OrganizationSnapshot and replaces it in the background.
+
+    The next snapshot is loaded (from a snapshot file whenever it changes, or
+    from the Organizations API) and warmed up before it replaces the current
+    one, so queries never wait for a refresh.
+    """
+
+    def __init__(self, snapshot_path=None, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self._snapshot_mtime = None
+        self.organization = None
+        self.loaded_at = None
+        self.refresh()
+
+    def _load(self):
+        if self.snapshot_path:
+            mtime = os.path.getmtime(self.snapshot_path)
+            if mtime == self._snapshot_mtime:
+                return None
+            self._snapshot_mtime = mtime
+            return load_snapshot(self.snapshot_path)
+        return OrganizationSnapshot(take_snapshot())
+
+    def refresh(self):
+        organization = self._load()
+        if organization is not None:
+            self.organization = warm_up(organization)
+            self.refreshes += 1
+            logging.warning(f"Loaded organization {organization.org_id}.")
+        self.loaded_at = time.time()
+
+    def run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception:
+                self.refresh_errors += 1
+                logging.exception("Refreshing the organization failed.")
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+
+class Metrics:
+    """
+    Request counts and a latency histogram per endpoint.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+
+    def observe(self, endpoint, status, seconds):
+        with self._lock:
+            entry = self._requests.setdefault(
+                endpoint,
+                {"statuses": {}, "buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0},
+            )
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+            entry["sum"] += seconds
+            for i in range(
+                bisect.bisect_left(LATENCY_BUCKETS, seconds), len(LATENCY_BUCKETS)
+            ):
+                entry["buckets"][i] += 1
+
+    def render(self, holder):
+        lines = [
+            "# TYPE scp_eval_requests_total counter",
+            "# TYPE scp_eval_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            for endpoint, entry in sorted(self._requests.items()):
+                count = sum(entry["statuses"].values())
+                for status, status_count in sorted(entry["statuses"].items()):
+                    lines.append(
+                        f'scp_eval_requests_total{{endpoint="{endpoint}",status="{status}"}} {status_count}'
+                    )
+                for bound, bucket_count in zip(LATENCY_BUCKETS, entry["buckets"]):
+                    lines.append(
+                        f'scp_eval_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {bucket_count}'
+                    )
+                lines.append(
+                    f'scp_eval_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {count}'
+                )
+                lines.append(
+                    f'scp_eval_request_duration_seconds_sum{{endpoint="{endpoint}"}} {entry["sum"]}'
+                )
+                lines.append(
+                    f'scp_eval_request_duration_seconds_count{{endpoint="{endpoint}"}} {count}'
+                )
+        lines += [
+            "# TYPE scp_eval_organization_age_seconds gauge",
+            f"scp_eval_organization_age_seconds {time.time() - holder.loaded_at}",
+            "# TYPE scp_eval_organization_refreshes_total counter",
+            f"scp_eval_organization_refreshes_total {holder.refreshes}",
+            "# TYPE scp_eval_organization_refresh_errors_total counter",
+            f"scp_eval_organization_refresh_errors_total {holder.refresh_errors}",
+            "# TYPE scp_eval_policy_indexes gauge",
+            f"scp_eval_policy_indexes {len(holder.organization._indexes)}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def make_handler(holder, metrics, complete_context=False):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def _send(self, status, body, content_type="application/json"):
+            payload = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return status
+
+        def _body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def _evaluate(self, row):
+            return evaluate_query(
+                normalize_query(row), holder.organization, complete_context
+            )
+
+        def _handle(self, method):
+            path = urlparse(self.path).path
+            started = time.perf_counter()
+            try:
+                status = self._route(method, path)
+            except (ValueError, KeyError) as error:
+                status = self._send(400, json.dumps({"error": str(error)}))
+            metrics.observe(path, status, time.perf_counter() - started)
+
+        def _route(self, method, path):
+            if path == "/metrics" and method == "GET":
+                return self._send(200, metrics.render(holder), "text/plain")
+            if path == "/healthz" and method == "GET":
+                return self._send(200, json.dumps({"status": "ok"}))
+            if path == "/query" and method == "GET":
+                query = urlparse(self.path).query
+                row = {k: v[0] for k, v in parse_qs(query).items()}
+                return self._send(200, json.dumps(self._evaluate(row)))
+            if path == "/query" and method == "POST":
+                row = json.loads(self._body())
+                return self._send(200, json.dumps(self._evaluate(row)))
+            if path == "/batch" and method == "POST":
+                verdicts = [
+                    json.dumps(self._evaluate(json.loads(line)))
+                    for line in self._body().decode("utf-8").splitlines()
+                    if line.strip()
+                ]
+                body = "\n".join(verdicts) + "\n"
+                return self._send(200, body, "application/x-ndjson")
+            return self._send(404, json.dumps({"error": f"No route {method} {path}"}))
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+    return Handler
+
+
+def serve(
+    # [Optional] The address to listen on
+    host="127.0.0.1",
+    # [Optional] The port to listen on
+    port=8080,
+    # [Optional] An organization snapshot written by org_snapshot.py, reloaded
+    # whenever it changes (Defaults to the Organizations API)
+    snapshot=None,
+    # [Optional] Seconds between two refreshes of the organization
+    refresh_interval=DEFAULT_REFRESH_INTERVAL,
+    # [Optional] Whether queries have no condition keys other than the ones given
+    complete_context=False,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    serve(port=8080, snapshot="org.snapshot.json.gz")
+    """
+    holder = OrganizationHolder(snapshot, refresh_interval)
+    holder.start()
+    # Evaluating a query logs the policies it reads, which is not useful here
+    logging.getLogger().setLevel(logging.ERROR)
+    server = ThreadingHTTPServer(
+        (host, port), make_handler(holder, Metrics(), complete_context)
+    )
+    print(f"Serving SCP evaluations on http://{host}:{port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP evaluation service")
+    parser.set_defaults(method=serve)
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="The address to listen on (default 127.0.0.1).",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="The port to listen on (default 8080).",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        required=False,
+        help="An organization snapshot written by org_snapshot.py, reloaded whenever it changes. Defaults to the Organizations API.",
+    )
+    parser.add_argument(
+        "--refresh_interval",
+        type=int,
+        default=DEFAULT_REFRESH_INTERVAL,
+        help=f"Seconds between two refreshes of the organization (default {DEFAULT_REFRESH_INTERVAL}).",
+    )
+    parser.add_argument(
+        "--complete_context",
+        action="store_true",
+        help="Queries have no condition keys other than the ones given.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
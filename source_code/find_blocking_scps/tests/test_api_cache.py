@@ -0,0 +1,55 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import api_cache  # noqa: E402
+from api_cache import ApiCache  # noqa: E402
+
+"""
+A changed SCP is served from the cache until its policy TTL expires, while the
+other responses keep the longer TTL.
+"""
+
+POLICY_PARAMS = {"PolicyId": "p-deny"}
+LIST_PARAMS = {"TargetId": "111111111111", "Filter": "SERVICE_CONTROL_POLICY"}
+
+
+class ApiCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ApiCache(":memory:", ttl=3600, policy_ttl=60)
+        self.now = 1000.0
+        patcher = mock.patch.object(api_cache.time, "time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_policy(self, content):
+        return self.cache.get_or_fetch(
+            "describe_policy", POLICY_PARAMS, lambda: ["p-deny", "DenyS3", content]
+        )
+
+    def list_policies(self, policy_ids):
+        return self.cache.get_or_fetch(
+            "list_policies_for_target", LIST_PARAMS, lambda: policy_ids
+        )
+
+    def test_changed_policy_is_served_after_policy_ttl(self):
+        self.assertEqual(self.get_policy("old")[2], "old")
+        self.now += 59
+        self.assertEqual(self.get_policy("new")[2], "old")
+        self.now += 1
+        self.assertEqual(self.get_policy("new")[2], "new")
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_other_responses_keep_ttl(self):
+        self.assertEqual(self.list_policies(["p-deny"]), ["p-deny"])
+        self.now += 3599
+        self.assertEqual(self.list_policies(["p-other"]), ["p-deny"])
+        self.now += 1
+        self.assertEqual(self.list_policies(["p-other"]), ["p-other"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scp_block_finder import (  # noqa: E402
+    SNAPSHOT_FORMAT_VERSION,
+    OrganizationSnapshot,
+    evaluate_batch,
+    read_batch_queries,
+)
+
+"""
+A malformed row of a batch file only fails its own query.
+"""
+
+SNAPSHOT = {
+    "format_version": SNAPSHOT_FORMAT_VERSION,
+    "created": "2026-01-01T00:00:00+00:00",
+    "org_id": "o-test",
+    "parents": {"111111111111": "r-0000"},
+    "attachments": {"r-0000": ["p-deny"], "111111111111": ["p-deny"]},
+    "policies": {
+        "p-deny": {
+            "name": "DenyS3",
+            "arn": "arn:aws:organizations::123456789012:policy/o-test/service_control_policy/p-deny",
+            "content": json.dumps(
+                {
+                    "Version": "2012-10-17",
+                    "Statement": [
+                        {"Effect": "Allow", "Action": "*", "Resource": "*"},
+                        {
+                            "Sid": "DenyS3",
+                            "Effect": "Deny",
+                            "Action": "s3:*",
+                            "Resource": "*",
+                        },
+                    ],
+                }
+            ),
+        }
+    },
+}
+
+GOOD_QUERY = {"target": "111111111111", "action": "s3:GetObject", "resource": "*"}
+
+
+def verdicts(text, file_format):
+    queries = read_batch_queries(io.StringIO(text), file_format)
+    return list(evaluate_batch(queries, OrganizationSnapshot(SNAPSHOT)))
+
+
+class BatchQueriesTest(unittest.TestCase):
+    def test_malformed_jsonl_lines(self):
+        lines = [
+            json.dumps(GOOD_QUERY),
+            "{not json",
+            "[]",
+            json.dumps({**GOOD_QUERY, "context": ["aws:SourceVpc"]}),
+            json.dumps(GOOD_QUERY),
+        ]
+        results = verdicts("\n".join(lines) + "\n", "jsonl")
+        self.assertEqual(len(results), 5)
+        self.assertTrue(results[0]["blocked"])
+        self.assertTrue(results[1]["error"].startswith("Line 2: "))
+        self.assertTrue(results[2]["error"].startswith("Line 3: "))
+        self.assertTrue(results[3]["error"].startswith("Line 4: "))
+        self.assertTrue(results[4]["blocked"])
+
+    def test_bad_csv_context_cell(self):
+        text = (
+            "target,action,resource,context\n"
+            "111111111111,s3:GetObject,*,{bad\n"
+            '111111111111,s3:GetObject,*,"{""aws:SourceVpc"": [""vpc-1""]}"\n'
+        )
+        results = verdicts(text, "csv")
+        self.assertEqual(len(results), 2)
+        self.assertTrue(results[0]["error"].startswith("Line 2: "))
+        self.assertTrue(results[1]["blocked"])
+        self.assertEqual(results[1]["context"], {"aws:SourceVpc": ["vpc-1"]})
+
+    def test_unknown_target(self):
+        results = verdicts(
+            json.dumps({**GOOD_QUERY, "target": "222222222222"}) + "\n", "jsonl"
+        )
+        self.assertIn("222222222222", results[0]["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
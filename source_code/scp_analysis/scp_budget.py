@@ -0,0 +1,276 @@
+import argparse
+import json
+import logging
+import os
+import re
+
+from scp_render import load_rendered
+from scp_templates import (
+    DEFAULT_MASTER_ACCOUNT_ID,
+    MAX_POLICIES_PER_TARGET,
+    MAX_POLICY_CHARACTERS,
+    SOURCE_DIR,
+    terraform_jsonencode,
+)
+
+"""
+Checks the rendered SCPs against the SCP size quota and every target against
+the quota of SCPs per target, before Terraform gets to apply them.
+
+With --pack, the statements of the SCPs that are attached to the same targets
+are repacked into as few policies as fit the size quota.
+"""
+
+POLICY_VERSION = "2012-10-17"
+
+
+def encoded_size(statements):
+    return len(
+        terraform_jsonencode({"Version": POLICY_VERSION, "Statement": statements})
+    )
+
+
+def fits(statements):
+    # scp_module/variables.tf only accepts policies shorter than the quota
+    return encoded_size(statements) < MAX_POLICY_CHARACTERS
+
+
+def budget_report(modules, full_aws_access=True):
+    """
+    Returns the size and headroom of every SCP, the slots used on every
+    target, and the list of quota violations.
+    """
+    policies = [
+        {
+            "scp_name": module.scp_name,
+            "template": module.template,
+            "size": module.size,
+            "headroom": MAX_POLICY_CHARACTERS - 1 - module.size,
+        }
+        for module in modules
+    ]
+    targets = {}
+    for module in modules:
+        for target_id in module.targets:
+            targets.setdefault(target_id, []).append(module.scp_name)
+    if full_aws_access:
+        # FullAWSAccess is attached everywhere unless it was replaced
+        for scp_names in targets.values():
+            scp_names.append("FullAWSAccess")
+    violations = [
+        f"{policy['scp_name']} is {policy['size']} characters long, the quota is {MAX_POLICY_CHARACTERS}"
+        for policy in policies
+        if policy["headroom"] < 0
+    ] + [
+        f"{target_id} has {len(scp_names)} SCPs attached, the quota is {MAX_POLICIES_PER_TARGET}"
+        for target_id, scp_names in sorted(targets.items())
+        if len(scp_names) > MAX_POLICIES_PER_TARGET
+    ]
+    return {
+        "policies": policies,
+        "targets": {
+            target_id: {
+                "scps": scp_names,
+                "free_slots": MAX_POLICIES_PER_TARGET - len(scp_names),
+            }
+            for target_id, scp_names in sorted(targets.items())
+        },
+        "violations": violations,
+    }
+
+
+def _split_statement(statement):
+    # Splits a statement that is too large on its own into statements with
+    # half of its actions each. Denying (or allowing) each half separately
+    # has the same effect as the whole.
+    if fits([statement]):
+        return [statement]
+    actions = statement.get("Action")
+    if not isinstance(actions, list) or len(actions) < 2:
+        raise ValueError(
+            f"Statement {statement.get('Sid', '')} alone exceeds the SCP size quota"
+        )
+    halves = []
+    for number, part in enumerate(
+        (actions[: len(actions) // 2], actions[len(actions) // 2 :]), 1
+    ):
+        half = dict(statement, Action=part)
+        if "Sid" in half:
+            half["Sid"] = f"{statement['Sid']}{number}"
+        halves.extend(_split_statement(half))
+    return halves
+
+
+def _unique_sid(statement, used_sids):
+    # Sids have to be unique within a policy
+    sid = statement.get("Sid")
+    if sid is None or sid not in used_sids:
+        return statement
+    number = 2
+    while f"{sid}{number}" in used_sids:
+        number += 1
+    return dict(statement, Sid=f"{sid}{number}")
+
+
+def pack_statements(statements):
+    """
+    Packs statements into as few policies as fit the size quota (first fit,
+    largest statements first), splitting statements that don't fit on their own.
+    Returns a list of statement lists.
+    """
+    pieces = [
+        piece for statement in statements for piece in _split_statement(statement)
+    ]
+    pieces.sort(key=lambda piece: len(terraform_jsonencode(piece)), reverse=True)
+    bins = []
+    for piece in pieces:
+        for packed in bins:
+            candidate = _unique_sid(piece, {s.get("Sid") for s in packed})
+            if fits(packed + [candidate]):
+                packed.append(candidate)
+                break
+        else:
+            bins.append([piece])
+    return bins
+
+
+def pack_modules(modules):
+    """
+    Repacks the statements of the SCPs attached to exactly the same targets.
+    Returns one {"targets", "scp_names", "policies"} entry per group of targets.
+    """
+    groups = {}
+    for module in modules:
+        if module.targets:
+            groups.setdefault(tuple(sorted(module.targets)), []).append(module)
+    packed = []
+    for targets, group in groups.items():
+        statements = [
+            statement
+            for module in group
+            for statement in _as_list(module.document["Statement"])
+        ]
+        packed.append(
+            {
+                "targets": list(targets),
+                "scp_names": [module.scp_name for module in group],
+                "policies": pack_statements(statements),
+            }
+        )
+    return packed
+
+
+def _as_list(value):
+    # Standardize into a list if there's only one value
+    return value if isinstance(value, list) else [value]
+
+
+def write_packed(packed, output, master_account_id=DEFAULT_MASTER_ACCOUNT_ID):
+    """
+    Writes every packed policy as a template, with the management account ID
+    turned back into ${master_account_id}.
+    """
+    os.makedirs(output, exist_ok=True)
+    for group in packed:
+        name = re.sub(r"[^\w-]", "_", "_".join(group["targets"]))
+        for number, statements in enumerate(group["policies"], 1):
+            path = os.path.join(output, f"Packed_{name}_{number}.json.tpl")
+            document = json.dumps(
+                {"Version": POLICY_VERSION, "Statement": statements}, indent=4
+            )
+            with open(path, "w") as policy_file:
+                policy_file.write(
+                    document.replace(master_account_id, "${master_account_id}") + "\n"
+                )
+
+
+def check_scp_budget(
+    # [Optional] A bundle written by scp_render.py (Defaults to rendering the templates)
+    bundle=None,
+    # [Optional] The directory with scp_define_attach.tf and terraform.tfvars
+    source_dir=SOURCE_DIR,
+    # [Optional] The management account ID to render the templates with
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+    # [Optional] Whether FullAWSAccess is still attached to every target
+    full_aws_access=True,
+    # [Optional] Write the repacked policies of each group of targets to this directory
+    pack=None,
+    # [Optional] Write the report as JSON to this file
+    output=None,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    check_scp_budget(pack="packed_scps")
+    """
+    modules = load_rendered(bundle, source_dir, master_account_id)
+    report = budget_report(modules, full_aws_access)
+    for policy in report["policies"]:
+        logging.warning(
+            f"{policy['scp_name']}: {policy['size']} characters, {policy['headroom']} left"
+        )
+    for target_id, target in report["targets"].items():
+        logging.warning(
+            f"{target_id}: {len(target['scps'])} of {MAX_POLICIES_PER_TARGET} SCPs ({', '.join(target['scps'])})"
+        )
+    if pack:
+        report["packed"] = pack_modules(modules)
+        for group in report["packed"]:
+            logging.warning(
+                f"{', '.join(group['targets'])}: {len(group['scp_names'])} SCPs "
+                f"can be packed into {len(group['policies'])}"
+            )
+        write_packed(report["packed"], pack, master_account_id)
+        logging.warning(f"Wrote the packed policies to {pack}")
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    for violation in report["violations"]:
+        logging.error(violation)
+    if report["violations"]:
+        raise SystemExit(1)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP size and quota checks")
+    parser.set_defaults(method=check_scp_budget)
+    parser.add_argument(
+        "--bundle",
+        type=str,
+        required=False,
+        help="A bundle written by scp_render.py. Defaults to rendering the templates.",
+    )
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=SOURCE_DIR,
+        help="The directory with scp_define_attach.tf and terraform.tfvars.",
+    )
+    parser.add_argument(
+        "--master_account_id",
+        type=str,
+        default=DEFAULT_MASTER_ACCOUNT_ID,
+        help="The management account ID to render the templates with.",
+    )
+    parser.add_argument(
+        "--without_full_aws_access",
+        dest="full_aws_access",
+        action="store_false",
+        help="FullAWSAccess was replaced, so it doesn't use a slot on every target.",
+    )
+    parser.add_argument(
+        "--pack",
+        type=str,
+        required=False,
+        help="Write the repacked policies of each group of targets to this directory.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Write the report as JSON to this file.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
@@ -0,0 +1,247 @@
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+
+from scp_render import load_rendered
+from scp_templates import DEFAULT_MASTER_ACCOUNT_ID, SOURCE_DIR
+
+"""
+Finds the modules of scp_define_attach.tf whose rendered SCP, description or
+targets changed since the last deployment, so that the pipeline only plans,
+validates and applies those.
+
+After every deployment, a manifest with a hash of every module is stored next
+to the Terraform state. The next run compares the current hashes against it.
+SCPs changed outside Terraform are only reverted by a full run (--full).
+"""
+
+MANIFEST_FORMAT_VERSION = 1
+
+# Changes to these files can affect every module
+SHARED_FILES = (
+    "scp_module/*.tf",
+    "providers.tf",
+    "backend.tf",
+    "variables.tf",
+)
+
+
+def module_hash(module):
+    """
+    Returns a hash of everything Terraform deploys for a module.
+    """
+    deployed = {
+        "scp_name": module.scp_name,
+        "description": module.description,
+        "content": module.content,
+        "targets": sorted(module.targets),
+    }
+    return hashlib.sha256(json.dumps(deployed, sort_keys=True).encode()).hexdigest()
+
+
+def shared_hash(source_dir=SOURCE_DIR):
+    digest = hashlib.sha256()
+    for pattern in SHARED_FILES:
+        for path in sorted(glob.glob(os.path.join(source_dir, pattern))):
+            digest.update(os.path.relpath(path, source_dir).encode())
+            with open(path, "rb") as shared_file:
+                digest.update(hashlib.sha256(shared_file.read()).digest())
+    return digest.hexdigest()
+
+
+def build_manifest(modules, source_dir=SOURCE_DIR):
+    return {
+        "format_version": MANIFEST_FORMAT_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": os.environ.get("CODEBUILD_RESOLVED_SOURCE_VERSION", ""),
+        "shared": shared_hash(source_dir),
+        "modules": {module.module_name: module_hash(module) for module in modules},
+    }
+
+
+def changed_modules(manifest, current):
+    """
+    Returns the names of the modules that were added, changed or removed
+    between two manifests, or None if every module has to be deployed.
+    """
+    if (
+        manifest is None
+        or manifest.get("format_version") != MANIFEST_FORMAT_VERSION
+        or manifest["shared"] != current["shared"]
+    ):
+        return None
+    names = set(manifest["modules"]) | set(current["modules"])
+    return sorted(
+        name
+        for name in names
+        if manifest["modules"].get(name) != current["modules"].get(name)
+    )
+
+
+def _split_s3_url(url):
+    bucket, _, key = url[len("s3://") :].partition("/")
+    return bucket, key
+
+
+def read_manifest(location):
+    """
+    Reads a manifest from a local path or an s3://bucket/key URL. Returns None
+    if there is none yet.
+    """
+    if location.startswith("s3://"):
+        import boto3
+
+        s3 = boto3.client("s3")
+        bucket, key = _split_s3_url(location)
+        try:
+            body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+        except s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(body)
+    if not os.path.exists(location):
+        return None
+    with open(location) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(manifest, location):
+    body = json.dumps(manifest, indent=2, sort_keys=True)
+    if location.startswith("s3://"):
+        import boto3
+
+        bucket, key = _split_s3_url(location)
+        boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=body.encode())
+        return
+    with open(location, "w") as manifest_file:
+        manifest_file.write(body + "\n")
+
+
+def target_arguments(changed):
+    """
+    Returns the terraform plan/apply arguments for the changed modules: "none"
+    if nothing changed, "" (no -target) for a full run.
+    """
+    if changed is None:
+        return ""
+    if not changed:
+        return "none"
+    return " ".join(f"-target=module.{name}" for name in changed)
+
+
+def find_changed_scps(
+    # The manifest of the last deployment, as a path or an s3://bucket/key URL
+    manifest,
+    # [Optional] Write the terraform -target arguments to this file
+    targets_file=None,
+    # [Optional] A bundle written by scp_render.py (Defaults to rendering the templates)
+    bundle=None,
+    # [Optional] The directory with scp_define_attach.tf and terraform.tfvars
+    source_dir=SOURCE_DIR,
+    # [Optional] The management account ID to render the templates with
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+    # [Optional] Deploy every SCP regardless of the manifest, which also
+    # reverts SCPs that were changed outside Terraform
+    full=False,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    find_changed_scps(manifest="s3://my-tfstate-bucket/scp_manifest.json", targets_file="tf_targets.txt")
+    find_changed_scps(manifest="s3://my-tfstate-bucket/scp_manifest.json", full=True)
+    """
+    current = build_manifest(
+        load_rendered(bundle, source_dir, master_account_id), source_dir
+    )
+    changed = None if full else changed_modules(read_manifest(manifest), current)
+    if full:
+        logging.warning("Full run requested, every SCP is deployed.")
+    elif changed is None:
+        logging.warning("No comparable deployment manifest, every SCP is deployed.")
+    elif not changed:
+        logging.warning("No SCP changed since the last deployment.")
+    else:
+        logging.warning(f"Changed since the last deployment: {', '.join(changed)}")
+    arguments = target_arguments(changed)
+    if targets_file:
+        with open(targets_file, "w") as output_file:
+            output_file.write(arguments + "\n")
+    else:
+        print(arguments)
+    return changed
+
+
+def update_manifest(
+    # Where to write the manifest, as a path or an s3://bucket/key URL
+    manifest,
+    # [Optional] A bundle written by scp_render.py (Defaults to rendering the templates)
+    bundle=None,
+    # [Optional] The directory with scp_define_attach.tf and terraform.tfvars
+    source_dir=SOURCE_DIR,
+    # [Optional] The management account ID to render the templates with
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    update_manifest(manifest="s3://my-tfstate-bucket/scp_manifest.json")
+    """
+    current = build_manifest(
+        load_rendered(bundle, source_dir, master_account_id), source_dir
+    )
+    write_manifest(current, manifest)
+    logging.warning(f"Wrote the deployment manifest to {manifest}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP change detection")
+    parser.set_defaults(method=find_changed_scps)
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        required=True,
+        help="The manifest of the last deployment, as a path or an s3://bucket/key URL.",
+    )
+    parser.add_argument(
+        "--targets_file",
+        type=str,
+        required=False,
+        help='Write the terraform -target arguments to this file ("none" if nothing changed, empty for a full run). Defaults to stdout.',
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Deploy every SCP regardless of the manifest (an empty target list), which also reverts SCPs changed outside Terraform.",
+    )
+    parser.add_argument(
+        "--update_manifest",
+        action="store_true",
+        help="Write the manifest of the current templates instead, after a deployment.",
+    )
+    parser.add_argument(
+        "--bundle",
+        type=str,
+        required=False,
+        help="A bundle written by scp_render.py. Defaults to rendering the templates.",
+    )
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=SOURCE_DIR,
+        help="The directory with scp_define_attach.tf and terraform.tfvars.",
+    )
+    parser.add_argument(
+        "--master_account_id",
+        type=str,
+        default=DEFAULT_MASTER_ACCOUNT_ID,
+        help="The management account ID to render the templates with.",
+    )
+    args = parser.parse_args()
+    if args.update_manifest:
+        args.method = update_manifest
+    args.method(**vars(args))
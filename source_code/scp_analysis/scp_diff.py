@@ -0,0 +1,327 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+from scp_redundancy import target_paths
+from scp_render import FULL_AWS_ACCESS_ID, is_bundle, load_bundle, planned_snapshot
+from scp_templates import DEFAULT_MASTER_ACCOUNT_ID, SOURCE_DIR, load_modules
+from statements import _as_list
+
+# The compiled policy matcher of the block finder
+sys.path.insert(0, os.path.join(SOURCE_DIR, "find_blocking_scps"))
+from scp_block_finder import (  # noqa: E402
+    OrganizationSnapshot,
+    build_request_context,
+    evaluate_index,
+)
+
+"""
+Computes which (target, action, principal) combinations went from allowed to
+denied, or back, between two versions of the SCP templates.
+
+Both versions are rendered offline, compiled with the block finder's policy
+matcher, and evaluated for every target in terraform.tfvars, every action the
+SCPs name (a sample action for each wildcard and NotAction pattern), and every
+principal pattern their conditions name.
+"""
+
+# Stands for every principal that none of the SCPs names
+OTHER_PRINCIPAL = "arn:aws:iam::111122223333:role/AnyOtherRole"
+
+PRINCIPAL_KEY = "aws:principalarn"
+
+
+def modules_at(
+    revision, source_dir=SOURCE_DIR, master_account_id=DEFAULT_MASTER_ACCOUNT_ID
+):
+    """
+    Returns the ScpModules of the source directory at a git revision.
+    """
+    # Run in the source directory, git archive only includes that subtree
+    archive = subprocess.run(
+        ["git", "archive", "--format=tar", revision, "--", "."],
+        cwd=source_dir,
+        check=True,
+        capture_output=True,
+    ).stdout
+    with tempfile.TemporaryDirectory() as checkout:
+        archive_path = os.path.join(checkout, "source.tar")
+        with open(archive_path, "wb") as archive_file:
+            archive_file.write(archive)
+        with tarfile.open(archive_path) as tar:
+            tar.extractall(checkout)
+        return load_modules(checkout, master_account_id)
+
+
+def modules_of(
+    version, source_dir=SOURCE_DIR, master_account_id=DEFAULT_MASTER_ACCOUNT_ID
+):
+    """
+    Returns the ScpModules of a bundle written by scp_render.py, or of the
+    source directory at a git revision.
+    """
+    if is_bundle(version):
+        return load_bundle(version)
+    return modules_at(version, source_dir, master_account_id)
+
+
+def _principal_patterns(modules):
+    patterns = set()
+    for module in modules:
+        for statement in _as_list(module.document["Statement"]):
+            for keys in statement.get("Condition", {}).values():
+                for key, values in keys.items():
+                    if key.lower() == PRINCIPAL_KEY:
+                        patterns.update(_as_list(values))
+    return patterns
+
+
+def _sample_principal(pattern):
+    # A principal ARN matching the pattern: the account wildcard becomes an
+    # account ID, any other wildcard a plain name
+    segments = pattern.split(":", 5)
+    if len(segments) == 6 and segments[4] == "*":
+        segments[4] = "111122223333"
+    return re.sub(r"[*?]", "x", ":".join(segments))
+
+
+def _sample_action(pattern):
+    # An action matching the pattern, e.g. "athena:x" for "athena:*", so that
+    # adding or removing a wildcard or NotAction pattern changes its verdict
+    return re.sub(r"[*?]", "x", pattern)
+
+
+def _actions_and_resources(modules):
+    # A sample action of every action pattern the SCPs name, in Action and
+    # NotAction, with the resources of the statements that name it
+    actions = {}
+    for module in modules:
+        for statement in _as_list(module.document["Statement"]):
+            resources = [
+                resource
+                for resource in _as_list(statement.get("Resource"))
+                if resource != "*"
+            ]
+            for pattern in _as_list(
+                statement.get("Action") or statement.get("NotAction")
+            ):
+                # "*" alone has no service to sample
+                if ":" not in pattern:
+                    continue
+                actions.setdefault(_sample_action(pattern), {"*"}).update(
+                    re.sub(r"[*?]", "x", resource) for resource in resources
+                )
+    return actions
+
+
+def _organization(modules, paths, master_account_id, full_aws_access=True):
+    # The modules attached to their targets in a planned snapshot with the OU
+    # paths of the diff, evaluated the way the block finder evaluates one
+    snapshot = planned_snapshot(modules, master_account_id, None, full_aws_access)
+    snapshot["parents"] = {
+        child: parent
+        for path in paths.values()
+        for child, parent in zip(path, path[1:])
+    }
+    if full_aws_access:
+        # Also on the levels of the paths that no module is attached to
+        for path in paths.values():
+            for level in path:
+                attachments = snapshot["attachments"].setdefault(level, [])
+                if FULL_AWS_ACCESS_ID not in attachments:
+                    attachments.insert(0, FULL_AWS_ACCESS_ID)
+    return OrganizationSnapshot(snapshot)
+
+
+def diff_policies(
+    before,
+    after,
+    parents=None,
+    full_aws_access=True,
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+):
+    """
+    Returns one change per (target, action, principal pattern, resource) whose
+    verdict differs between the two lists of ScpModules. Conditions on keys
+    other than the principal are assumed to apply.
+    """
+    targets = {t for module in before + after for t in module.targets}
+    paths = {
+        target: path
+        for target, path in target_paths(before + after, parents).items()
+        if target in targets
+    }
+    organizations = [
+        _organization(modules, paths, master_account_id, full_aws_access)
+        for modules in (before, after)
+    ]
+    actions = _actions_and_resources(before + after)
+    principals = sorted(_principal_patterns(before + after)) + [OTHER_PRINCIPAL]
+    changes = []
+    for target in sorted(paths):
+        for principal in principals:
+            request_context = build_request_context(
+                principal_arn=_sample_principal(principal)
+            )
+            for action in sorted(actions):
+                for resource in sorted(actions[action]):
+                    verdicts = [
+                        [
+                            finding.describe()
+                            for finding in evaluate_index(
+                                organization.get_policy_index(target),
+                                action,
+                                resource,
+                                request_context,
+                            )
+                        ]
+                        for organization in organizations
+                    ]
+                    if bool(verdicts[0]) != bool(verdicts[1]):
+                        changes.append(
+                            {
+                                "target": target,
+                                "action": action,
+                                "principal": principal,
+                                "resource": resource,
+                                "before": "denied" if verdicts[0] else "allowed",
+                                "after": "denied" if verdicts[1] else "allowed",
+                                "by": verdicts[0] or verdicts[1],
+                            }
+                        )
+    return changes
+
+
+def summarize(changes):
+    """
+    Returns the changes as text, grouped by target, principal and direction.
+    """
+    if not changes:
+        return "No changes in what the SCPs deny."
+    groups = {}
+    for change in changes:
+        key = (change["target"], change["principal"], change["before"], change["after"])
+        groups.setdefault(key, set()).add(change["action"])
+    newly_denied = sum(1 for change in changes if change["after"] == "denied")
+    lines = [
+        f"{newly_denied} newly denied, {len(changes) - newly_denied} newly allowed"
+    ]
+    for (target, principal, before, after), actions in sorted(groups.items()):
+        principal = "other principals" if principal == OTHER_PRINCIPAL else principal
+        lines.append(
+            f"{target}, {principal}: {before} -> {after}: {', '.join(sorted(actions))}"
+        )
+    return "\n".join(lines)
+
+
+def diff_scps(
+    # The git revision to compare against, e.g. HEAD~1 or a commit ID, or a
+    # bundle directory written by scp_render.py
+    base,
+    # [Optional] The git revision or bundle to compare (Defaults to the working tree)
+    head=None,
+    # [Optional] The directory with scp_define_attach.tf and terraform.tfvars
+    source_dir=SOURCE_DIR,
+    # [Optional] The management account ID to render the templates with
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+    # [Optional] An organization snapshot (see find_blocking_scps/org_snapshot.py)
+    # for the OU tree (Defaults to every OU being directly below the root)
+    snapshot=None,
+    # [Optional] Whether FullAWSAccess is still attached to every target
+    full_aws_access=True,
+    # [Optional] Write the changes as JSON to this file
+    output=None,
+    # [Optional] Write the summary to this file
+    summary=None,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    diff_scps(base="HEAD~1", summary="scp_diff.txt")
+    diff_scps(base="base_bundle", head="scp_bundle")
+    """
+    started = time.perf_counter()
+    parents = None
+    if snapshot:
+        with gzip.open(snapshot, "rt", encoding="utf-8") as snapshot_file:
+            parents = json.load(snapshot_file)["parents"]
+    before = modules_of(base, source_dir, master_account_id)
+    if head:
+        after = modules_of(head, source_dir, master_account_id)
+    else:
+        after = load_modules(source_dir, master_account_id)
+    changes = diff_policies(before, after, parents, full_aws_access, master_account_id)
+    text = summarize(changes)
+    logging.warning(text)
+    logging.info(f"Computed the SCP diff in {time.perf_counter() - started:.2f}s")
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(changes, output_file, indent=2)
+    if summary:
+        with open(summary, "w") as summary_file:
+            summary_file.write(text + "\n")
+    return changes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP effective permission diff")
+    parser.set_defaults(method=diff_scps)
+    parser.add_argument(
+        "--base",
+        type=str,
+        required=True,
+        help="The git revision to compare against, e.g. HEAD~1 or a commit ID, or a bundle directory written by scp_render.py.",
+    )
+    parser.add_argument(
+        "--head",
+        type=str,
+        required=False,
+        help="The git revision or bundle directory to compare. Defaults to the working tree.",
+    )
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=SOURCE_DIR,
+        help="The directory with scp_define_attach.tf and terraform.tfvars.",
+    )
+    parser.add_argument(
+        "--master_account_id",
+        type=str,
+        default=DEFAULT_MASTER_ACCOUNT_ID,
+        help="The management account ID to render the templates with.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        required=False,
+        help="An organization snapshot for the OU tree. Defaults to every OU being directly below the root.",
+    )
+    parser.add_argument(
+        "--without_full_aws_access",
+        dest="full_aws_access",
+        action="store_false",
+        help="FullAWSAccess was replaced by allow-list SCPs.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Write the changes as JSON to this file.",
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        required=False,
+        help="Write the summary to this file.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
@@ -0,0 +1,506 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+from scp_budget import budget_report
+from scp_templates import (
+    DEFAULT_MASTER_ACCOUNT_ID,
+    MAX_POLICY_CHARACTERS,
+    MODULE_PATTERN,
+    SOURCE_DIR,
+    TEMPLATE_PATTERN,
+    load_modules,
+    render_template,
+    terraform_jsonencode,
+)
+from statements import _as_list
+
+# The condition operators the block finder evaluates
+sys.path.insert(0, os.path.join(SOURCE_DIR, "find_blocking_scps"))
+from condition_evaluator import parse_operator  # noqa: E402
+
+"""
+Lints the SCP templates offline, in milliseconds, for the errors that most
+often fail the Access Analyzer stage or the deployment: invalid JSON, unknown
+elements and condition operators, malformed actions and ARNs, placeholders
+that were never replaced, and policies or targets over the SCP quotas.
+"""
+
+POLICY_ELEMENTS = ("Version", "Id", "Statement")
+STATEMENT_ELEMENTS = (
+    "Sid",
+    "Effect",
+    "Action",
+    "NotAction",
+    "Resource",
+    "NotResource",
+    "Condition",
+)
+
+ACTION_PATTERN = re.compile(r"^(\*|[A-Za-z0-9*?-]+:[A-Za-z0-9*?]+)$")
+SID_PATTERN = re.compile(r"^[A-Za-z0-9]*$")
+PARTITIONS = ("aws", "aws-cn", "aws-us-gov", "*")
+ACCOUNT_PATTERN = re.compile(r"^([0-9]{12}|[0-9*?]*[*?][0-9*?]*)$")
+# IAM principal ARNs: arn:partition:iam::account:root, role/path/name or user/path/name
+PRINCIPAL_RESOURCE_PATTERN = re.compile(
+    r"^(root|[*?]+|(role|user|[*?]+)/[A-Za-z0-9_+=,.@/*?-]+)$"
+)
+
+# Placeholders of the example templates, e.g. <PERMISSION SET NAME> or
+# [privilegerole PLACE HOLDER], that have to be replaced before deploying
+PLACEHOLDER_PATTERN = re.compile(
+    r"<[^<>\"\n]*>|\[[^\[\]\"\n]*PLACE ?HOLDER[^\[\]\"\n]*\]|[\w ]*PLACE ?HOLDER[\w ]*",
+    re.I,
+)
+
+PRINCIPAL_KEY = "aws:principalarn"
+
+SEVERITIES = ("ERROR", "WARNING")
+
+
+def _line_of(lines, text):
+    # The first line of the template that contains text, for the report
+    for number, line in enumerate(lines, 1):
+        if text in line:
+            return number
+    return None
+
+
+def _arn_problem(arn, principal=False):
+    """
+    Returns what is wrong with an ARN (pattern), or None.
+    """
+    if arn == "*":
+        return None
+    segments = arn.split(":", 5)
+    if len(segments) != 6 or segments[0] != "arn":
+        return "does not have the form arn:partition:service:region:account:resource"
+    _, partition, service, region, account, resource = segments
+    if partition not in PARTITIONS:
+        return f"has an unknown partition {partition}"
+    if not resource:
+        return "has no resource"
+    if " " in arn:
+        return "contains spaces"
+    if not principal:
+        return None
+    if service not in ("iam", "*"):
+        return f"is not an IAM principal ARN (service {service})"
+    if region not in ("", "*"):
+        return "has a region, IAM ARNs have none"
+    if not ACCOUNT_PATTERN.match(account):
+        return f"has an invalid account ID {account}"
+    if not PRINCIPAL_RESOURCE_PATTERN.match(resource):
+        return f"has an invalid principal {resource}"
+    return None
+
+
+def _lint_condition(condition, label):
+    problems = []
+    if not isinstance(condition, dict):
+        return [("ERROR", "condition", f"{label}: Condition is not an object", None)]
+    for operator, keys in condition.items():
+        try:
+            _, base_operator, _ = parse_operator(operator)
+        except ValueError:
+            problems.append(
+                (
+                    "ERROR",
+                    "unknown-operator",
+                    f"{label}: unknown condition operator {operator}",
+                    f'"{operator}"',
+                )
+            )
+            continue
+        if not isinstance(keys, dict) or not keys:
+            problems.append(
+                (
+                    "ERROR",
+                    "condition",
+                    f"{label}: {operator} has no condition keys",
+                    f'"{operator}"',
+                )
+            )
+            continue
+        for key, values in keys.items():
+            values = _as_list(values)
+            if not values or not all(
+                isinstance(value, (str, bool, int, float)) for value in values
+            ):
+                problems.append(
+                    (
+                        "ERROR",
+                        "condition-value",
+                        f"{label}: {operator} {key} needs one or more strings, numbers or booleans",
+                        f'"{key}"',
+                    )
+                )
+                continue
+            principal = key.lower() == PRINCIPAL_KEY
+            if not (base_operator.startswith("Arn") or principal):
+                continue
+            for value in values:
+                if PLACEHOLDER_PATTERN.search(str(value)):
+                    # Reported as a placeholder
+                    continue
+                problem = _arn_problem(str(value), principal)
+                if problem:
+                    problems.append(
+                        (
+                            "ERROR",
+                            "malformed-principal-arn" if principal else "malformed-arn",
+                            f"{label}: {key} value {value} {problem}",
+                            str(value),
+                        )
+                    )
+    return problems
+
+
+def lint_document(document):
+    """
+    Returns the problems of an SCP document as (severity, check, message,
+    text to locate in the template) tuples.
+    """
+    if not isinstance(document, dict):
+        return [("ERROR", "policy", "The policy is not a JSON object", None)]
+    problems = []
+    for element in document:
+        if element not in POLICY_ELEMENTS:
+            problems.append(
+                ("ERROR", "unknown-element", f"Unknown element {element}", element)
+            )
+    if document.get("Version") != "2012-10-17":
+        problems.append(
+            ("ERROR", "version", 'Version has to be "2012-10-17"', '"Version"')
+        )
+    statements = document.get("Statement")
+    if not statements or not isinstance(statements, (list, dict)):
+        problems.append(("ERROR", "statement", "The policy has no statements", None))
+        return problems
+    sids = set()
+    for index, statement in enumerate(_as_list(statements)):
+        if not isinstance(statement, dict):
+            problems.append(
+                ("ERROR", "statement", f"Statement {index} is not an object", None)
+            )
+            continue
+        sid = statement.get("Sid", "")
+        label = sid or f"Statement {index}"
+        locate = f'"{sid}"' if sid else None
+        if not isinstance(sid, str) or not SID_PATTERN.match(sid):
+            problems.append(
+                ("ERROR", "sid", f"{label}: Sids can only be alphanumeric", locate)
+            )
+        elif sid and sid in sids:
+            problems.append(("ERROR", "sid", f"{label}: duplicate Sid", locate))
+        sids.add(sid)
+        for element in statement:
+            if element in ("Principal", "NotPrincipal"):
+                problems.append(
+                    (
+                        "ERROR",
+                        "unknown-element",
+                        f"{label}: SCPs don't support {element}",
+                        f'"{element}"',
+                    )
+                )
+            elif element not in STATEMENT_ELEMENTS:
+                problems.append(
+                    (
+                        "ERROR",
+                        "unknown-element",
+                        f"{label}: unknown element {element}",
+                        f'"{element}"',
+                    )
+                )
+        if statement.get("Effect") not in ("Allow", "Deny"):
+            problems.append(
+                ("ERROR", "effect", f"{label}: Effect has to be Allow or Deny", locate)
+            )
+        if ("Action" in statement) == ("NotAction" in statement):
+            problems.append(
+                (
+                    "ERROR",
+                    "action",
+                    f"{label}: needs exactly one of Action and NotAction",
+                    locate,
+                )
+            )
+        actions = _as_list(statement.get("Action", statement.get("NotAction")))
+        for action in actions:
+            if not isinstance(action, str) or not ACTION_PATTERN.match(action):
+                problems.append(
+                    (
+                        "ERROR",
+                        "malformed-action",
+                        f"{label}: malformed action {action}",
+                        str(action),
+                    )
+                )
+        if ("Resource" in statement) == ("NotResource" in statement):
+            problems.append(
+                (
+                    "ERROR",
+                    "resource",
+                    f"{label}: needs exactly one of Resource and NotResource",
+                    locate,
+                )
+            )
+        for resource in _as_list(
+            statement.get("Resource", statement.get("NotResource"))
+        ):
+            if PLACEHOLDER_PATTERN.search(str(resource)):
+                continue
+            problem = _arn_problem(str(resource))
+            if problem:
+                problems.append(
+                    (
+                        "ERROR",
+                        "malformed-arn",
+                        f"{label}: resource {resource} {problem}",
+                        str(resource),
+                    )
+                )
+        if "Condition" in statement:
+            problems.extend(_lint_condition(statement["Condition"], label))
+        elif (
+            statement.get("Effect") == "Deny"
+            and "*" in actions
+            and statement.get("Resource") in ("*", ["*"])
+        ):
+            problems.append(
+                (
+                    "WARNING",
+                    "deny-all",
+                    f"{label}: denies every action on every resource to every principal",
+                    locate,
+                )
+            )
+    return problems
+
+
+def lint_template(
+    template, source_dir=SOURCE_DIR, master_account_id=DEFAULT_MASTER_ACCOUNT_ID
+):
+    """
+    Returns the findings of one template, given relative to the source
+    directory.
+    """
+    path = os.path.join(source_dir, template)
+    with open(path) as template_file:
+        lines = template_file.read().splitlines()
+
+    def finding(severity, check, message, line=None):
+        return {
+            "template": template,
+            "line": line,
+            "severity": severity,
+            "check": check,
+            "message": message,
+        }
+
+    findings = []
+    for number, line in enumerate(lines, 1):
+        for placeholder in PLACEHOLDER_PATTERN.findall(line):
+            findings.append(
+                finding(
+                    "ERROR",
+                    "placeholder",
+                    f"Replace the placeholder {placeholder.strip()}",
+                    number,
+                )
+            )
+    try:
+        rendered = render_template(path, {"master_account_id": master_account_id})
+    except ValueError as error:
+        return findings + [finding("ERROR", "render", str(error))]
+    try:
+        document = json.loads(rendered)
+    except json.JSONDecodeError as error:
+        return findings + [
+            finding("ERROR", "json", f"Invalid JSON: {error.msg}", error.lineno)
+        ]
+    for severity, check, message, text in lint_document(document):
+        findings.append(
+            finding(severity, check, message, text and _line_of(lines, text))
+        )
+    size = len(terraform_jsonencode(document))
+    if size >= MAX_POLICY_CHARACTERS:
+        findings.append(
+            finding(
+                "ERROR",
+                "policy-size",
+                f"The policy is {size} characters long, the quota is {MAX_POLICY_CHARACTERS}",
+            )
+        )
+    return findings
+
+
+def module_templates(source_dir=SOURCE_DIR):
+    """
+    Returns the templates the modules of scp_define_attach.tf use, relative to
+    the source directory.
+    """
+    with open(os.path.join(source_dir, "scp_define_attach.tf")) as tf_file:
+        text = tf_file.read()
+    templates = []
+    for _, body in MODULE_PATTERN.findall(text):
+        template = TEMPLATE_PATTERN.search(body)
+        if template:
+            templates.append(os.path.normpath(template.group(1)))
+    return templates
+
+
+def lint_templates(
+    templates=None,
+    source_dir=SOURCE_DIR,
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+    full_aws_access=True,
+):
+    """
+    Returns the findings of the templates, relative to the source directory
+    (Defaults to every template), and of the SCP slots of every target.
+    """
+    used = module_templates(source_dir)
+    if templates is None:
+        templates = sorted(
+            set(used)
+            | {
+                os.path.relpath(path, source_dir)
+                for path in glob.glob(
+                    os.path.join(source_dir, "service_control_policies", "**", "*.tpl"),
+                    recursive=True,
+                )
+            }
+        )
+    findings = []
+    for template in templates:
+        template = os.path.normpath(template)
+        findings.extend(lint_template(template, source_dir, master_account_id))
+        if template not in used:
+            findings.append(
+                {
+                    "template": template,
+                    "line": None,
+                    "severity": "WARNING",
+                    "check": "unused-template",
+                    "message": "No module in scp_define_attach.tf uses the template",
+                }
+            )
+    try:
+        modules = load_modules(source_dir, master_account_id)
+    except ValueError:
+        # Already reported for the template
+        return findings
+    report = budget_report(modules, full_aws_access)
+    for target_id, target in report["targets"].items():
+        if target["free_slots"] < 0:
+            findings.append(
+                {
+                    "template": "scp_define_attach.tf",
+                    "line": None,
+                    "severity": "ERROR",
+                    "check": "target-quota",
+                    "message": f"{target_id} has {len(target['scps'])} SCPs attached ({', '.join(target['scps'])}), the quota is {len(target['scps']) + target['free_slots']}",
+                }
+            )
+    return findings
+
+
+def lint_scps(
+    # [Optional] Only lint these templates (Defaults to every template)
+    templates=None,
+    # [Optional] Severities that fail the lint
+    fail_on=("ERROR",),
+    # [Optional] Write the findings as JSON to this file
+    output=None,
+    # [Optional] The directory with scp_define_attach.tf and terraform.tfvars
+    source_dir=SOURCE_DIR,
+    # [Optional] The management account ID to render the templates with
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+    # [Optional] Whether FullAWSAccess is still attached to every target
+    full_aws_access=True,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    lint_scps()
+    lint_scps(templates=["service_control_policies/Root/Data_Baseline_Root.json.tpl"])
+    """
+    started = time.perf_counter()
+    if templates:
+        # Given relative to the working directory, e.g. by pre-commit
+        templates = [
+            os.path.relpath(os.path.abspath(template), source_dir)
+            for template in templates
+        ]
+    findings = lint_templates(templates, source_dir, master_account_id, full_aws_access)
+    for finding in findings:
+        location = finding["template"]
+        if finding["line"]:
+            location += f":{finding['line']}"
+        logging.warning(
+            f"{location}: {finding['severity']} {finding['check']}: {finding['message']}"
+        )
+    failed = sum(finding["severity"] in fail_on for finding in findings)
+    logging.warning(
+        f"{len(findings)} findings, {failed} of them failing, in {(time.perf_counter() - started) * 1000:.0f}ms."
+    )
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(findings, output_file, indent=2)
+    if failed:
+        raise SystemExit(1)
+    return findings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP template linter")
+    parser.set_defaults(method=lint_scps)
+    parser.add_argument(
+        "templates",
+        type=str,
+        nargs="*",
+        help="Only lint these templates. Defaults to every template.",
+    )
+    parser.add_argument(
+        "--fail_on",
+        type=str,
+        nargs="+",
+        default=["ERROR"],
+        choices=SEVERITIES,
+        help="Severities that fail the lint (default ERROR).",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Write the findings as JSON to this file.",
+    )
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=SOURCE_DIR,
+        help="The directory with scp_define_attach.tf and terraform.tfvars.",
+    )
+    parser.add_argument(
+        "--master_account_id",
+        type=str,
+        default=DEFAULT_MASTER_ACCOUNT_ID,
+        help="The management account ID to render the templates with.",
+    )
+    parser.add_argument(
+        "--without_full_aws_access",
+        dest="full_aws_access",
+        action="store_false",
+        help="FullAWSAccess was replaced by allow-list SCPs.",
+    )
+    args = parser.parse_args()
+    args.templates = args.templates or None
+    args.method(**vars(args))
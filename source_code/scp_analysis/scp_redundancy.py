@@ -0,0 +1,273 @@
+import argparse
+import gzip
+import json
+import logging
+
+from scp_render import load_rendered
+from scp_templates import (
+    DEFAULT_MASTER_ACCOUNT_ID,
+    SOURCE_DIR,
+    terraform_jsonencode,
+)
+from statements import CanonicalStatement, _as_list
+
+"""
+Finds SCP statements that can be dropped or merged without changing what is
+denied, along every OU path the SCPs are attached to:
+
+- duplicate: another statement on the path has exactly the same effect
+- subsumed: another statement on the path denies everything this one does
+- redundant actions: some of the statement's actions are already denied by
+  other statements on the path
+- mergeable: statements of one SCP with the same effect, resources and
+  Condition block that can be written as one statement
+"""
+
+# How each type of finding is reported
+FINDING_VERBS = {
+    "duplicate": "is a duplicate",
+    "subsumed": "is subsumed",
+    "redundant actions": "has redundant actions",
+    "mergeable": "can be merged",
+}
+
+
+def target_paths(modules, parents=None):
+    """
+    Returns the OU path (the target followed by its ancestors) of every target
+    that an SCP is attached to. Without the parents of a snapshot, every OU is
+    assumed to be directly below the root.
+    """
+    targets = {target for module in modules for target in module.targets}
+    roots = sorted(target for target in targets if target.startswith("r-"))
+    paths = {}
+    for target in sorted(targets):
+        path = [target]
+        if parents:
+            while path[-1] in parents:
+                path.append(parents[path[-1]])
+        elif not target.startswith("r-"):
+            path.extend(roots)
+        paths[target] = path
+    return paths
+
+
+def path_statements(modules, path):
+    """
+    Returns the canonical statements of the SCPs attached along a path, from
+    the root down, with the depth of the level they are attached at.
+    """
+    statements = []
+    for depth, target in enumerate(reversed(path)):
+        for module in modules:
+            if target in module.targets:
+                for index, statement in enumerate(
+                    _as_list(module.document["Statement"])
+                ):
+                    statements.append(
+                        (depth, CanonicalStatement(statement, module.scp_name, index))
+                    )
+    return statements
+
+
+def _redundancies(statements):
+    # Yields (finding type, statement, covering statements, actions) for the
+    # Deny statements of one path. Of two statements that cover each other,
+    # the one attached higher up (or listed first) is kept.
+    order = {
+        id(statement): position for position, (_, statement) in enumerate(statements)
+    }
+    denies = [statement for _, statement in statements if statement.effect == "Deny"]
+    for statement in denies:
+        others = [other for other in denies if other is not statement]
+        for other in others:
+            if not other.covers(statement):
+                continue
+            if statement.covers(other) and order[id(other)] > order[id(statement)]:
+                continue
+            finding = "duplicate" if other.key() == statement.key() else "subsumed"
+            yield finding, statement, [other], list(statement.actions)
+            break
+        else:
+            if statement.not_action:
+                continue
+            covered = {}
+            for action in statement.actions:
+                for other in others:
+                    if other.applies_wherever(statement) and other.covers_action(
+                        action
+                    ):
+                        covered[action] = other
+                        break
+            if covered:
+                yield "redundant actions", statement, list(
+                    {id(o): o for o in covered.values()}.values()
+                ), sorted(covered)
+
+
+def _mergeable(modules):
+    # Statements of one SCP that only differ in their actions
+    for module in modules:
+        groups = {}
+        for index, statement in enumerate(_as_list(module.document["Statement"])):
+            canonical = CanonicalStatement(statement, module.scp_name, index)
+            if canonical.not_action:
+                continue
+            groups.setdefault(
+                (
+                    canonical.effect,
+                    canonical.not_resource,
+                    canonical.resources,
+                    canonical.condition_key,
+                ),
+                [],
+            ).append(canonical)
+        for group in groups.values():
+            if len(group) < 2:
+                continue
+            merged = dict(group[0].statement)
+            merged["Action"] = sorted(
+                {
+                    a
+                    for statement in group
+                    for a in _as_list(statement.statement["Action"])
+                }
+            )
+            saved = sum(
+                len(terraform_jsonencode(statement.statement)) + 1
+                for statement in group
+            ) - (len(terraform_jsonencode(merged)) + 1)
+            yield group, saved
+
+
+def find_redundancies(modules, parents=None):
+    """
+    Returns the findings for all paths. A statement is removable if it is
+    redundant on the path of every target its SCP is attached to.
+    """
+    paths = target_paths(modules, parents)
+    attached = {module.scp_name: module.targets for module in modules}
+    findings = {}
+    for target, path in paths.items():
+        for finding, statement, covering, actions in _redundancies(
+            path_statements(modules, path)
+        ):
+            key = (finding, statement.describe(), tuple(actions))
+            entry = findings.setdefault(
+                key,
+                {
+                    "type": finding,
+                    "statement": statement.describe(),
+                    "covered_by": [other.describe() for other in covering],
+                    "actions": actions,
+                    "targets": [],
+                    "_statement": statement,
+                },
+            )
+            entry["targets"].append(target)
+    results = []
+    for entry in findings.values():
+        statement = entry.pop("_statement")
+        entry["removable"] = set(entry["targets"]) >= set(attached[statement.scp_name])
+        if entry["type"] == "redundant actions":
+            entry["saved_characters"] = sum(len(a) + 3 for a in entry["actions"])
+        else:
+            entry["saved_characters"] = (
+                len(terraform_jsonencode(statement.statement)) + 1
+            )
+        results.append(entry)
+    for group, saved in _mergeable(modules):
+        results.append(
+            {
+                "type": "mergeable",
+                "statement": group[0].describe(),
+                "covered_by": [statement.describe() for statement in group[1:]],
+                "actions": [],
+                "targets": attached[group[0].scp_name],
+                "removable": True,
+                "saved_characters": saved,
+            }
+        )
+    return results
+
+
+def check_scp_redundancy(
+    # [Optional] A bundle written by scp_render.py (Defaults to rendering the templates)
+    bundle=None,
+    # [Optional] The directory with scp_define_attach.tf and terraform.tfvars
+    source_dir=SOURCE_DIR,
+    # [Optional] The management account ID to render the templates with
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+    # [Optional] An organization snapshot (see find_blocking_scps/org_snapshot.py)
+    # for the OU tree (Defaults to every OU being directly below the root)
+    snapshot=None,
+    # [Optional] Write the findings as JSON to this file
+    output=None,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    check_scp_redundancy(snapshot="org.snapshot.json.gz")
+    """
+    parents = None
+    if snapshot:
+        with gzip.open(snapshot, "rt", encoding="utf-8") as snapshot_file:
+            parents = json.load(snapshot_file)["parents"]
+    modules = load_rendered(bundle, source_dir, master_account_id)
+    findings = find_redundancies(modules, parents)
+    for finding in findings:
+        message = f"{finding['statement']} {FINDING_VERBS[finding['type']]}"
+        if finding["type"] == "mergeable":
+            message += f" with {', '.join(finding['covered_by'])}"
+        else:
+            message += f" (by {', '.join(finding['covered_by'])})"
+            if finding["type"] == "redundant actions":
+                message += f": {', '.join(finding['actions'])}"
+            message += f" on {', '.join(finding['targets'])}"
+            if not finding["removable"]:
+                message += ", but not on every target of its SCP"
+        logging.warning(f"{message}. Saves {finding['saved_characters']} characters.")
+    if not findings:
+        logging.warning("No redundant statements found.")
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(findings, output_file, indent=2)
+    return findings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP statement redundancy checks")
+    parser.set_defaults(method=check_scp_redundancy)
+    parser.add_argument(
+        "--bundle",
+        type=str,
+        required=False,
+        help="A bundle written by scp_render.py. Defaults to rendering the templates.",
+    )
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=SOURCE_DIR,
+        help="The directory with scp_define_attach.tf and terraform.tfvars.",
+    )
+    parser.add_argument(
+        "--master_account_id",
+        type=str,
+        default=DEFAULT_MASTER_ACCOUNT_ID,
+        help="The management account ID to render the templates with.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        required=False,
+        help="An organization snapshot for the OU tree. Defaults to every OU being directly below the root.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Write the findings as JSON to this file.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
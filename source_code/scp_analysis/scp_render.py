@@ -0,0 +1,356 @@
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+
+from scp_templates import (
+    DEFAULT_MASTER_ACCOUNT_ID,
+    SOURCE_DIR,
+    ScpModule,
+    load_modules,
+    render_policy,
+)
+
+"""
+Renders every SCP template at once and writes the policies as a
+content-addressed bundle, so that the analyzers, the diff and the block finder
+all read the same rendered policies without rendering them again and without a
+terraform init and plan.
+
+Every .json.tpl file below service_control_policies is rendered with
+master_account_id, validated as JSON and encoded the way Terraform sends it to
+AWS (minified, object keys in lexical order). A bundle is a directory:
+
+    manifest.json               the modules of scp_define_attach.tf, their
+                                targets and the hash of their policy
+    policies/<sha256>.json      every rendered policy, named by its hash
+
+Rendering the same templates again writes the same files, and a policy file
+that is already in the bundle directory is not written again.
+"""
+
+BUNDLE_FORMAT_VERSION = 1
+
+MANIFEST_FILE = "manifest.json"
+POLICIES_DIR = "policies"
+
+TEMPLATES_DIR = "service_control_policies"
+TEMPLATE_SUFFIX = ".json.tpl"
+
+# Stands for the organization when a planned snapshot has no base snapshot
+DEFAULT_ORG_ID = "o-bundle"
+
+FULL_AWS_ACCESS_ID = "p-FullAWSAccess"
+
+
+def policy_hash(content):
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def template_paths(source_dir=SOURCE_DIR):
+    """
+    Returns the path of every template below service_control_policies,
+    relative to the source directory, in order.
+    """
+    paths = []
+    for directory, _, files in os.walk(os.path.join(source_dir, TEMPLATES_DIR)):
+        for name in files:
+            if name.endswith(TEMPLATE_SUFFIX):
+                paths.append(os.path.relpath(os.path.join(directory, name), source_dir))
+    return sorted(paths)
+
+
+def render_policies(source_dir=SOURCE_DIR, master_account_id=DEFAULT_MASTER_ACCOUNT_ID):
+    """
+    Returns every template rendered and encoded like Terraform does, by
+    template path. Raises ValueError with the problems of every template that
+    doesn't render to valid JSON.
+    """
+    policies = {}
+    problems = []
+    for template in template_paths(source_dir):
+        try:
+            policies[template] = render_policy(source_dir, template, master_account_id)
+        except ValueError as error:
+            problems.append(str(error))
+    if problems:
+        raise ValueError("\n".join(problems))
+    return policies
+
+
+def build_manifest(modules, policies, master_account_id):
+    """
+    Returns the manifest of a bundle. Its bundle_id is a hash of everything
+    else in it, so two bundles with the same ID deploy the same SCPs.
+    """
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "master_account_id": master_account_id,
+        "templates": {
+            template: policy_hash(content) for template, content in policies.items()
+        },
+        "modules": [
+            {
+                "module_name": module.module_name,
+                "scp_name": module.scp_name,
+                "description": module.description,
+                "template": module.template,
+                "targets": module.targets,
+                "policy": policy_hash(module.content),
+                "size": module.size,
+            }
+            for module in modules
+        ],
+    }
+    manifest["bundle_id"] = hashlib.sha256(
+        json.dumps(manifest, sort_keys=True).encode()
+    ).hexdigest()
+    return manifest
+
+
+def write_bundle(modules, policies, master_account_id, bundle):
+    """
+    Writes the rendered policies and the manifest to the bundle directory and
+    returns the manifest.
+    """
+    manifest = build_manifest(modules, policies, master_account_id)
+    os.makedirs(os.path.join(bundle, POLICIES_DIR), exist_ok=True)
+    contents = list(policies.values()) + [module.content for module in modules]
+    for content in contents:
+        path = os.path.join(bundle, POLICIES_DIR, f"{policy_hash(content)}.json")
+        if not os.path.exists(path):
+            with open(path, "w", encoding="utf-8") as policy_file:
+                policy_file.write(content)
+    # The manifest is written last, so a bundle with a manifest is complete
+    manifest_path = os.path.join(bundle, MANIFEST_FILE)
+    with open(f"{manifest_path}.tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    return manifest
+
+
+def read_manifest(bundle):
+    with open(os.path.join(bundle, MANIFEST_FILE)) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported bundle format version {manifest.get('format_version')}"
+        )
+    return manifest
+
+
+def is_bundle(path):
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def load_bundle(bundle):
+    """
+    Returns the ScpModule of every module in a bundle, in the order of
+    scp_define_attach.tf. Raises ValueError if a policy doesn't match its hash.
+    """
+    manifest = read_manifest(bundle)
+    contents = {}
+    modules = []
+    for entry in manifest["modules"]:
+        digest = entry["policy"]
+        if digest not in contents:
+            path = os.path.join(bundle, POLICIES_DIR, f"{digest}.json")
+            with open(path, encoding="utf-8") as policy_file:
+                contents[digest] = policy_file.read()
+            if policy_hash(contents[digest]) != digest:
+                raise ValueError(f"{path} doesn't match its hash")
+        modules.append(
+            ScpModule(
+                entry["module_name"],
+                entry["scp_name"],
+                entry["template"],
+                entry["targets"],
+                contents[digest],
+                entry["description"],
+            )
+        )
+    return modules
+
+
+def load_rendered(
+    bundle=None, source_dir=SOURCE_DIR, master_account_id=DEFAULT_MASTER_ACCOUNT_ID
+):
+    """
+    Returns the ScpModules of a bundle, or renders them from the source
+    directory without a bundle.
+    """
+    if bundle:
+        return load_bundle(bundle)
+    return load_modules(source_dir, master_account_id)
+
+
+def planned_snapshot(modules, master_account_id, base=None, full_aws_access=True):
+    """
+    Returns an organization snapshot (see scp_block_finder.OrganizationSnapshot)
+    with the SCPs of the modules attached to their targets. The SCPs of a base
+    snapshot with the same names as the modules are replaced, its OU tree and
+    other SCPs are kept. Without a base snapshot, every OU and account is
+    directly below the root and FullAWSAccess is attached everywhere.
+    """
+    # The snapshot format of the block finder, imported here because the block
+    # finder needs boto3, which the linter (through scp_budget) runs without
+    sys.path.insert(0, os.path.join(SOURCE_DIR, "find_blocking_scps"))
+    from scp_block_finder import SNAPSHOT_FORMAT_VERSION
+
+    if base is None:
+        targets = {target for module in modules for target in module.targets}
+        roots = sorted(target for target in targets if target.startswith("r-"))
+        snapshot = {
+            "org_id": DEFAULT_ORG_ID,
+            "parents": {
+                target: roots[0]
+                for target in sorted(targets)
+                if roots and not target.startswith("r-")
+            },
+            "attachments": {},
+            "policies": {},
+        }
+        if full_aws_access:
+            snapshot["policies"][FULL_AWS_ACCESS_ID] = {
+                "name": "FullAWSAccess",
+                "arn": "arn:aws:organizations::aws:policy/service_control_policy/p-FullAWSAccess",
+                "content": json.dumps(
+                    {
+                        "Version": "2012-10-17",
+                        "Statement": [
+                            {"Effect": "Allow", "Action": "*", "Resource": "*"}
+                        ],
+                    }
+                ),
+            }
+            snapshot["attachments"] = {
+                target: [FULL_AWS_ACCESS_ID] for target in sorted(targets)
+            }
+    else:
+        managed = {module.scp_name for module in modules}
+        replaced = {
+            policy_id
+            for policy_id, policy in base["policies"].items()
+            if policy["name"] in managed
+        }
+        snapshot = {
+            "org_id": base["org_id"],
+            "parents": base["parents"],
+            "attachments": {
+                target: [policy_id for policy_id in ids if policy_id not in replaced]
+                for target, ids in base["attachments"].items()
+            },
+            "policies": {
+                policy_id: policy
+                for policy_id, policy in base["policies"].items()
+                if policy_id not in replaced
+            },
+        }
+    for module in modules:
+        policy_id = "p-" + hashlib.sha256(module.module_name.encode()).hexdigest()[:16]
+        snapshot["policies"][policy_id] = {
+            "name": module.scp_name,
+            "arn": f"arn:aws:organizations::{master_account_id}:policy/"
+            f"{snapshot['org_id']}/service_control_policy/{policy_id}",
+            "content": module.content,
+        }
+        for target in module.targets:
+            snapshot["attachments"].setdefault(target, []).append(policy_id)
+    return {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        **snapshot,
+    }
+
+
+def render_scps(
+    # The bundle directory to write
+    output,
+    # [Optional] The directory with scp_define_attach.tf and terraform.tfvars
+    source_dir=SOURCE_DIR,
+    # [Optional] The management account ID to render the templates with
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+    # [Optional] Also write an organization snapshot with the rendered SCPs
+    # attached, for the block finder's --snapshot
+    snapshot_output=None,
+    # [Optional] The organization snapshot (see find_blocking_scps/org_snapshot.py)
+    # to attach the rendered SCPs to (Defaults to every OU being directly below the root)
+    snapshot=None,
+    # [Optional] Whether FullAWSAccess is still attached to every target
+    full_aws_access=True,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    render_scps(output="scp_bundle")
+    render_scps(output="scp_bundle", snapshot="org.snapshot.json.gz", snapshot_output="planned.snapshot.json.gz")
+    """
+    policies = render_policies(source_dir, master_account_id)
+    modules = load_modules(source_dir, master_account_id, policies)
+    manifest = write_bundle(modules, policies, master_account_id, output)
+    logging.warning(
+        f"Rendered {len(policies)} templates for {len(modules)} SCPs "
+        f"into {output} (bundle {manifest['bundle_id'][:12]})"
+    )
+    if snapshot_output:
+        base = None
+        if snapshot:
+            with gzip.open(snapshot, "rt", encoding="utf-8") as snapshot_file:
+                base = json.load(snapshot_file)
+        with gzip.open(snapshot_output, "wt", encoding="utf-8") as snapshot_file:
+            json.dump(
+                planned_snapshot(modules, master_account_id, base, full_aws_access),
+                snapshot_file,
+                separators=(",", ":"),
+                sort_keys=True,
+            )
+        logging.warning(f"Wrote the planned organization snapshot to {snapshot_output}")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP template renderer")
+    parser.set_defaults(method=render_scps)
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="The bundle directory to write.",
+    )
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=SOURCE_DIR,
+        help="The directory with scp_define_attach.tf and terraform.tfvars.",
+    )
+    parser.add_argument(
+        "--master_account_id",
+        type=str,
+        default=DEFAULT_MASTER_ACCOUNT_ID,
+        help="The management account ID to render the templates with.",
+    )
+    parser.add_argument(
+        "--snapshot_output",
+        type=str,
+        required=False,
+        help="Also write an organization snapshot with the rendered SCPs attached, for the block finder's --snapshot.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        required=False,
+        help="The organization snapshot to attach the rendered SCPs to. Defaults to every OU being directly below the root.",
+    )
+    parser.add_argument(
+        "--without_full_aws_access",
+        dest="full_aws_access",
+        action="store_false",
+        help="FullAWSAccess was replaced, so it isn't attached in the planned snapshot.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
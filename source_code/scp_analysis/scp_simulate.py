@@ -0,0 +1,365 @@
+import argparse
+import glob
+import gzip
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from scp_render import load_rendered, planned_snapshot, read_manifest
+from scp_templates import (
+    DEFAULT_MASTER_ACCOUNT_ID,
+    SOURCE_DIR,
+    read_tfvars,
+    render_template,
+)
+
+# The compiled policy matcher of the block finder
+sys.path.insert(0, os.path.join(SOURCE_DIR, "find_blocking_scps"))
+from scp_block_finder import (  # noqa: E402
+    ImplicitDeny,
+    OrganizationSnapshot,
+    build_request_context,
+    evaluate_index,
+)
+
+"""
+Runs the policy test suites next to the SCP templates: every case names a
+request (target, principal, action, resource and condition keys) and whether
+the SCPs deny it, and optionally by which SCP or statement.
+
+Suites are JSON files ending in .tests.json below service_control_policies,
+rendered with master_account_id like the templates:
+
+{
+    "description": "Only the network pipelines change VPCs",
+    "defaults": {"target": "var.infrastructure_id", "resource": "*"},
+    "accounts": {"111122223333": "var.infrastructure_id"},
+    "cases": [
+        {
+            "name": "Workload role can't delete a VPC",
+            "target": "111122223333",
+            "principal_arn": "arn:aws:iam::111122223333:role/Developer",
+            "action": "ec2:DeleteVpc",
+            "expect": "denied",
+            "denied_by": "Infrastructure_Baseline_Root/PreventVPCActionsinAllOUswithWhitelist"
+        }
+    ]
+}
+
+A target is a root, OU or account ID, or var.<name> of terraform.tfvars; a
+list variable runs the case for every ID in it. "accounts" places accounts
+below a root or OU for the run. denied_by names SCPs, SCP/Sid statements or
+"implicit", each of which has to be among the reasons for the denial.
+
+The rendered SCPs are attached to their targets in terraform.tfvars (or in an
+organization snapshot), and every case is evaluated against that snapshot by
+the block finder's OrganizationSnapshot, as a --snapshot query would be.
+Large runs are split into shards that are evaluated on every CPU core.
+"""
+
+SUITE_PATTERN = "service_control_policies/**/*.tests.json"
+
+CASE_FIELDS = (
+    "name",
+    "target",
+    "action",
+    "resource",
+    "region",
+    "principal_arn",
+    "account",
+    "context",
+    "expect",
+    "denied_by",
+)
+
+EXPECTATIONS = ("denied", "allowed")
+
+# Runs with fewer cases are evaluated in this process, starting workers takes longer
+MIN_PARALLEL_CASES = 500
+
+# Shards per worker, so that a slow shard doesn't hold up the whole run
+SHARDS_PER_WORKER = 4
+
+# The OrganizationSnapshot of the planned SCPs, per process
+_worker = {}
+
+
+def _resolve(value, tfvars):
+    # A var.<name> of terraform.tfvars becomes its value
+    if isinstance(value, str) and value.startswith("var."):
+        name = value[len("var.") :]
+        if name not in tfvars:
+            raise ValueError(f"{value} is not defined in terraform.tfvars")
+        return tfvars[name]
+    return value
+
+
+def read_suite(
+    path, source_dir=SOURCE_DIR, master_account_id=DEFAULT_MASTER_ACCOUNT_ID
+):
+    """
+    Returns the suite at path as (accounts, cases), with the defaults applied
+    and the targets resolved, one case per target.
+    """
+    name = os.path.relpath(path, source_dir)
+    if name.startswith(os.pardir):
+        name = path
+    try:
+        suite = json.loads(
+            render_template(path, {"master_account_id": master_account_id})
+        )
+    except json.JSONDecodeError as error:
+        raise ValueError(f"{name} is not valid JSON: {error}") from None
+    tfvars = read_tfvars(os.path.join(source_dir, "terraform.tfvars"))
+    accounts = {}
+    for account, parent in suite.get("accounts", {}).items():
+        accounts[account] = _resolve(parent, tfvars)
+        if not isinstance(accounts[account], str):
+            raise ValueError(f"{name}: account {account} needs a single parent")
+    cases = []
+    for number, case in enumerate(suite.get("cases", []), 1):
+        case = {**suite.get("defaults", {}), **case}
+        unknown = sorted(set(case) - set(CASE_FIELDS))
+        if unknown:
+            raise ValueError(
+                f"{name}, case {number}: unknown fields {', '.join(unknown)}"
+            )
+        if case.get("expect") not in EXPECTATIONS:
+            raise ValueError(
+                f"{name}, case {number}: expect has to be {' or '.join(EXPECTATIONS)}"
+            )
+        if not case.get("target") or not case.get("action"):
+            raise ValueError(f"{name}, case {number}: target and action are required")
+        denied_by = case.get("denied_by", [])
+        case["denied_by"] = [denied_by] if isinstance(denied_by, str) else denied_by
+        targets = _resolve(case["target"], tfvars)
+        for target in targets if isinstance(targets, list) else [targets]:
+            cases.append(
+                {
+                    **case,
+                    "suite": name,
+                    "name": case.get("name") or f"case {number}",
+                    "target": target,
+                    "resource": case.get("resource") or "*",
+                }
+            )
+    return accounts, cases
+
+
+def find_suites(source_dir=SOURCE_DIR):
+    return sorted(glob.glob(os.path.join(source_dir, SUITE_PATTERN), recursive=True))
+
+
+def _init_worker(snapshot):
+    # The organization is built once per process, so that every case of the
+    # process reuses the compiled SCPs and the PolicyIndex of its target
+    _worker["organization"] = OrganizationSnapshot(snapshot)
+
+
+def _explains(expected, finding):
+    if expected == "implicit":
+        return isinstance(finding, ImplicitDeny)
+    if isinstance(finding, ImplicitDeny):
+        return False
+    return expected in (finding.policy_name, finding.describe())
+
+
+def run_case(case):
+    """
+    Evaluates one case in this process's organization and returns its result.
+    """
+    result = {
+        field: case[field]
+        for field in ("suite", "name", "target", "action", "resource", "expect")
+    }
+    organization = _worker["organization"]
+    try:
+        findings = evaluate_index(
+            organization.get_policy_index(case["target"]),
+            case["action"],
+            case["resource"],
+            build_request_context(
+                case.get("region", ""),
+                case.get("principal_arn", ""),
+                case.get("account")
+                or (case["target"] if case["target"].isdigit() else ""),
+                organization.org_id,
+                context=case.get("context"),
+                complete=True,
+            ),
+        )
+    except ValueError as error:
+        result.update(passed=False, error=str(error))
+        return result
+    result["actual"] = "denied" if findings else "allowed"
+    result["statements"] = [finding.to_dict() for finding in findings]
+    result["denied_by"] = [finding.describe() for finding in findings]
+    missing = [
+        expected
+        for expected in case["denied_by"]
+        if not any(_explains(expected, finding) for finding in findings)
+    ]
+    result["passed"] = result["actual"] == case["expect"] and not missing
+    if missing and findings:
+        result["error"] = f"not denied by {', '.join(missing)}"
+    return result
+
+
+def _run_shard(cases):
+    return [run_case(case) for case in cases]
+
+
+def run_cases(cases, snapshot, max_workers=None):
+    """
+    Returns the result of every case, in order. Large runs are split into
+    shards that are evaluated on up to max_workers processes.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1 or len(cases) < MIN_PARALLEL_CASES:
+        _init_worker(snapshot)
+        return _run_shard(cases)
+    shard_size = -(-len(cases) // (max_workers * SHARDS_PER_WORKER))
+    shards = [cases[i : i + shard_size] for i in range(0, len(cases), shard_size)]
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_worker, initargs=(snapshot,)
+    ) as executor:
+        return [
+            result for shard in executor.map(_run_shard, shards) for result in shard
+        ]
+
+
+def describe_failure(result):
+    if "actual" not in result:
+        reason = result["error"]
+    else:
+        reason = f"got {result['actual']}"
+        if result["denied_by"]:
+            reason += f" by {', '.join(result['denied_by'])}"
+        if result.get("error"):
+            reason += f", {result['error']}"
+    return (
+        f"{result['suite']}: {result['name']} ({result['target']}, {result['action']} "
+        f"on {result['resource']}): expected {result['expect']}, {reason}"
+    )
+
+
+def run_policy_tests(
+    # [Optional] The suite files to run (Defaults to every .tests.json below service_control_policies)
+    suites=None,
+    # [Optional] A bundle written by scp_render.py (Defaults to rendering the templates)
+    bundle=None,
+    # [Optional] The directory with scp_define_attach.tf and terraform.tfvars
+    source_dir=SOURCE_DIR,
+    # [Optional] The management account ID to render the templates with
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+    # [Optional] An organization snapshot (see find_blocking_scps/org_snapshot.py)
+    # for the OU tree and the SCPs not managed here (Defaults to every OU being directly below the root)
+    snapshot=None,
+    # [Optional] Whether FullAWSAccess is still attached to every target
+    full_aws_access=True,
+    # [Optional] How many processes evaluate the cases (Defaults to one per CPU core)
+    max_workers=None,
+    # [Optional] Write the results as JSON to this file
+    output=None,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    run_policy_tests()
+    run_policy_tests(bundle="scp_bundle", output="policy_tests.json")
+    """
+    if bundle:
+        master_account_id = read_manifest(bundle)["master_account_id"]
+    modules = load_rendered(bundle, source_dir, master_account_id)
+    base = None
+    if snapshot:
+        with gzip.open(snapshot, "rt", encoding="utf-8") as snapshot_file:
+            base = json.load(snapshot_file)
+    organization = planned_snapshot(modules, master_account_id, base, full_aws_access)
+    cases = []
+    for path in suites or find_suites(source_dir):
+        accounts, suite_cases = read_suite(path, source_dir, master_account_id)
+        for account, parent in accounts.items():
+            if organization["parents"].get(account, parent) != parent:
+                raise ValueError(
+                    f"{os.path.relpath(path, source_dir)}: account {account} is "
+                    f"already below {organization['parents'][account]}"
+                )
+            organization["parents"][account] = parent
+        cases.extend(suite_cases)
+    results = run_cases(cases, organization, max_workers)
+    failures = [result for result in results if not result["passed"]]
+    for result in failures:
+        logging.error(describe_failure(result))
+        for statement in result.get("statements", []):
+            if "sid" in statement:
+                logging.error(
+                    f"    {statement['policy_name']}/{statement['sid']} ({statement['policy_arn']})"
+                )
+    logging.warning(
+        f"{len(results) - len(failures)} of {len(results)} policy test cases passed."
+    )
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    if failures:
+        raise SystemExit(1)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP policy test suites")
+    parser.set_defaults(method=run_policy_tests)
+    parser.add_argument(
+        "suites",
+        type=str,
+        nargs="*",
+        help="The suite files to run. Defaults to every .tests.json below service_control_policies.",
+    )
+    parser.add_argument(
+        "--bundle",
+        type=str,
+        required=False,
+        help="A bundle written by scp_render.py. Defaults to rendering the templates.",
+    )
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=SOURCE_DIR,
+        help="The directory with scp_define_attach.tf and terraform.tfvars.",
+    )
+    parser.add_argument(
+        "--master_account_id",
+        type=str,
+        default=DEFAULT_MASTER_ACCOUNT_ID,
+        help="The management account ID to render the templates with.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        required=False,
+        help="An organization snapshot for the OU tree and the SCPs not managed here. Defaults to every OU being directly below the root.",
+    )
+    parser.add_argument(
+        "--without_full_aws_access",
+        dest="full_aws_access",
+        action="store_false",
+        help="FullAWSAccess was replaced by allow-list SCPs.",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        required=False,
+        help="How many processes evaluate the cases. Defaults to one per CPU core.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Write the results as JSON to this file.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
@@ -0,0 +1,167 @@
+import json
+import os
+import re
+
+"""
+Renders the SCP templates the way scp_define_attach.tf does, without Terraform
+or AWS access.
+
+Every module of scp_define_attach.tf is read for its SCP name, template and
+targets, the targets are resolved from terraform.tfvars, and the template is
+rendered and encoded like jsonencode(jsondecode(templatefile(...))).
+"""
+
+# The directory with scp_define_attach.tf, terraform.tfvars and the templates
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Used for master_account_id when rendering offline. It has the length of a
+# real account ID, so sizes come out the same.
+DEFAULT_MASTER_ACCOUNT_ID = "123456789012"
+
+# AWS quotas for SCPs
+MAX_POLICY_CHARACTERS = 5120
+MAX_POLICIES_PER_TARGET = 5
+
+MODULE_PATTERN = re.compile(r'^module\s+"([^"]+)"\s*\{(.*?)^\}', re.M | re.S)
+ARGUMENT_PATTERN = re.compile(r"^\s*(\w+)\s*=\s*(.+?)\s*$", re.M)
+TEMPLATE_PATTERN = re.compile(r'templatefile\(\s*"([^"]+)"')
+VARIABLE_PATTERN = re.compile(r"var\.(\w+)")
+
+
+class ScpModule:
+    """
+    One module of scp_define_attach.tf: an SCP rendered from a template and
+    attached to a list of targets.
+    """
+
+    def __init__(
+        self, module_name, scp_name, template, targets, content, description=""
+    ):
+        self.module_name = module_name
+        self.scp_name = scp_name
+        self.description = description
+        # The template path, relative to the source directory
+        self.template = template
+        self.targets = targets
+        # The policy as Terraform sends it to AWS
+        self.content = content
+
+    @property
+    def document(self):
+        return json.loads(self.content)
+
+    @property
+    def size(self):
+        return len(self.content)
+
+
+def terraform_jsonencode(value):
+    """
+    Encodes a value like Terraform's jsonencode: no whitespace, object keys in
+    lexical order and <, >, &, U+2028 and U+2029 escaped.
+    """
+    encoded = json.dumps(
+        value, separators=(",", ":"), sort_keys=True, ensure_ascii=False
+    )
+    for character in "<>&\u2028\u2029":
+        encoded = encoded.replace(character, f"\\u{ord(character):04x}")
+    return encoded
+
+
+def render_template(path, variables):
+    """
+    Renders a templatefile() template with only ${name} interpolations
+    ($${ is a literal ${). Raises ValueError for directives and unknown names.
+    """
+    with open(path) as template_file:
+        template = template_file.read()
+    if re.search(r"(?<!%)%\{", template):
+        raise ValueError(f"{path}: template directives (%{{...}}) are not supported")
+
+    def interpolate(match):
+        if match.group(1):
+            return "${"
+        name = match.group(2).strip()
+        if name not in variables:
+            raise ValueError(f"{path}: unknown template variable {name}")
+        return str(variables[name])
+
+    return re.sub(r"(\$)?\$\{([^}]*)\}", interpolate, template)
+
+
+def read_tfvars(path):
+    """
+    Reads a terraform.tfvars file with string and list of strings values.
+    """
+    with open(path) as tfvars_file:
+        text = re.sub(r"(?m)^\s*(#|//).*$", "", tfvars_file.read())
+    return {name: json.loads(value) for name, value in ARGUMENT_PATTERN.findall(text)}
+
+
+def _resolve_targets(expression, tfvars):
+    # Either [var.a, var.b, "literal"] or var.list
+    expression = expression.strip()
+    if expression.startswith("["):
+        items = [item.strip() for item in expression[1:-1].split(",") if item.strip()]
+    else:
+        items = [expression]
+    targets = []
+    for item in items:
+        variable = VARIABLE_PATTERN.fullmatch(item)
+        if variable is None:
+            targets.append(json.loads(item))
+            continue
+        value = tfvars.get(variable.group(1), [])
+        targets.extend(value if isinstance(value, list) else [value])
+    return targets
+
+
+def render_policy(source_dir, template, master_account_id):
+    """
+    Returns a template rendered and encoded like
+    jsonencode(jsondecode(templatefile(...))), raising ValueError if it is not
+    valid JSON.
+    """
+    rendered = render_template(
+        os.path.join(source_dir, template),
+        {"master_account_id": master_account_id},
+    )
+    try:
+        document = json.loads(rendered)
+    except json.JSONDecodeError as error:
+        raise ValueError(f"{template} is not valid JSON: {error}") from None
+    return terraform_jsonencode(document)
+
+
+def load_modules(
+    source_dir=SOURCE_DIR, master_account_id=DEFAULT_MASTER_ACCOUNT_ID, policies=None
+):
+    """
+    Returns the ScpModule of every module in scp_define_attach.tf, in order.
+    Templates found in policies (template path to rendered content, e.g. from
+    scp_render.render_policies) are not rendered again.
+    """
+    tfvars = read_tfvars(os.path.join(source_dir, "terraform.tfvars"))
+    with open(os.path.join(source_dir, "scp_define_attach.tf")) as tf_file:
+        text = tf_file.read()
+    modules = []
+    for module_name, body in MODULE_PATTERN.findall(text):
+        arguments = dict(ARGUMENT_PATTERN.findall(body))
+        template = os.path.normpath(
+            TEMPLATE_PATTERN.search(arguments["scp_policy"]).group(1)
+        )
+        if policies and template in policies:
+            content = policies[template]
+        else:
+            content = render_policy(source_dir, template, master_account_id)
+        modules.append(
+            ScpModule(
+                module_name,
+                json.loads(arguments["scp_name"]),
+                template,
+                _resolve_targets(arguments.get("scp_target_list", "[]"), tfvars),
+                content,
+                json.loads(arguments.get("scp_desc", '""')),
+            )
+        )
+    return modules
@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from scp_render import load_rendered
+from scp_templates import DEFAULT_MASTER_ACCOUNT_ID, SOURCE_DIR
+
+"""
+Validates every rendered SCP with IAM Access Analyzer (ValidatePolicy),
+concurrently, and writes all findings to one JSON report.
+
+Findings are cached by the hash of the policy content, so a policy that did
+not change is never validated again.
+"""
+
+DEFAULT_MAX_WORKERS = 8
+
+# Finding types that fail the validation
+DEFAULT_FAIL_ON = ("ERROR", "SECURITY_WARNING")
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class FindingsCache:
+    """
+    Access Analyzer findings by policy content hash, as one JSON file per
+    policy in a local directory or under an s3://bucket/prefix URL.
+    """
+
+    def __init__(self, location):
+        self.location = location.rstrip("/")
+        self.s3 = None
+        if self.location.startswith("s3://"):
+            import boto3
+
+            self.s3 = boto3.client("s3")
+            self.bucket, _, self.prefix = self.location[len("s3://") :].partition("/")
+        else:
+            os.makedirs(self.location, exist_ok=True)
+
+    def _key(self, policy_hash):
+        return (
+            f"{self.prefix}/{policy_hash}.json"
+            if self.prefix
+            else f"{policy_hash}.json"
+        )
+
+    def get(self, policy_hash):
+        if self.s3 is not None:
+            try:
+                response = self.s3.get_object(
+                    Bucket=self.bucket, Key=self._key(policy_hash)
+                )
+            except self.s3.exceptions.NoSuchKey:
+                return None
+            return json.loads(response["Body"].read())
+        path = os.path.join(self.location, f"{policy_hash}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as cache_file:
+            return json.load(cache_file)
+
+    def put(self, policy_hash, findings):
+        body = json.dumps(findings)
+        if self.s3 is not None:
+            self.s3.put_object(
+                Bucket=self.bucket, Key=self._key(policy_hash), Body=body.encode()
+            )
+            return
+        with open(
+            os.path.join(self.location, f"{policy_hash}.json"), "w"
+        ) as cache_file:
+            cache_file.write(body)
+
+
+def validate_policy(analyzer_client, content):
+    """
+    Returns the Access Analyzer findings of one SCP.
+    """
+    paginator = analyzer_client.get_paginator("validate_policy")
+    findings = []
+    for page in paginator.paginate(
+        policyDocument=content, policyType="SERVICE_CONTROL_POLICY"
+    ):
+        for finding in page["findings"]:
+            findings.append(
+                {
+                    "findingType": finding["findingType"],
+                    "issueCode": finding["issueCode"],
+                    "findingDetails": finding["findingDetails"],
+                    "learnMoreLink": finding.get("learnMoreLink", ""),
+                    "locations": finding.get("locations", []),
+                }
+            )
+    return findings
+
+
+def validate_modules(
+    modules, analyzer_client, cache=None, max_workers=DEFAULT_MAX_WORKERS
+):
+    """
+    Returns one report entry per module, with its findings. Policies with the
+    same content are validated once.
+    """
+    hashes = {module.module_name: content_hash(module.content) for module in modules}
+    contents = {hashes[module.module_name]: module.content for module in modules}
+
+    def findings_for(policy_hash):
+        findings = cache.get(policy_hash) if cache is not None else None
+        if findings is not None:
+            return findings, True
+        findings = validate_policy(analyzer_client, contents[policy_hash])
+        if cache is not None:
+            cache.put(policy_hash, findings)
+        return findings, False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = dict(zip(contents, executor.map(findings_for, contents)))
+    report = []
+    for module in modules:
+        findings, cached = results[hashes[module.module_name]]
+        report.append(
+            {
+                "module": module.module_name,
+                "scp_name": module.scp_name,
+                "template": module.template,
+                "content_hash": hashes[module.module_name],
+                "cached": cached,
+                "findings": findings,
+            }
+        )
+    return report
+
+
+def validate_scps(
+    # [Optional] Findings cache, as a directory or an s3://bucket/prefix URL
+    cache=None,
+    # [Optional] Write the report as JSON to this file
+    output=None,
+    # [Optional] Finding types that fail the validation
+    fail_on=DEFAULT_FAIL_ON,
+    # [Optional] How many policies are validated concurrently
+    max_workers=DEFAULT_MAX_WORKERS,
+    # [Optional] A bundle written by scp_render.py (Defaults to rendering the templates)
+    bundle=None,
+    # [Optional] The directory with scp_define_attach.tf and terraform.tfvars
+    source_dir=SOURCE_DIR,
+    # [Optional] The management account ID to render the templates with
+    master_account_id=DEFAULT_MASTER_ACCOUNT_ID,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    validate_scps(cache="s3://my-tfstate-bucket/access-analyzer-cache", output="report.json")
+    """
+    import boto3
+    from botocore.config import Config
+
+    analyzer_client = boto3.client(
+        "accessanalyzer",
+        config=Config(retries={"mode": "adaptive", "max_attempts": 10}),
+    )
+    modules = load_rendered(bundle, source_dir, master_account_id)
+    report = validate_modules(
+        modules,
+        analyzer_client,
+        FindingsCache(cache) if cache else None,
+        max_workers,
+    )
+    failed = 0
+    for entry in report:
+        for finding in entry["findings"]:
+            logging.warning(
+                f"{entry['scp_name']}: {finding['findingType']} {finding['issueCode']}: {finding['findingDetails']}"
+            )
+            failed += finding["findingType"] in fail_on
+    cached = sum(entry["cached"] for entry in report)
+    logging.warning(
+        f"Validated {len(report)} SCPs ({cached} from the cache), "
+        f"{sum(len(entry['findings']) for entry in report)} findings."
+    )
+    if output:
+        with open(output, "w") as output_file:
+            json.dump({"policies": report}, output_file, indent=2)
+    if failed:
+        logging.error(f"{failed} findings of type {', '.join(fail_on)}.")
+        raise SystemExit(1)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SCP Access Analyzer validation")
+    parser.set_defaults(method=validate_scps)
+    parser.add_argument(
+        "--cache",
+        type=str,
+        required=False,
+        help="Cache findings by policy content hash in this directory or s3://bucket/prefix URL.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Write the report as JSON to this file.",
+    )
+    parser.add_argument(
+        "--fail_on",
+        type=str,
+        nargs="+",
+        default=DEFAULT_FAIL_ON,
+        choices=["ERROR", "SECURITY_WARNING", "WARNING", "SUGGESTION"],
+        help=f"Finding types that fail the validation (default {' '.join(DEFAULT_FAIL_ON)}).",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help=f"How many policies are validated concurrently (default {DEFAULT_MAX_WORKERS}).",
+    )
+    parser.add_argument(
+        "--bundle",
+        type=str,
+        required=False,
+        help="A bundle written by scp_render.py. Defaults to rendering the templates.",
+    )
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=SOURCE_DIR,
+        help="The directory with scp_define_attach.tf and terraform.tfvars.",
+    )
+    parser.add_argument(
+        "--master_account_id",
+        type=str,
+        default=DEFAULT_MASTER_ACCOUNT_ID,
+        help="The management account ID to render the templates with.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+"""
+Times one phase of a pipeline build, e.g. terraform init or plan, and prints
+the duration as a CloudWatch embedded metric format (EMF) record, so that the
+build logs can be aggregated with timing_report.py.
+
+The command runs with the build's stdout and stderr, and its exit code is
+passed on, so a buildspec command can be wrapped as it is:
+
+    python3 scp_analysis/stage_timing.py --stage SCP-Plan-Validate --phase init -- terraform init
+"""
+
+NAMESPACE = "SCPManagementPipeline"
+
+# Build details recorded with every record, by environment variable
+BUILD_PROPERTIES = {
+    "BuildId": "CODEBUILD_BUILD_ID",
+    "SourceVersion": "CODEBUILD_RESOLVED_SOURCE_VERSION",
+    "PullRequestId": "pullRequestId",
+}
+
+
+def emf_record(stage, phase, duration_ms, status, properties=None):
+    """
+    Returns the EMF record of one timed phase, with Stage and Phase as
+    dimensions.
+    """
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [["Stage", "Phase"]],
+                    "Metrics": [
+                        {"Name": "Duration", "Unit": "Milliseconds"},
+                        {"Name": "Failed", "Unit": "Count"},
+                    ],
+                }
+            ],
+        },
+        "Stage": stage,
+        "Phase": phase,
+        "Duration": round(duration_ms, 1),
+        "Failed": int(status != 0),
+        "Status": status,
+        **(properties or {}),
+    }
+
+
+def time_phase(
+    # The pipeline stage, e.g. SCP-Plan-Validate
+    stage,
+    # The phase of the stage, e.g. init, plan or apply
+    phase,
+    # The command to run and time
+    command,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    time_phase(stage="SCP-Deploy", phase="apply", command=["terraform", "apply", "-auto-approve"])
+    """
+    if command and command[0] == "--":
+        command = command[1:]
+    if not command:
+        raise SystemExit("No command to time, pass it after --")
+    started = time.perf_counter()
+    try:
+        status = subprocess.call(command)
+    except OSError as error:
+        print(error, file=sys.stderr)
+        status = 127
+    duration_ms = (time.perf_counter() - started) * 1000
+    properties = {
+        name: os.environ[variable]
+        for name, variable in BUILD_PROPERTIES.items()
+        if os.environ.get(variable)
+    }
+    print(
+        json.dumps(emf_record(stage, phase, duration_ms, status, properties)),
+        flush=True,
+    )
+    raise SystemExit(status)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Times a pipeline build phase as an EMF record"
+    )
+    parser.set_defaults(method=time_phase)
+    parser.add_argument(
+        "--stage",
+        type=str,
+        required=True,
+        help="The pipeline stage, e.g. SCP-Plan-Validate.",
+    )
+    parser.add_argument(
+        "--phase",
+        type=str,
+        required=True,
+        help="The phase of the stage, e.g. init, plan or apply.",
+    )
+    parser.add_argument(
+        "command",
+        nargs=argparse.REMAINDER,
+        help="The command to run and time, after --.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))
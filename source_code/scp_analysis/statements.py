@@ -0,0 +1,201 @@
+import json
+
+"""
+Canonical SCP statements, and when one statement covers another.
+
+Action and resource patterns only use * and ?, so whether one pattern covers
+another (matches every string the other one matches) can be decided on the
+patterns themselves, without expanding them.
+"""
+
+# Operators that hold when the value matches none of the listed values. Fewer
+# listed values make them hold more often.
+NEGATED_LIST_OPERATORS = (
+    "StringNotEquals",
+    "StringNotEqualsIgnoreCase",
+    "StringNotLike",
+    "ArnNotEquals",
+    "ArnNotLike",
+    "NotIpAddress",
+)
+
+# Operators that hold when the value matches one of the listed values. More
+# listed values make them hold more often.
+LIST_OPERATORS = (
+    "StringEquals",
+    "StringEqualsIgnoreCase",
+    "StringLike",
+    "ArnEquals",
+    "ArnLike",
+    "IpAddress",
+)
+
+
+def _as_list(value):
+    # Standardize into a list if there's only one value
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def glob_covers(pattern, other):
+    """
+    Returns whether every string matching the glob other also matches the
+    glob pattern (* matches any sequence, ? any single character).
+    """
+    # covered[i][j]: pattern[i:] covers other[j:]
+    covered = [[False] * (len(other) + 1) for _ in range(len(pattern) + 1)]
+    covered[len(pattern)][len(other)] = True
+    for i in range(len(pattern) - 1, -1, -1):
+        for j in range(len(other), -1, -1):
+            if pattern[i] == "*":
+                # Match nothing, or swallow the next token of other
+                covered[i][j] = covered[i + 1][j] or (
+                    j < len(other) and covered[i][j + 1]
+                )
+            elif j == len(other):
+                covered[i][j] = False
+            elif pattern[i] == "?":
+                covered[i][j] = other[j] != "*" and covered[i + 1][j + 1]
+            else:
+                covered[i][j] = pattern[i] == other[j] and covered[i + 1][j + 1]
+    return covered[0][0]
+
+
+def _service(pattern):
+    return pattern.split(":", 1)[0] if ":" in pattern else "*"
+
+
+class CanonicalStatement:
+    """
+    An SCP statement with its actions lowercased and sorted, its resources
+    sorted and its Condition block normalized, so that equal statements
+    compare equal regardless of how they are written.
+    """
+
+    def __init__(self, statement, scp_name="", index=0):
+        self.statement = statement
+        self.scp_name = scp_name
+        # The position of the statement in its policy
+        self.index = index
+        self.sid = statement.get("Sid", "")
+        self.effect = statement.get("Effect", "")
+        self.not_action = "NotAction" in statement
+        self.actions = tuple(
+            sorted(
+                {
+                    action.lower()
+                    for action in _as_list(
+                        statement.get("NotAction" if self.not_action else "Action")
+                    )
+                }
+            )
+        )
+        self.not_resource = "NotResource" in statement
+        self.resources = tuple(
+            sorted(
+                set(
+                    _as_list(
+                        statement.get(
+                            "NotResource" if self.not_resource else "Resource"
+                        )
+                    )
+                )
+            )
+        )
+        self.condition = {
+            operator: {
+                key.lower(): tuple(sorted(str(value) for value in _as_list(values)))
+                for key, values in keys.items()
+            }
+            for operator, keys in statement.get("Condition", {}).items()
+        }
+        self.condition_key = json.dumps(self.condition, sort_keys=True)
+
+    def key(self):
+        """
+        Statements with equal keys have exactly the same effect.
+        """
+        return (
+            self.effect,
+            self.not_action,
+            self.actions,
+            self.not_resource,
+            self.resources,
+            self.condition_key,
+        )
+
+    def covers_action(self, action):
+        """
+        Returns whether the statement applies to every action matching action.
+        """
+        if not self.not_action:
+            return any(glob_covers(pattern, action) for pattern in self.actions)
+        if "*" in action or "?" in action:
+            # Only certain if no excluded pattern is in the same service
+            if "*" in _service(action) or "?" in _service(action):
+                return False
+            return all(
+                _service(pattern) != _service(action)
+                and "*" not in _service(pattern)
+                and "?" not in _service(pattern)
+                for pattern in self.actions
+            )
+        return not any(glob_covers(pattern, action) for pattern in self.actions)
+
+    def covers_resources(self, other):
+        if self.not_resource or other.not_resource:
+            return self.not_resource == other.not_resource and set(
+                self.resources
+            ) <= set(other.resources)
+        return all(
+            any(glob_covers(pattern, resource) for pattern in self.resources)
+            for resource in other.resources
+        )
+
+    def condition_implied_by(self, other):
+        """
+        Returns whether this statement's Condition block holds whenever the
+        Condition block of other does.
+        """
+        for operator, keys in self.condition.items():
+            other_keys = other.condition.get(operator, {})
+            base_operator = operator.split(":")[-1]
+            for key, values in keys.items():
+                if key not in other_keys:
+                    return False
+                other_values = set(other_keys[key])
+                if base_operator in NEGATED_LIST_OPERATORS:
+                    if not set(values) <= other_values:
+                        return False
+                elif base_operator in LIST_OPERATORS and ":" not in operator:
+                    if not set(values) >= other_values:
+                        return False
+                elif set(values) != other_values:
+                    return False
+        return True
+
+    def applies_wherever(self, other):
+        """
+        Returns whether this statement applies to every request that other
+        applies to, for the actions both name.
+        """
+        return (
+            self.effect == other.effect
+            and self.covers_resources(other)
+            and self.condition_implied_by(other)
+        )
+
+    def covers(self, other):
+        """
+        Returns whether this statement applies to every request that other
+        applies to.
+        """
+        if other.not_action:
+            return self.key() == other.key()
+        return self.applies_wherever(other) and all(
+            self.covers_action(action) for action in other.actions
+        )
+
+    def describe(self):
+        return f"{self.scp_name}/{self.sid or self.index}"
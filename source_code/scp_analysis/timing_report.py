@@ -0,0 +1,165 @@
+import argparse
+import datetime
+import gzip
+import json
+import logging
+
+"""
+Aggregates the timing records of the pipeline into latency percentiles per
+stage and phase, slowest first.
+
+Reads exported logs with the EMF records of stage_timing.py and of the pull
+request Lambda function: plain text logs (e.g. downloaded from CodeBuild),
+the JSON output of aws logs filter-log-events or get-log-events, and .gz
+files of either. The JSON output of aws codepipeline list-action-executions
+adds the duration of every pipeline action, including Source and the manual
+approval.
+"""
+
+
+def _emf_records(text):
+    # Every line (or log event message) that holds an EMF record
+    for line in text.splitlines():
+        start = line.find('{"')
+        if start < 0 or '"_aws"' not in line:
+            continue
+        try:
+            record = json.loads(line[start:])
+        except json.JSONDecodeError:
+            continue
+        if isinstance(record, dict) and "_aws" in record:
+            yield record
+
+
+def _parse_time(value):
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _action_records(executions):
+    for execution in executions:
+        if "lastUpdateTime" not in execution or "startTime" not in execution:
+            continue
+        duration = _parse_time(execution["lastUpdateTime"]) - _parse_time(
+            execution["startTime"]
+        )
+        yield {
+            "Stage": execution["stageName"],
+            "Phase": execution["actionName"],
+            "Duration": duration.total_seconds() * 1000,
+            "Failed": int(execution.get("status") == "Failed"),
+        }
+
+
+def read_timings(path):
+    """
+    Returns the timing records of one exported log file.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as log_file:
+        text = log_file.read()
+    try:
+        exported = json.loads(text)
+    except json.JSONDecodeError:
+        exported = None
+    if isinstance(exported, dict) and "actionExecutionDetails" in exported:
+        return list(_action_records(exported["actionExecutionDetails"]))
+    if isinstance(exported, dict) and "events" in exported:
+        text = "\n".join(event["message"] for event in exported["events"])
+    records = []
+    for record in _emf_records(text):
+        if "Stage" in record and "Phase" in record and "Duration" in record:
+            records.append(record)
+    return records
+
+
+def _percentile(ordered, fraction):
+    # Linear interpolation between the closest ranks
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def aggregate(records):
+    """
+    Returns the count, failures, total and latency percentiles (in
+    milliseconds) of every stage and phase, slowest p90 first.
+    """
+    durations = {}
+    failures = {}
+    for record in records:
+        key = (record["Stage"], record["Phase"])
+        durations.setdefault(key, []).append(float(record["Duration"]))
+        failures[key] = failures.get(key, 0) + int(record.get("Failed", 0))
+    phases = []
+    for (stage, phase), values in durations.items():
+        values.sort()
+        phases.append(
+            {
+                "stage": stage,
+                "phase": phase,
+                "count": len(values),
+                "failed": failures[(stage, phase)],
+                "total_ms": sum(values),
+                "p50_ms": _percentile(values, 0.5),
+                "p90_ms": _percentile(values, 0.9),
+                "p99_ms": _percentile(values, 0.99),
+                "max_ms": values[-1],
+            }
+        )
+    return sorted(phases, key=lambda phase: phase["p90_ms"], reverse=True)
+
+
+def timing_report(
+    # The exported log files
+    logs,
+    # [Optional] Write the report as JSON to this file
+    output=None,
+    # keyworded variable length of arguments
+    **kwargs,
+):
+    """
+    Example Usage:
+    timing_report(logs=["plan_build.log", "pipeline_actions.json"], output="timing.json")
+    """
+    records = []
+    for path in logs:
+        records.extend(read_timings(path))
+    phases = aggregate(records)
+    logging.warning(
+        f"{'stage':<28} {'phase':<20} {'count':>5} {'failed':>6} {'p50 s':>8} {'p90 s':>8} {'p99 s':>8} {'max s':>8}"
+    )
+    for phase in phases:
+        logging.warning(
+            f"{phase['stage']:<28} {phase['phase']:<20} {phase['count']:>5} {phase['failed']:>6} "
+            f"{phase['p50_ms'] / 1000:>8.2f} {phase['p90_ms'] / 1000:>8.2f} "
+            f"{phase['p99_ms'] / 1000:>8.2f} {phase['max_ms'] / 1000:>8.2f}"
+        )
+    logging.warning(f"{len(records)} timing records in {len(logs)} files.")
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(phases, output_file, indent=2)
+    return phases
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Per-phase latency percentiles of the SCP pipeline"
+    )
+    parser.set_defaults(method=timing_report)
+    parser.add_argument(
+        "logs",
+        type=str,
+        nargs="+",
+        help="Exported build or Lambda logs, or aws codepipeline list-action-executions output.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=False,
+        help="Write the report as JSON to this file.",
+    )
+    args = parser.parse_args()
+    args.method(**vars(args))